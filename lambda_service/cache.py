@@ -0,0 +1,68 @@
+""" Small in-process caches.
+
+Lambda keeps module state between warm invocations of the same container, so values cached here are reused until
+they expire or the container is recycled.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """ A bounded cache whose entries expire after a fixed time.
+
+    When the cache is full, the least recently used entry is evicted. Safe to share between threads.
+
+    Args:
+        maxsize (int): maximum number of entries.
+        ttl_s (float): default number of seconds an entry stays valid.
+        clock (callable): returns the current time in seconds. Defaults to time.monotonic.
+    """
+
+    def __init__(self, maxsize, ttl_s, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl_s = ttl_s
+        self._clock = clock
+        self._entries = OrderedDict()  # key: (expiration time, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Get the value for key, or default if it is missing or expired. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl_s=None):
+        """ Store value under key, valid for ttl_s seconds (or the cache's default ttl). """
+        ttl_s = self.ttl_s if ttl_s is None else ttl_s
+        with self._lock:
+            self._entries[key] = (self._clock() + ttl_s, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """ Remove key and return its value, or default if it is missing or expired. """
+        value = self.get(key, default)
+        with self._lock:
+            self._entries.pop(key, None)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key):
+        sentinel = object()
+        return self.get(key, sentinel) is not sentinel
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -1,24 +1,125 @@
 import boto3
 import json
+import logging
+import os
+import threading
+from functools import lru_cache
 
+logger = logging.getLogger(__name__)
+
+DATASTREAM_QUEUE_NAME = os.getenv('DATASTREAM_QUEUE_NAME', 'datastreamIncomingQueue-dev')
+
+# Limits for a single send_message_batch request
+SEND_MESSAGE_BATCH_MAX_ENTRIES = 10
+SEND_MESSAGE_BATCH_MAX_BYTES = 256 * 1024
+
+
+@lru_cache(maxsize=None)
+def get_sqs_client():
+    return boto3.client('sqs', region_name=os.getenv('REGION', 'us-east-1'))
+
+
+@lru_cache(maxsize=None)
 def get_queue_url(queueName):
-    sqs_client = boto3.client("sqs", region_name="us-east-1")
-    response = sqs_client.get_queue_url(
+    """ Look up the url of a queue. Queue urls don't change, so each is only looked up once per container. """
+    response = get_sqs_client().get_queue_url(
         QueueName=queueName,
     )
     return response["QueueUrl"]
 
+
+class DatastreamPublisher:
+    """ Collects datastream messages and sends them to the queue in batches.
+
+    Messages are held until flush() is called (the handlers flush at the end of each invocation), then sent with
+    send_message_batch, up to 10 messages per request. Safe to share between threads.
+
+    Args:
+        queue_name (str): name of the SQS queue that feeds the datastream.
+    """
+
+    def __init__(self, queue_name=DATASTREAM_QUEUE_NAME):
+        self.queue_name = queue_name
+        self._messages = []
+        self._lock = threading.Lock()
+
+    def publish(self, site, data):
+        """ Queue a message for the next flush. """
+        payload = {
+            "topic": "imagedata",
+            "site": site,
+            "data": data,
+        }
+        with self._lock:
+            self._messages.append(json.dumps(payload))
+
+    def flush(self) -> int:
+        """ Send every queued message.
+
+        Messages that can't be sent are logged and dropped; like before batching, a failed notification doesn't
+        fail the upload that caused it. Entries that SQS rejects because of a server side error are retried once.
+
+        Returns:
+            int: the number of messages that could not be sent.
+        """
+        with self._lock:
+            messages, self._messages = self._messages, []
+        if not messages:
+            return 0
+
+        failed = 0
+        for batch in batch_messages(messages):
+            try:
+                failed += self._send_batch(batch)
+            except Exception:
+                logger.exception(f"Failed to send {len(batch)} messages to {self.queue_name}")
+                failed += len(batch)
+        return failed
+
+    def _send_batch(self, batch, retry=True) -> int:
+        entries = [{"Id": str(i), "MessageBody": body} for i, body in enumerate(batch)]
+        response = get_sqs_client().send_message_batch(
+            QueueUrl=get_queue_url(self.queue_name),
+            Entries=entries,
+        )
+        failures = response.get("Failed", [])
+        if not failures:
+            return 0
+
+        retryable = [batch[int(f["Id"])] for f in failures if not f.get("SenderFault")]
+        for failure in failures:
+            if failure.get("SenderFault") or not retry:
+                logger.error(f"Datastream message rejected: {failure}")
+        if retry and retryable:
+            return len(failures) - len(retryable) + self._send_batch(retryable, retry=False)
+        return len(failures)
+
+
+def batch_messages(messages):
+    """ Split message bodies into batches that fit in one send_message_batch request (by count and total size). """
+    batch = []
+    batch_bytes = 0
+    for body in messages:
+        body_bytes = len(body.encode('utf8'))
+        if batch and (len(batch) == SEND_MESSAGE_BATCH_MAX_ENTRIES
+                      or batch_bytes + body_bytes > SEND_MESSAGE_BATCH_MAX_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(body)
+        batch_bytes += body_bytes
+    if batch:
+        yield batch
+
+
+publisher = DatastreamPublisher()
+
+
 def send_to_datastream(site, data):
-    sqs = boto3.client('sqs')
-    queue_url = get_queue_url('datastreamIncomingQueue-dev')
-
-    payload = {
-        "topic": "imagedata",
-        "site": site,
-        "data": data,
-    }
-    response = sqs.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(payload),
-    )
-    return response
\ No newline at end of file
+    """ Queue a message for the datastream. It's sent by the next flush_datastream() call. """
+    publisher.publish(site, data)
+
+
+def flush_datastream() -> int:
+    """ Send all the queued datastream messages. Returns the number of messages that could not be sent. """
+    return publisher.flush()
@@ -1,22 +1,29 @@
 import logging
 import os
-import json
-import boto3
 import re
+import threading
 from datetime import datetime
 from http import HTTPStatus
 from contextlib import contextmanager
-from sqlalchemy import Column, String, Integer, Float, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, String, Integer, Float, Boolean, ForeignKey, DateTime, Index
+from sqlalchemy import any_, bindparam, case, func, or_
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.postgresql import insert, JSONB, ARRAY
 from sqlalchemy import MetaData
 from sqlalchemy import Table
 from sqlalchemy.engine.url import URL # don't need if we get the db-address from aws ssm.
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
-from sqlalchemy.exc import ArgumentError
+from sqlalchemy.exc import ArgumentError, OperationalError
 
-from lambda_service.helpers import get_s3_image_path, get_s3_file_url, get_site_from_base_filename
+from lambda_service.helpers import get_s3_image_path, get_s3_file_urls, get_site_from_base_filename
+from lambda_service.helpers import get_s3_rendition_path
+from lambda_service.helpers import get_secret
+from lambda_service import parameter_store
+from lambda_service import db_profiling
+from lambda_service.stages import STAGE_MAX_WORKERS
 
 logger = logging.getLogger(__name__)
 handler = logging.StreamHandler()
@@ -27,43 +34,128 @@ logger.setLevel(logging.DEBUG)
 
 Base = declarative_base()
 
-ssm = boto3.client('ssm', region_name=os.getenv('REGION'))
-def get_secret(key):
-    """
-    Some parameters are stored in AWS Systems Manager Parameter Store.
-    This replaces the .env variables we used to use with flask.
-    """
-    resp = ssm.get_parameter(
-    	Name=key,
-    	WithDecryption=True
-    )
-    return resp['Parameter']['Value']
-
 class MissingFitsHeaderKey(Exception):
     pass
 
-DB_ADDRESS = get_secret('db-url')
+
+def get_db_address():
+    """ The database url. It's read from the parameter store when first needed (not at import) and then cached. """
+    return get_secret('db-url')
+
+
+def __getattr__(name):
+    # Keep `from lambda_service.db import DB_ADDRESS` working without calling the parameter store at import time
+    if name == 'DB_ADDRESS':
+        return get_db_address()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Connection pool settings. The engine (and its connections) is kept for the life of the container and reused
+# across warm invocations. A container handles one event at a time, but the stages of an event run on a thread pool
+# (see lambda_service.stages), and any of them may check out a connection at the same time. One connection is kept
+# open between invocations, and the overflow lets every stage worker have a connection without waiting.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 1))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', max(0, STAGE_MAX_WORKERS - DB_POOL_SIZE)))
+DB_POOL_RECYCLE_S = int(os.getenv('DB_POOL_RECYCLE_S', 300))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+
+# Engines and session factories, keyed by database url
+_engines = {}
+_session_factories = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(db_address):
+    """ Get the engine for a database url, creating it the first time it is requested.
+
+    The engine is cached for the life of the process, so connection setup is paid once per container
+    instead of once per query. Only the engine for the current url is kept: when the url changes (eg. the db-url
+    parameter is refreshed after the credentials are rotated), the engine for the previous url is disposed, so its
+    pooled connections don't stay open for the life of the container.
+
+    Args:
+        db_address (str): SQLAlchemy database url
+
+    Returns:
+        sqlalchemy.engine.Engine
+    """
+    engine = _engines.get(db_address)
+    if engine is not None:
+        return engine
+
+    with _engines_lock:
+        engine = _engines.get(db_address)
+        if engine is not None:
+            return engine
+        dispose_engines()
+        engine = create_engine(
+            db_address,
+            poolclass=QueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_recycle=DB_POOL_RECYCLE_S,
+            pool_pre_ping=DB_POOL_PRE_PING,
+        )
+        if db_profiling.DB_PROFILING_ENABLED:
+            db_profiling.attach_profiler(engine)
+        _session_factories[db_address] = sessionmaker(bind=engine)
+        _engines[db_address] = engine
+    return engine
+
+
+def dispose_engines(db_address=None):
+    """ Close the pooled connections and drop the cached engine(s).
+
+    The next call to get_session will create a fresh engine. This is useful after the database credentials
+    change, or before a container is frozen for a long time.
+
+    Args:
+        db_address (str): only dispose the engine for this url. If None, dispose every cached engine.
+    """
+    addresses = list(_engines) if db_address is None else [db_address]
+    for address in addresses:
+        engine = _engines.pop(address, None)
+        _session_factories.pop(address, None)
+        if engine is not None:
+            engine.dispose()
 
 
 @contextmanager
 def get_session(db_address):
     """ Get a connection to the database.
 
+    Sessions are bound to a pooled engine that is shared by every call with the same db_address.
+
     Returns:
         session: SQLAlchemy Database Session
     """
-    engine = create_engine(db_address)
-    db_session = sessionmaker(bind=engine)
-    session = db_session()
+    get_engine(db_address)
+    session = _session_factories[db_address]()
     try:
         yield session
         session.commit()
+    except OperationalError as e:
+        session.rollback()
+        if is_authentication_failure(e):
+            # The credentials were probably rotated. Drop the cached url and engine so the next attempt
+            # (usually the lambda retry) reads the current url from the parameter store.
+            logger.warning("Database authentication failed; refreshing the database url")
+            parameter_store.invalidate('db-url')
+            dispose_engines(db_address)
+        raise
     except:
         session.rollback()
         raise
     finally:
         session.close()
 
+
+def is_authentication_failure(error) -> bool:
+    """ Whether a database error means the credentials were rejected. """
+    # 28P01 is invalid_password and 28000 is invalid_authorization_specification
+    if getattr(error.orig, 'pgcode', None) in ('28P01', '28000'):
+        return True
+    return 'password authentication failed' in str(error.orig)
+
 def keyvalgen(obj):
     """ Generate attr name/val pairs, filtering out SQLA attrs."""
     excl = ('_sa_adapter', '_sa_instance_state')
@@ -73,9 +165,12 @@ def keyvalgen(obj):
 
 class Image(Base):
     __tablename__ = 'images'
+    __table_args__ = (
+        Index('images_header_gin', 'header', postgresql_using='gin'),
+    )
 
     image_id          = Column(Integer, primary_key=True)
-    base_filename     = Column(String)
+    base_filename     = Column(String, unique=True)
     data_type         = Column(String)
     site              = Column(String)
     capture_date      = Column(DateTime, default=datetime.utcnow)
@@ -89,12 +184,13 @@ class Image(Base):
     exposure_time     = Column(Float)
     username          = Column(String)
     user_id           = Column(String)
-    header            = Column(String)
+    header            = Column(JSONB)
 
     fits_01_exists    = Column(Boolean)
     fits_10_exists    = Column(Boolean)
     jpg_medium_exists = Column(Boolean)
     jpg_small_exists  = Column(Boolean)
+    jpg_renditions    = Column(ARRAY(Integer))  # heights (px) of the jpg renditions, see helpers.get_s3_rendition_path
 
 
 
@@ -112,52 +208,123 @@ class Image(Base):
         queries this api for images. 
 
         Notably missing from this is the entire fits header, for smaller 
-        payload sizes. 
+        payload sizes. To build packages for many images, use query_image_pkgs
+        or build_image_pkgs instead.
         
         """
+        return build_image_pkgs([self])[0]
 
-        package = {
-            "image_id": self.image_id,
-            "base_filename": self.base_filename,
-            "data_type": self.data_type,
-            "site": self.site, 
-
-            "exposure_time": self.exposure_time,
-            "filter_used": self.filter_used,
-            "right_ascension": self.right_ascension, 
-            "declination": self.declination, 
-            "azimuth": self.azimuth,
-            "altitude": self.altitude,
-            "airmass": self.airmass,
-
-            "fits_01_exists": self.fits_01_exists,
-            "fits_10_exists": self.fits_10_exists,
-            "jpg_medium_exists": self.jpg_medium_exists,
-            "jpg_small_exists": self.jpg_small_exists,
-
-            "username": self.username,
-            "user_id": self.user_id,
+
+# Fields copied as-is into an image package
+IMAGE_PKG_FIELDS = [
+    "image_id", "base_filename", "data_type", "site",
+    "exposure_time", "filter_used", "right_ascension", "declination", "azimuth", "altitude", "airmass",
+    "fits_01_exists", "fits_10_exists", "jpg_medium_exists", "jpg_small_exists",
+    "username", "user_id",
+]
+
+# Columns needed to build an image package. The header is deliberately left out.
+IMAGE_PKG_COLUMNS = [getattr(Image, field) for field in IMAGE_PKG_FIELDS] + [
+    Image.capture_date, Image.sort_date, Image.jpg_renditions,
+]
+
+
+def build_image_pkgs(rows) -> list:
+    """ Build image packages (see Image.get_image_pkg) for many rows at once.
+
+    The jpg urls for every row are presigned in one batch.
+
+    Args:
+        rows (iterable): Image instances, or rows from a query of IMAGE_PKG_COLUMNS.
+
+    Returns:
+        list: one package dict per row, in order.
+    """
+    rows = list(rows)
+
+    # Presign all the jpg urls together
+    jpg_paths = []
+    for row in rows:
+        medium_path = small_path = None
+        if row.jpg_medium_exists:
+            medium_path = get_s3_image_path("data", row.base_filename, row.data_type, "10", "jpg")
+        if row.jpg_small_exists:
+            small_path = get_s3_image_path("data", row.base_filename, row.data_type, "11", "jpg")
+        rendition_paths = {
+            height: get_s3_rendition_path(row.base_filename, row.data_type, height)
+            for height in row.jpg_renditions or []
         }
+        jpg_paths.append((medium_path, small_path, rendition_paths))
+    urls = get_s3_file_urls([
+        path for medium_path, small_path, rendition_paths in jpg_paths
+        for path in [medium_path, small_path, *rendition_paths.values()] if path is not None
+    ])
+
+    packages = []
+    for row, (medium_path, small_path, rendition_paths) in zip(rows, jpg_paths):
+        package = {field: getattr(row, field) for field in IMAGE_PKG_FIELDS}
 
         # Convert to timestamp in milliseconds
-        package["capture_date"] = int(1000 * self.capture_date.timestamp())
-        package["sort_date"] = int(1000 * self.sort_date.timestamp())
+        package["capture_date"] = int(1000 * row.capture_date.timestamp())
+        package["sort_date"] = int(1000 * row.sort_date.timestamp())
+
+        # Include a url to the medium and small jpgs
+        package["jpg_url"] = urls.get(medium_path, "")
+        package["jpg_thumbnail_url"] = urls.get(small_path, "")
+
+        # Urls of the renditions, by height in pixels, so clients can pick the smallest one that's big enough
+        package["jpg_rendition_urls"] = {height: urls[path] for height, path in rendition_paths.items()}
+        packages.append(package)
 
-        # Include a url to the medium jpg
-        package["jpg_url"] = ""
-        if self.jpg_medium_exists:
-            path = get_s3_image_path("data", self.base_filename, self.data_type, "10", "jpg")
-            url = get_s3_file_url(path)
-            package["jpg_url"] = url
+    return packages
 
-        # Include a url to the small jpg
-        package["jpg_thumbnail_url"] = ""
-        if self.jpg_small_exists:
-            path = get_s3_image_path("data", self.base_filename, self.data_type, "11", "jpg")
-            url = get_s3_file_url(path)
-            package["jpg_thumbnail_url"] = url
 
-        return package
+def query_image_pkgs(db_address: str, *criteria, order_by=None, limit: int = None) -> list:
+    """ Get image packages for the images matching some filter criteria.
+
+    Only the columns in IMAGE_PKG_COLUMNS are selected, and the rows are turned into packages directly, without
+    building ORM objects or loading the (large) header column.
+
+    Args:
+        db_address (str): SQLAlchemy database url
+        *criteria: SQLAlchemy filter expressions, eg. Image.site == 'tst'
+        order_by: SQLAlchemy ordering. Defaults to the most recent images first.
+        limit (int): maximum number of images to return.
+
+    Returns:
+        list: image packages.
+    """
+    with get_session(db_address=db_address) as session:
+        query = session.query(*IMAGE_PKG_COLUMNS)\
+            .filter(*criteria)\
+            .order_by(Image.capture_date.desc() if order_by is None else order_by)
+        if limit is not None:
+            query = query.limit(limit)
+        return build_image_pkgs(query.all())
+
+
+def upsert_image(db_address: str, base_filename: str, updates: dict):
+    """ Create or update the row for an exposure in a single statement.
+
+    Uses INSERT ... ON CONFLICT (base_filename) DO UPDATE, so concurrent lambdas handling files from the same
+    exposure can't create duplicate rows. Only the columns in `updates` are written when the row already exists.
+
+    Args:
+        db_address (str): SQLAlchemy database url
+        base_filename (str): identifies the exposure. Example: wmd-ea03-20190621-00000007
+        updates (dict): column names and the values to set
+    """
+    insert_stmt = insert(Image).values(
+        base_filename=base_filename,
+        site=get_site_from_base_filename(base_filename),
+        **updates
+    )
+    upsert_stmt = insert_stmt.on_conflict_do_update(
+        index_elements=[Image.base_filename],
+        set_=updates
+    )
+    with get_session(db_address=db_address) as session:
+        session.execute(upsert_stmt)
 
 
 def header_data_exists(db_address, base_filename):
@@ -169,7 +336,16 @@ def header_data_exists(db_address, base_filename):
     return header_exists
         
 
-def update_header_data(db_address: str, base_filename: str, data_type: str, header_data: dict):
+def get_header_updates(header_data: dict, data_type: str) -> dict:
+    """ Get the column values that are set from a fits header.
+
+    Args:
+        header_data (dict): parsed fits header. The whole header is saved in the jsonb header column.
+        data_type (str): data type of the file the header came from, eg. 'EX'.
+
+    Returns:
+        dict: column names and values, ready for upsert_image.
+    """
 
     if 'CRVAL1' in header_data:
         right_ascension = header_data['CRVAL1']
@@ -191,7 +367,7 @@ def update_header_data(db_address: str, base_filename: str, data_type: str, head
 
     # specific header values to add to update columns:
     updates = {
-        "header": header_data.get('JSON'),
+        "header": {key: val for key, val in header_data.items() if key != 'JSON'},
         "right_ascension": right_ascension,
         "declination": declination,
         "altitude": header_data.get('ALTITUDE'),
@@ -208,31 +384,24 @@ def update_header_data(db_address: str, base_filename: str, data_type: str, head
     capture_date = re.sub('T', ' ', header_data.get('DATE-OBS'))
     updates["capture_date"] = capture_date
     updates["sort_date"] = capture_date
+    return updates
 
-    with get_session(db_address=db_address) as session:
 
-        # Check if entry for this image already exists
-        row_exists = session.query(Image.image_id)\
-            .filter_by(base_filename=base_filename)\
-            .scalar() is not None
+def update_header_data(db_address: str, base_filename: str, data_type: str, header_data: dict):
+    updates = get_header_updates(header_data, data_type)
+    upsert_image(db_address, base_filename, updates)
 
-        # If an entry already exists, just update the new bits
-        if row_exists:
-            item = session.query(Image)\
-                .filter(Image.base_filename==base_filename)\
-                .update(updates)
 
-        # Create a new row if an entry doesn't exist yet.
-        else:
-            new_image = Image(
-                **updates,
-                base_filename=base_filename,
-                site=get_site_from_base_filename(base_filename)
-            )
-            session.add(new_image)
-            session.commit()
+def get_file_exists_column(reduction_level: str, filetype: str):
+    """ Get the name of the boolean column that records whether a file exists.
 
-def update_new_image(db_address:str, base_filename:str, data_type:str, reduction_level:str, filetype:str):
+    Args:
+        reduction_level (str): two digit reduction level from the filename, eg. '10'
+        filetype (str): file extension, eg. 'jpg' or 'fits'
+
+    Returns:
+        str: column name like 'jpg_medium_exists', or None if the file isn't tracked in the database.
+    """
 
     # Define the 'reduction_level' values that signify different image types
     medium_jpg_reduction_values = ["10", "13"]
@@ -249,7 +418,12 @@ def update_new_image(db_address:str, base_filename:str, data_type:str, reduction
         file_exists_column = "fits_01_exists"
     elif filetype == "fits" and reduction_level in fits_10_reduction_values:
         file_exists_column = "fits_10_exists"
-    
+    return file_exists_column
+
+
+def update_new_image(db_address:str, base_filename:str, data_type:str, reduction_level:str, filetype:str):
+
+    file_exists_column = get_file_exists_column(reduction_level, filetype)
     if file_exists_column is None:
         print(f"Unknown filetype added: {base_filename}, {data_type}, {reduction_level}, {filetype}")
         return
@@ -258,47 +432,111 @@ def update_new_image(db_address:str, base_filename:str, data_type:str, reduction
     updates[file_exists_column] = True
     updates["data_type"] = data_type
 
+    upsert_image(db_address, base_filename, updates)
 
-    with get_session(db_address=db_address) as session:
 
-        # Check if entry for this image already exists
-        row_exists = session.query(Image.image_id)\
-            .filter_by(base_filename=base_filename)\
-            .scalar() is not None
+# Matches json strings that hold a number, like headers saved before values were typed.
+NUMERIC_TEXT_PATTERN = r'^\s*[+-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eEdD][+-]?[0-9]+)?\s*$'
 
-        # If an entry already exists, just update the new bits
-        if row_exists:
-            item = session.query(Image)\
-                .filter(Image.base_filename==base_filename)\
-                .update(updates)
 
-        # Create a new row if an entry doesn't exist yet.
-        else:
-            new_image = Image(
-                base_filename=base_filename,
-                site=get_site_from_base_filename(base_filename),
-                **updates
-            )
-            session.add(new_image)
-            session.commit()
+def header_value_as_float(key):
+    """ SQL expression for a header value as a float, or NULL if the value isn't numeric. """
+    value = Image.header[key]
+    return case(
+        (func.jsonb_typeof(value) == 'number', value.astext.cast(Float)),
+        (
+            (func.jsonb_typeof(value) == 'string') & value.astext.op('~')(NUMERIC_TEXT_PATTERN),
+            func.translate(value.astext, 'dD', 'eE').cast(Float)
+        ),
+        else_=None
+    )
 
 
-def db_remove_base_filename(base_filename):
-    """ Remove an entire row represented by the data's base filename.
+def query_images_by_header(db_address: str, equals: dict = None, ranges: dict = None, site: str = None,
+                           limit: int = 100) -> list:
+    """ Find images by the contents of their fits header. All the filtering is done in the database.
 
     Args:
-        base_filename (str): identifies what to delete. 
-            Example: wmd-ea03-20190621-00000007
+        db_address (str): SQLAlchemy database url
+        equals (dict): header keys and the values they must have, eg. {'IMAGETYP': 'Light Frame', 'OBJECT': 'M31'}.
+            This is a jsonb containment (@>) query, which uses the GIN index on the header column. Numeric values
+            also match headers that hold them as strings (see header_equals_criteria).
+        ranges (dict): header keys and (min, max) bounds for numeric values, eg. {'FOCUS': (9000, 11000)}.
+            Bounds are inclusive; use None for an open bound.
+        site (str): only include images from this site.
+        limit (int): maximum number of images to return.
+
+    Returns:
+        list: image packages (see Image.get_image_pkg), most recent first.
     """
+    criteria = []
+    if site is not None:
+        criteria.append(Image.site == site)
+    if equals:
+        criteria.extend(header_equals_criteria(equals))
+    for key, (low, high) in (ranges or {}).items():
+        value = header_value_as_float(key)
+        if low is not None:
+            criteria.append(value >= low)
+        if high is not None:
+            criteria.append(value <= high)
+    return query_image_pkgs(db_address, *criteria, limit=limit)
+
+
+def header_equals_criteria(equals: dict) -> list:
+    """ SQL criteria for header keys that must have the given values.
+
+    Numbers also match legacy rows where the value was saved as a numeric string (eg. "EXPTIME": "30"), so each
+    numeric key gets its own criterion. Everything else goes in a single jsonb containment (@>) test.
+
+    Args:
+        equals (dict): header keys and the values they must have.
+
+    Returns:
+        list: SQL expressions that must all be true.
+    """
+    criteria = []
+    exact = {}
+    for key, value in equals.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            criteria.append(or_(Image.header.contains({key: value}), header_value_as_float(key) == value))
+        else:
+            exact[key] = value
+    if exact:
+        criteria.insert(0, Image.header.contains(exact))
+    return criteria
+
 
-    with get_session(db_address=DB_ADDRESS) as session:
+def db_remove_base_filenames(base_filenames) -> int:
+    """ Remove the rows of many images with a single DELETE statement.
 
-        # Identify the row to delete
-        row_to_delete = session.query(Image)\
-            .filter(Image.base_filename == base_filename)\
-            .first()
+    Base filenames without a row are ignored, so removing the same images twice is harmless.
 
-        # Delete and commit the change
-        session.delete(row_to_delete)
+    Args:
+        base_filenames (list): identify what to delete.
+            Example: ['wmd-ea03-20190621-00000007']
+
+    Returns:
+        int: the number of rows removed.
+    """
+    if not base_filenames:
+        return 0
+
+    # The names are sent as one array parameter: WHERE base_filename = ANY(%(names)s)
+    names = bindparam('names', list(base_filenames), type_=ARRAY(String))
+    with get_session(db_address=get_db_address()) as session:
+        removed = session.query(Image)\
+            .filter(Image.base_filename == any_(names))\
+            .delete(synchronize_session=False)
         session.commit()
+    return removed
+
+
+def db_remove_base_filename(base_filename):
+    """ Remove an entire row represented by the data's base filename.
 
+    Args:
+        base_filename (str): identifies what to delete. 
+            Example: wmd-ea03-20190621-00000007
+    """
+    return db_remove_base_filenames([base_filename])
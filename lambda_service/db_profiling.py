@@ -0,0 +1,144 @@
+""" Count and time the SQL statements sent to the database.
+
+Set DB_PROFILING_ENABLED=true to attach the listeners to every engine made by db.get_engine. Each invocation then
+logs how many statements it ran and how many connections it checked out of the pool, statement durations are added
+to the handler's metrics (as db_statement, see lambda_service.metrics), and any statement slower than
+DB_SLOW_QUERY_MS is logged with its parameters redacted.
+
+count_statements() works without the setting, for tests and benchmarks:
+
+    with count_statements(engine) as profile:
+        upsert_image(...)
+    assert profile.statements == 1
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from lambda_service.metrics import recorder as metrics_recorder
+
+logger = logging.getLogger(__name__)
+
+DB_PROFILING_ENABLED = os.getenv('DB_PROFILING_ENABLED', 'false').lower() == 'true'
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', 100))
+
+
+class QueryProfile:
+    """ Statement and connection checkout counts, and statement durations. Safe to share between threads. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.statements = 0
+            self.checkouts = 0
+            self.durations_ms = []
+
+    def add_statement(self, duration_ms):
+        with self._lock:
+            self.statements += 1
+            self.durations_ms.append(duration_ms)
+
+    def add_checkout(self):
+        with self._lock:
+            self.checkouts += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                'statements': self.statements,
+                'checkouts': self.checkouts,
+                'total_ms': round(sum(self.durations_ms), 3),
+                'max_ms': round(max(self.durations_ms), 3) if self.durations_ms else None,
+            }
+
+
+# The profile of the current invocation, filled by the listeners that DB_PROFILING_ENABLED attaches
+profile = QueryProfile()
+
+
+def redact_parameters(parameters):
+    """ Replace the values of statement parameters with their type names, so logs never hold the data itself.
+
+    Args:
+        parameters: the parameters of a statement: a dict, a sequence, or a list of either (for executemany).
+
+    Returns:
+        the parameters, with the same structure, and each value replaced by a string like '<str>'.
+    """
+    if isinstance(parameters, dict):
+        return {key: redact_parameters(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return type(parameters)(redact_parameters(value) for value in parameters)
+    return f"<{type(parameters).__name__}>"
+
+
+def attach_profiler(engine, query_profile=profile, slow_query_ms=DB_SLOW_QUERY_MS, record_metrics=True):
+    """ Listen to an engine's statements and connection checkouts, adding them to query_profile.
+
+    Returns:
+        list: (target, event name, listener) for each listener, to pass to detach_profiler.
+    """
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration_ms = (time.perf_counter() - conn.info['query_start_times'].pop()) * 1000
+        query_profile.add_statement(duration_ms)
+        if record_metrics:
+            metrics_recorder.record('db_statement', duration_ms)
+        if duration_ms >= slow_query_ms:
+            logger.warning(f"Slow query ({duration_ms:.1f} ms): {statement} "
+                           f"parameters: {redact_parameters(parameters)}")
+
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        query_profile.add_checkout()
+
+    listeners = [
+        (engine, 'before_cursor_execute', before_cursor_execute),
+        (engine, 'after_cursor_execute', after_cursor_execute),
+        (engine.pool, 'checkout', checkout),
+    ]
+    for target, name, listener in listeners:
+        event.listen(target, name, listener)
+    return listeners
+
+
+def detach_profiler(listeners):
+    for target, name, listener in listeners:
+        event.remove(target, name, listener)
+
+
+@contextmanager
+def count_statements(engine, slow_query_ms=DB_SLOW_QUERY_MS):
+    """ Profile the statements an engine runs inside the with block.
+
+    Yields:
+        QueryProfile: filled in as the block runs.
+    """
+    query_profile = QueryProfile()
+    listeners = attach_profiler(engine, query_profile, slow_query_ms=slow_query_ms, record_metrics=False)
+    try:
+        yield query_profile
+    finally:
+        detach_profiler(listeners)
+
+
+def flush_profile() -> dict:
+    """ Log the current invocation's statement counts and start a new profile. Does nothing unless enabled.
+
+    Returns:
+        dict: the summary that was logged, or None if profiling is off.
+    """
+    if not DB_PROFILING_ENABLED:
+        return None
+    summary = profile.summary()
+    profile.reset()
+    logger.info(f"Database profile: {summary}")
+    return summary
@@ -1,23 +1,34 @@
-import json
 import logging
 import time
 import os
+from functools import lru_cache
 
 import botocore
 import boto3
 from boto3.dynamodb.conditions import Attr
 
-from lambda_service.helpers import s3_remove_base_filename
-from lambda_service.helpers import get_data_type_from_filename
-from lambda_service.helpers import get_site_from_filename
-from lambda_service.helpers import get_base_filename_from_full_filename
-from lambda_service.helpers import get_site_from_base_filename
-from lambda_service.helpers import validate_filename
-from lambda_service.db import db_remove_base_filename
+from lambda_service.cache import TTLCache
+from lambda_service.helpers import s3_remove_base_filenames
+from lambda_service.filenames import FileKey
+from lambda_service.db import db_remove_base_filenames
+from lambda_service.metrics import timed, flush_metrics
+from lambda_service.db_profiling import flush_profile
+
+logger = logging.getLogger(__name__)
 
 EXPIRATION_TABLE_NAME = os.getenv('EXPIRATION_TABLE', 'data-expiration-tracker')
-dynamodb = boto3.resource('dynamodb', region_name=os.getenv('REGION'))
-expiration_table= dynamodb.Table(EXPIRATION_TABLE_NAME)
+
+# Base filenames this container has already added to the expiration table. Every file of an expiring exposure asks
+# for the same entry, so remembering them saves a (failing) conditional write per file.
+EXPIRATION_CACHE_TTL_S = int(os.getenv('EXPIRATION_CACHE_TTL_S', 3600))
+_registered_expirations = TTLCache(maxsize=10000, ttl_s=EXPIRATION_CACHE_TTL_S)
+
+
+@lru_cache(maxsize=None)
+def get_expiration_table():
+    """ The expiration dynamodb table, created the first time it's needed. """
+    dynamodb = boto3.resource('dynamodb', region_name=os.getenv('REGION'))
+    return dynamodb.Table(EXPIRATION_TABLE_NAME)
 
 
 def data_type_has_expiration(data_type: str) -> bool:
@@ -42,11 +53,9 @@ def get_image_lifespan(full_filename):
         int: number of seconds before the image can be removed. 
     """
 
-    if not validate_filename(full_filename):
-        raise ValueError('The provided full filename input did not pass validation.')
-
-    site = get_site_from_filename(full_filename)
-    data_type = get_data_type_from_filename(full_filename)
+    file_key = FileKey.parse(full_filename)  # raises an AssertionError if the filename is invalid
+    site = file_key.site
+    data_type = file_key.data_type
 
     # Images from the test site (tst) should use 5 minute expirations for quicker debugging
     if site == 'tst':
@@ -70,12 +79,20 @@ def add_expiration_entry(base_filename, time_to_live_s, s3_directory='data'):
     Does nothing if the entry already exists. Include a 7 day expiration 
     time, after which the entry is automatically removed. 
 
+    Entries added (or found to exist) by this container are remembered, so later files of the same exposure don't
+    write to the table at all. An entry is remembered for at most its time to live.
+
     Args: 
         base_filename(str): wmd-ea03-20190621-00000007
         time_to_live_s (int): number of seconds before dynamodb can begin the deletion process
         s3_directory (str): this is the 'folder' in s3 that contains the file(s). (data, info-images, allsky, ...)
 
+    Returns:
+        bool: True if the entry was written, False if it already existed.
     """
+    cache_key = (s3_directory, base_filename)
+    if cache_key in _registered_expirations:
+        return False
 
     entry = {
         'pk': base_filename,
@@ -83,8 +100,9 @@ def add_expiration_entry(base_filename, time_to_live_s, s3_directory='data'):
         'expiration_timestamp_s': int(time.time() + time_to_live_s)
     }
 
+    written = True
     try:
-        dynamodb_response = expiration_table.put_item(
+        get_expiration_table().put_item(
             Item=entry,
             ConditionExpression=Attr("pk").not_exists()
         )
@@ -93,31 +111,54 @@ def add_expiration_entry(base_filename, time_to_live_s, s3_directory='data'):
         # other exceptions.
         if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
             raise
+        written = False
 
+    _registered_expirations.set(cache_key, True, ttl_s=min(EXPIRATION_CACHE_TTL_S, time_to_live_s))
+    return written
 
-def remove_expired_data_handler(event, context):
-    print(event)
-    records_to_delete = event['Records']
-    for record in records_to_delete:
 
-        if record["eventName"] != "REMOVE": 
-            continue
+def get_expired_base_filenames(records) -> dict:
+    """ Group the base filenames removed from the expiration table by the s3 directory their files are in.
 
-        s3_directory = record["dynamodb"]["OldImage"]["s3_directory"]["S"]
-        print(s3_directory)
+    Args:
+        records (list): dynamodb stream records. Only REMOVE events are used.
 
-        if s3_directory == 'data':
-            base_filename = record["dynamodb"]["Keys"]["pk"]["S"]
-            s3_remove_base_filename(base_filename, s3_directory)
-            db_remove_base_filename(base_filename)
-
-        elif s3_directory == 'info-images':
-            base_filename = record["dynamodb"]["Keys"]["pk"]["S"]
-            s3_remove_base_filename(base_filename, s3_directory)
+    Returns:
+        dict: s3 directory: list of base filenames, without duplicates, in the order they were removed.
+    """
+    expired = {}
+    for record in records:
+        if record["eventName"] != "REMOVE":
+            continue
+        s3_directory = record["dynamodb"]["OldImage"]["s3_directory"]["S"]
+        base_filename = record["dynamodb"]["Keys"]["pk"]["S"]
+        expired.setdefault(s3_directory, {})[base_filename] = None
+    return {s3_directory: list(base_filenames) for s3_directory, base_filenames in expired.items()}
 
-        else:
-            print(f"unknown s3 directory: {s3_directory}. Not removing {base_filename}.") 
 
+def remove_expired_data_handler(event, context):
+    """ Remove the files (and database rows) of every expired exposure in a batch of stream records.
 
-        
-    
\ No newline at end of file
+    All the expired prefixes are listed together and deleted with a few delete_objects calls, and the database rows
+    are removed with one statement. Removal is idempotent, so if anything fails the whole batch can be retried.
+    """
+    expired = get_expired_base_filenames(event['Records'])
+    try:
+        for s3_directory, base_filenames in expired.items():
+            if s3_directory == 'data':
+                with timed('s3_delete', s3_directory=s3_directory):
+                    s3_remove_base_filenames(base_filenames, s3_directory)
+                with timed('db_delete', s3_directory=s3_directory):
+                    removed_rows = db_remove_base_filenames(base_filenames)
+                logger.info(f"Removed {len(base_filenames)} expired exposures ({removed_rows} database rows)")
+
+            elif s3_directory == 'info-images':
+                with timed('s3_delete', s3_directory=s3_directory):
+                    s3_remove_base_filenames(base_filenames, s3_directory)
+                logger.info(f"Removed {len(base_filenames)} expired info images")
+
+            else:
+                logger.warning(f"unknown s3 directory: {s3_directory}. Not removing {base_filenames}.")
+    finally:
+        flush_profile()
+        flush_metrics()
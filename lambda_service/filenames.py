@@ -0,0 +1,132 @@
+""" Parse the filenames of data files.
+
+Files uploaded to the data bucket are named like
+
+    wmd-ea03-20190621-00000007-EX00.fits.bz2
+
+which is {site}-{instrument}-{yyyymmdd}-{8 digit counter}-{data type}{2 digit reduction level}.{extension}, optionally
+followed by a compression extension. The first four sections make up the base filename, which is shared by all the
+files (header txt, jpgs, fits files) that belong to one exposure.
+"""
+import re
+from functools import lru_cache
+
+# site: 3-6 characters, instrument: anything, date: yyyymmdd, counter: 8 digits
+BASE_FILENAME_RE = re.compile(r'([^-]{3,6})-([^-]*)-([0-9]{8})-([0-9]{8})')
+
+# The base filename, then the data type (letters) and reduction level (two digits), then the extensions.
+FILENAME_RE = re.compile(BASE_FILENAME_RE.pattern + r'-([a-zA-Z]+)([0-9]{2})(?![0-9])[^-.]*\.([a-zA-Z]+)(?:\.([^-]*))?')
+
+
+class InvalidFilename(AssertionError):
+    """ Raised for a filename that doesn't follow the naming convention.
+
+    This is an AssertionError so that existing code catching failed filename validation keeps working.
+    """
+
+
+class FileKey:
+    """ The parts of a data filename, parsed once.
+
+    FileKeys are immutable. Use FileKey.parse to create one from a filename; parsed filenames are cached, so the
+    files of an exposure (which usually arrive together) are only parsed once per container.
+
+    Attributes:
+        site (str): Example: wmd
+        instrument (str): Example: ea03
+        file_date (str): yyyymmdd. Example: 20190621
+        file_counter (str): Example: 00000007
+        data_type (str): Example: EX
+        reduction_level (str): Example: 00
+        extension (str): the file type. Example: fits
+        compression (str): the compression extension, or None for uncompressed files. Example: bz2
+        base_filename (str): the first four sections. Example: wmd-ea03-20190621-00000007
+    """
+
+    __slots__ = (
+        'site', 'instrument', 'file_date', 'file_counter', 'data_type', 'reduction_level', 'extension',
+        'compression', 'base_filename',
+    )
+
+    def __init__(self, site, instrument, file_date, file_counter, data_type, reduction_level, extension,
+                 compression=None):
+        set_attribute = super().__setattr__
+        set_attribute('site', site)
+        set_attribute('instrument', instrument)
+        set_attribute('file_date', file_date)
+        set_attribute('file_counter', file_counter)
+        set_attribute('data_type', data_type)
+        set_attribute('reduction_level', reduction_level)
+        set_attribute('extension', extension)
+        set_attribute('compression', compression)
+        set_attribute('base_filename', f"{site}-{instrument}-{file_date}-{file_counter}")
+
+    @staticmethod
+    def parse(filename):
+        """ Parse a full filename (without any s3 directory prefix).
+
+        Args:
+            filename (str): Example: wmd-ea03-20190621-00000007-EX00.fits.bz2
+
+        Returns:
+            FileKey
+
+        Raises:
+            InvalidFilename: if the filename doesn't follow the naming convention.
+        """
+        return _parse_filename(filename)
+
+    @property
+    def filename(self):
+        """ The full filename. Example: wmd-ea03-20190621-00000007-EX00.fits.bz2 """
+        filename = f"{self.base_filename}-{self.data_type}{self.reduction_level}.{self.extension}"
+        if self.compression:
+            filename += f".{self.compression}"
+        return filename
+
+    def to_dict(self):
+        """ The parts of the filename as a dict, in the format returned by helpers.parse_file_key. """
+        return {
+            "base_filename": self.base_filename,
+            "file_extension": self.extension,
+            "site": self.site,
+            "instrument": self.instrument,
+            "file_date": self.file_date,
+            "file_counter": self.file_counter,
+            "data_type": self.data_type,
+            "reduction_level": self.reduction_level,
+        }
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def _key(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if not isinstance(other, FileKey):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return f"FileKey.parse({self.filename!r})"
+
+
+@lru_cache(maxsize=4096)
+def _parse_filename(filename):
+    match = FILENAME_RE.fullmatch(filename)
+    if match is None:
+        raise InvalidFilename(f"Invalid filename: {filename}")
+    return FileKey(*match.groups())
+
+
+@lru_cache(maxsize=4096)
+def is_valid_base_filename(base_filename):
+    """ Whether base_filename follows the naming convention. Example: wmd-ea03-20190621-00000007 """
+    return BASE_FILENAME_RE.fullmatch(base_filename) is not None
@@ -0,0 +1,216 @@
+""" Parse fits headers.
+
+A fits header is a sequence of 80 character cards. Cards with a value look like
+
+    KEYWORD = value / comment
+
+where the value is either a quoted string (with '' standing for a literal quote), a logical (T or F), an integer,
+a float, or blank (undefined). Long string values are split across CONTINUE cards, and COMMENT and HISTORY cards
+hold free text. The header ends with the END card.
+"""
+import math
+import re
+from functools import lru_cache
+
+FITS_CARD_LENGTH = 80
+
+COMMENTARY_KEYWORDS = ('COMMENT', 'HISTORY')
+
+INTEGER_RE = re.compile(r'[+-]?[0-9]+')
+FLOAT_RE = re.compile(r'[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[EeDd][+-]?[0-9]+)?')
+
+
+def parse_header(buffer) -> dict:
+    """ Parse the cards of a fits header into a dict, in a single pass over the buffer.
+
+    Values are typed following the fits rules: strings have their quotes removed, '' unescaped, and trailing
+    spaces stripped; T and F become bools; integers and floats (including D exponents) become int and float;
+    blank values become None. Anything else (like complex values) is kept as text. Long strings are joined from
+    their CONTINUE cards, and COMMENT and HISTORY cards are collected into lists of strings. Parsing stops at the
+    END card.
+
+    Args:
+        buffer (bytes): the header, as consecutive 80 character cards.
+
+    Returns:
+        dict: keyword: value for every card with a value, plus 'COMMENT' and 'HISTORY' lists if present.
+    """
+    # latin-1 maps each byte to one character, so card boundaries stay at multiples of 80.
+    text = bytes(buffer).decode('latin-1')
+    card_offsets = range(0, len(text), FITS_CARD_LENGTH)
+    return _parse_cards(text, card_offsets)
+
+
+def parse_headers(buffers) -> list:
+    """ Parse many fits headers at once.
+
+    The headers are joined into one array of cards, and numpy finds the distinct cards across all of them in one
+    vectorized pass. Headers from a site repeat most of their cards (SIMPLE, BITPIX, NAXISn, site and telescope
+    keywords, ...), so each distinct card is parsed only once, and the headers are then assembled from the parsed
+    cards. The results are the same as calling parse_header on each buffer.
+
+    Args:
+        buffers (list): fits headers, as bytes.
+
+    Returns:
+        list: one dict per header, in order, as returned by parse_header.
+    """
+    import numpy as np
+
+    if not buffers:
+        return []
+
+    # Pad each header to whole cards so the headers can share one array
+    padded = [bytes(buffer) + b' ' * (-len(buffer) % FITS_CARD_LENGTH) for buffer in buffers]
+    cards = np.frombuffer(b''.join(padded), dtype=f'V{FITS_CARD_LENGTH}')
+    unique_cards, card_ids = np.unique(cards, return_inverse=True)
+    card_ids = card_ids.ravel().tolist()
+
+    unique_text = unique_cards.tobytes().decode('latin-1')
+    parsed_cards = [
+        _parse_card(unique_text, offset)
+        for offset in range(0, len(unique_text), FITS_CARD_LENGTH)
+    ]
+
+    headers = []
+    first_card = 0
+    for buffer in padded:
+        last_card = first_card + len(buffer) // FITS_CARD_LENGTH
+        headers.append(_assemble_header(parsed_cards[i] for i in card_ids[first_card:last_card]))
+        first_card = last_card
+    return headers
+
+
+# Kinds of card, as returned by _parse_card
+VALUE_CARD, STRING_CARD, CONTINUE_CARD, COMMENTARY_CARD, END_CARD, OTHER_CARD = range(6)
+
+
+def _parse_cards(text, card_offsets) -> dict:
+    """ Parse the cards that start at each of card_offsets in text, stopping at the END card. """
+    return _assemble_header(_parse_card(text, offset) for offset in card_offsets)
+
+
+def _parse_card(text, offset):
+    """ Parse the card that starts at text[offset].
+
+    Returns:
+        tuple: (keyword, kind, value), where kind is one of the *_CARD constants.
+    """
+    keyword = text[offset:offset+8].rstrip()
+    card_end = offset + FITS_CARD_LENGTH
+
+    if keyword == 'END':
+        return keyword, END_CARD, None
+
+    if keyword == 'CONTINUE':
+        value, _ = _parse_string(text, text.find("'", offset + 8, card_end), offset)
+        return keyword, CONTINUE_CARD, value
+
+    if keyword in COMMENTARY_KEYWORDS:
+        return keyword, COMMENTARY_CARD, _to_str(text[offset+8:card_end].rstrip())
+
+    # Cards without the '= ' value indicator (including blank cards) have no value
+    if text[offset+8:offset+10] != '= ':
+        return keyword, OTHER_CARD, None
+
+    value_start = offset + 10
+    quote = text.find("'", value_start, card_end)
+    if quote != -1 and not text[value_start:quote].strip():
+        value, _ = _parse_string(text, quote, offset)
+        return keyword, STRING_CARD, value
+
+    comment = text.find('/', value_start, card_end)
+    return keyword, VALUE_CARD, convert_value(text[value_start:card_end if comment == -1 else comment].strip())
+
+
+def _assemble_header(parsed_cards) -> dict:
+    """ Build a header dict from parsed cards, joining CONTINUE strings and stopping at the END card. """
+    header = {}
+    continued_keyword = None  # keyword of a string value that ends with '&'
+
+    for keyword, kind, value in parsed_cards:
+        if kind == END_CARD:
+            break
+
+        if kind == CONTINUE_CARD:
+            if continued_keyword is not None:
+                header[continued_keyword] = header[continued_keyword][:-1] + value
+                if not value.endswith('&'):
+                    continued_keyword = None
+            continue
+        continued_keyword = None
+
+        if kind == COMMENTARY_CARD:
+            header.setdefault(keyword, []).append(value)
+        elif kind == STRING_CARD:
+            header[keyword] = value
+            if value.endswith('&'):
+                continued_keyword = keyword
+        elif kind == VALUE_CARD:
+            header[keyword] = value
+
+    return header
+
+
+@lru_cache(maxsize=4096)
+def convert_value(value_text):
+    """ Convert the text of a non-string fits value to a python value.
+
+    Args:
+        value_text (str): the value, with surrounding spaces and any comment removed.
+
+    Returns:
+        bool, int, float, or None for a blank value. Text that isn't a valid fits logical, integer or float
+        (like a complex value) is returned unchanged.
+    """
+    if not value_text:
+        return None
+    if value_text == 'T':
+        return True
+    if value_text == 'F':
+        return False
+    if INTEGER_RE.fullmatch(value_text):
+        return int(value_text)
+    if FLOAT_RE.fullmatch(value_text):
+        value = float(value_text.replace('D', 'E').replace('d', 'e'))
+        # Values like 1E999 overflow; keep them as text so the header stays valid JSON.
+        return value if math.isfinite(value) else value_text
+    return value_text
+
+
+def _parse_string(text, quote, card_offset):
+    """ Parse the quoted string that starts at text[quote], within the card starting at card_offset.
+
+    Returns:
+        tuple: the unescaped string (trailing spaces removed), and the index just past the closing quote.
+    """
+    card_end = card_offset + FITS_CARD_LENGTH
+    if quote == -1:
+        return '', card_end
+
+    pieces = []
+    start = quote + 1
+    while True:
+        close = text.find("'", start, card_end)
+        if close == -1:
+            # Unterminated string; take the rest of the card.
+            pieces.append(text[start:card_end])
+            end = card_end
+            break
+        pieces.append(text[start:close])
+        if text[close+1:close+2] == "'" and close + 1 < card_end:
+            # '' is an escaped quote
+            pieces.append("'")
+            start = close + 2
+            continue
+        end = close + 1
+        break
+
+    return _to_str(''.join(pieces).rstrip()), end
+
+
+def _to_str(value):
+    """ Convert a latin-1 decoded value to str, treating any non-ascii bytes as utf-8. """
+    if value.isascii():
+        return value
+    return value.encode('latin-1').decode('utf8', errors='replace')
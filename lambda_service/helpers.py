@@ -1,28 +1,100 @@
 import boto3
+import bz2
 import os
-import re
 import json
-import dateutil
 import datetime
-from astropy.io import fits
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from botocore.client import Config
 
+from lambda_service.cache import TTLCache
+from lambda_service.filenames import FileKey, is_valid_base_filename
+from lambda_service.parameter_store import get_parameter
+from lambda_service.fits_header import parse_header
+
 BUCKET_NAME = os.environ['BUCKET_NAME']
 REGION = os.environ['REGION']
 
-ssm_c = boto3.client('ssm', region_name=REGION)
-s3_c = boto3.client('s3', region_name=REGION)
+logger = logging.getLogger(__name__)
+
+# Fits files are made of 2880 byte blocks; headers are made of 80 character cards.
+FITS_BLOCK_SIZE = 2880
+FITS_CARD_LENGTH = 80
+FITS_HEADER_CHUNK_BYTES = 64 * 1024
+FITS_HEADER_MAX_BYTES = 2 * 1024 * 1024
+
+# Heights of the jpg renditions made from each medium jpg. The rendition with the thumbnail height is the EX11 jpg;
+# the others are saved under renditions/ (see get_s3_rendition_path).
+JPG_THUMBNAIL_HEIGHT_PX = int(os.getenv('JPG_THUMBNAIL_HEIGHT_PX', 128))
+JPG_RENDITION_HEIGHTS_PX = sorted({
+    int(height) for height in os.getenv('JPG_RENDITION_HEIGHTS_PX', str(JPG_THUMBNAIL_HEIGHT_PX)).split(',')
+    if height.strip()
+})
+
+# Presigned urls are valid for 7 days, and reused for at most one day so clients always get several days of validity.
+PRESIGNED_URL_TTL_S = 604800
+PRESIGNED_URL_MAX_REUSE_S = 86400
+_presigned_urls = TTLCache(maxsize=20000, ttl_s=PRESIGNED_URL_MAX_REUSE_S)
+
+# delete_objects accepts at most 1000 keys per call
+S3_DELETE_OBJECTS_MAX_KEYS = 1000
+S3_LIST_MAX_WORKERS = 8
+
+
+class RecordProcessingError(Exception):
+    """ Raised after a batch of s3 records is processed if any of the records failed.
+
+    The records attribute holds the key and status of every record in the batch.
+    """
+    def __init__(self, records):
+        self.records = records
+        failed_keys = [r["key"] for r in records if r["status"] == "failed"]
+        super().__init__(f"Failed to process {len(failed_keys)} of {len(records)} records: {failed_keys}")
+
+
+class S3DeleteError(Exception):
+    """ Raised when delete_objects could not remove some of the objects. The errors attribute holds s3's report. """
+    def __init__(self, errors):
+        self.errors = errors
+        super().__init__(f"Failed to remove {len(errors)} objects from s3: {errors[:10]}")
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    """ The s3 client, created the first time it's needed and reused for the life of the container. """
+    client = boto3.client('s3', region_name=REGION)
+    add_if_none_match_support(client)
+    return client
+
+
+def add_if_none_match_support(client):
+    """ Let put_object take IfNoneMatch='*', to only write an object that doesn't exist yet.
+
+    The botocore pinned in requirements.txt predates s3's conditional writes and would reject the parameter, so it's
+    taken out before the request is validated and sent as an If-None-Match header. A failed condition raises a
+    ClientError with the code 'PreconditionFailed'.
+    """
+    def take_if_none_match(params, context, **kwargs):
+        if 'IfNoneMatch' in params:
+            context['if_none_match'] = params.pop('IfNoneMatch')
+
+    def add_if_none_match_header(params, context, **kwargs):
+        if 'if_none_match' in context:
+            params['headers']['If-None-Match'] = context['if_none_match']
+
+    client.meta.events.register('before-parameter-build.s3.PutObject', take_if_none_match)
+    client.meta.events.register('before-call.s3.PutObject', add_if_none_match_header)
+
 
 def get_secret(key):
     """
     Some parameters are stored in AWS Systems Manager Parameter Store.
     This replaces the .env variables we used to use with flask.
+
+    Values are cached; see lambda_service.parameter_store.
     """
-    resp = ssm_c.get_parameter(
-    	Name=key,
-    	WithDecryption=True
-    )
-    return resp['Parameter']['Value']
+    return get_parameter(key)
 
 
 def get_s3_image_path(s3_directory, base_filename, data_type, reduction_level, file_type):
@@ -31,24 +103,72 @@ def get_s3_image_path(s3_directory, base_filename, data_type, reduction_level, f
     return path
 
 
-def get_s3_file_url(path, ttl=604800):
-    s3 = boto3.client('s3', REGION, config=Config(signature_version='s3v4'))
-    url = s3.generate_presigned_url(
-        ClientMethod="get_object",
-        Params={"Bucket": BUCKET_NAME, "Key": path},
-        ExpiresIn=ttl
-    )
-    return url
+def get_s3_rendition_path(base_filename, data_type, height_px, s3_directory='data'):
+    """ The key of a jpg rendition of an image's medium jpg.
+
+    The rendition with the thumbnail height is the small (EX11) jpg. Other heights are saved outside the data
+    directory, so they don't trigger the data handlers. Example: renditions/wmd-ea03-20190621-00000007-EX10-h256.jpg
+    """
+    if height_px == JPG_THUMBNAIL_HEIGHT_PX:
+        return get_s3_image_path(s3_directory, base_filename, data_type, "11", "jpg")
+    return f"renditions/{base_filename}-{data_type}10-h{height_px}.jpg"
+
+
+@lru_cache(maxsize=None)
+def get_signing_client():
+    """ s3 client used to presign urls. Created once per container. """
+    return boto3.client('s3', REGION, config=Config(signature_version='s3v4'))
+
+
+def get_s3_file_url(path, ttl=PRESIGNED_URL_TTL_S):
+    return get_s3_file_urls([path], ttl)[path]
+
+
+def get_s3_file_urls(paths, ttl=PRESIGNED_URL_TTL_S):
+    """ Presign download urls for many objects at once.
+
+    Urls are remembered and handed out again for up to a day (or a quarter of the ttl, for shorter ttls), so every
+    url returned is still valid for most of its ttl. Presigning is local computation, so a page of urls only costs
+    the signing of the ones that aren't cached yet.
+
+    Args:
+        paths (list): object keys in the data bucket.
+        ttl (int): number of seconds the urls are valid for.
+
+    Returns:
+        dict: path: url for every path.
+    """
+    reuse_s = min(PRESIGNED_URL_MAX_REUSE_S, ttl // 4)
+    urls = {}
+    for path in paths:
+        url = _presigned_urls.get((path, ttl))
+        if url is None:
+            url = get_signing_client().generate_presigned_url(
+                ClientMethod="get_object",
+                Params={"Bucket": BUCKET_NAME, "Key": path},
+                ExpiresIn=ttl
+            )
+            _presigned_urls.set((path, ttl), url, ttl_s=reuse_s)
+        urls[path] = url
+    return urls
 
 
 def read_s3_body(bucket_name, object_name):
-    s3_object = s3_c.get_object(Bucket=bucket_name, Key=object_name)
+    s3_object = get_s3_client().get_object(Bucket=bucket_name, Key=object_name)
     body = s3_object['Body']
     return body.read()
 
     
 def isodate_to_timestamp(isodate):
-    parsed_t = dateutil.parser.parse(isodate)
+    """ Convert an iso 8601 date, like the eventTime of an s3 record (2020-09-24T17:40:17.597Z), to a timestamp.
+
+    The common formats are parsed with the standard library; dateutil is only imported for anything else.
+    """
+    try:
+        parsed_t = datetime.datetime.fromisoformat(isodate.replace('Z', '+00:00'))
+    except ValueError:
+        import dateutil.parser
+        parsed_t = dateutil.parser.parse(isodate)
     t_in_seconds = parsed_t.timestamp()
     return t_in_seconds
 
@@ -73,44 +193,18 @@ def scan_header_file(bucket, path) -> dict:
         note - this file is assumed to be formatted as a fits header.
     :return: dictionary representation the fits header txt file.
     """
-    data_entry = {}
-    fits_line_length = 80
-
     contents = read_s3_body(bucket, path)
-    
-    for i in range(0, len(contents), fits_line_length):
-        single_header_line = contents[i:i+fits_line_length].decode('utf8')
-
-
-        # Split header lines according to the FITS header format
-        values = re.split('=|/|',single_header_line)
-        
-        # Get the attribute and value for each line in the header.
-        try:
-
-            # The first 8 characters contains the attribute.
-            attribute = single_header_line[:8].strip()
-            # The rest of the characters contain the value 
-            # (and sometimes a comment).
-            after_attr = single_header_line[10:-1]
-
-            # If the value (and not in a comment) is a string, then 
-            # we want the contents inside the single-quotes.
-            if "'" in after_attr.split('/')[0]:
-                value = after_attr.split("'")[1].strip()
-            
-            # Otherwise, get the string preceding a comment 
-            # (comments start with '/')
-            else: 
-                value = after_attr.split("/")[0].strip()
-
-            # Add the attribute/value to a dict
-            data_entry[attribute] = value
-
-            if attribute == 'END': break
-        
-        except Exception as e:
-            print(f"Error with parsing fits header: {e}")
+    return parse_header_bytes(contents)
+
+
+def parse_header_bytes(contents) -> dict:
+    """
+    Create a python dict from the bytes of a fits header.
+
+    :param contents: bytes of a fits header, as a sequence of 80 character cards.
+    :return: dictionary representation of the fits header, including its 'JSON' representation.
+    """
+    data_entry = parse_header(contents)
 
     # Add the JSON representation of the data_entry to itself as the 
     # header attribute
@@ -118,104 +212,132 @@ def scan_header_file(bucket, path) -> dict:
     return data_entry
 
 
-def get_header_from_fits(bucket, key):
-    file_url = s3_c.generate_presigned_url('get_object', Params={"Bucket": bucket, "Key": key})
-    fits_file = fits.open(file_url)
-    header = dict(fits_file[0].header)
-    header['JSON'] = json.dumps(header)
-    return header
+def find_fits_header_end(contents, start=0):
+    """ Find the end of the primary header in the bytes at the start of a fits file.
 
+    Args:
+        contents (bytes): the first bytes of a fits file.
+        start (int): offset of the first card to check. Must be a multiple of the card length.
 
+    Returns:
+        int: the offset just past the END card, or None if the END card isn't in contents yet.
+    """
+    for i in range(start, len(contents) - FITS_CARD_LENGTH + 1, FITS_CARD_LENGTH):
+        if contents[i:i+8] == b'END     ':
+            return i + FITS_CARD_LENGTH
+    return None
 
-def parse_file_key(file_key):
-    filename_no_extension, filename_extension = file_key.split('.', 1)  # only split on the first dot.
-    filename_extension = filename_extension.split('.')[0]
-    site, instrument, file_date, file_counter, data_type_level = filename_no_extension.split('-')
 
-    #data_type = data_type_level[0:2]
-    #reduction_level = data_type_level[2:4]
-    data_type = get_data_type_from_filename(file_key)
-    reduction_level = get_reduction_level_from_filename(file_key)
+def read_fits_header_bytes(bucket, key, chunk_size=FITS_HEADER_CHUNK_BYTES):
+    """ Read the primary header of a fits file in s3 without downloading the whole file.
 
-    base_filename = '-'.join([site, instrument, file_date, file_counter])
-    return {
-        "base_filename": base_filename,
-        "file_extension": filename_extension,
-        "site": site,
-        "instrument": instrument,
-        "file_date": file_date,
-        "file_counter": file_counter,
-        "data_type": data_type,
-        "reduction_level": reduction_level
-    }
+    The object is fetched with ranged GETs, starting with chunk_size bytes and doubling the range for each
+    request (bz2 can only emit output once it has a whole compressed block, which can be several hundred kB).
+    bz2 compressed files are decompressed incrementally, with the output of each step capped at chunk_size bytes,
+    so memory use stays constant. Reading stops as soon as the END card of the primary header is found.
 
+    Args:
+        bucket (str): name of the s3 bucket
+        key (str): key of a .fits or .fits.bz2 object
+        chunk_size (int): number of bytes in the first ranged request
 
-# TODO: It would be useful to refactor all filename helpers into a separate module. That would also provide a place
-# for better filename documentation. 
-# Would the filename be well suited for a simple class? Easy to get any single piece or str representation. 
+    Returns:
+        bytes: the header cards, up to and including the END card.
+    """
+    decompressor = bz2.BZ2Decompressor() if key.endswith('.bz2') else None
+    header = bytearray()
+    checked = 0  # offset of the first card that hasn't been checked for END yet
+    start = 0
+    object_size = None
+    range_size = chunk_size
+
+    while object_size is None or start < object_size:
+        response = get_s3_client().get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{start + range_size - 1}")
+        range_size = min(2 * range_size, FITS_HEADER_MAX_BYTES)
+        chunk = response['Body'].read()
+        # ContentRange looks like 'bytes 0-65535/4128768'
+        object_size = int(response['ContentRange'].split('/')[-1])
+        start += len(chunk)
+        if not chunk:
+            break
+
+        if decompressor is None:
+            pieces = [chunk]
+        else:
+            pieces = [decompressor.decompress(chunk, max_length=chunk_size)]
+            while not decompressor.eof and not decompressor.needs_input:
+                pieces.append(decompressor.decompress(b'', max_length=chunk_size))
+
+        for piece in pieces:
+            header += piece
+            end = find_fits_header_end(header, checked)
+            if end is not None:
+                return bytes(header[:end])
+            checked = len(header) - len(header) % FITS_CARD_LENGTH
+            if len(header) > FITS_HEADER_MAX_BYTES:
+                raise ValueError(f"No END card in the first {FITS_HEADER_MAX_BYTES} bytes of {key}")
+
+        if decompressor is not None and decompressor.eof:
+            break
+
+    raise ValueError(f"Could not find the end of the fits header in {key}")
+
+
+def get_header_sidecar_key(key):
+    """ Get the key of the header text file that belongs with a fits file.
+
+    Sidecars are saved outside the data directory, like the jpg renditions, so they don't trigger the data handlers
+    or replace a header file uploaded by the site.
+    Example: data/wmd-ea03-20190621-00000007-EX10.fits.bz2 -> headers/wmd-ea03-20190621-00000007-EX10.txt
+    """
+    filename = key.rsplit('/', 1)[-1]
+    return f"headers/{filename.split('.', 1)[0]}.txt"
 
 
-# Example base filename: wmd-ea03-20190621-00000007
-def validate_base_filename(filename):
+def get_header_from_fits(bucket, key, write_sidecar=True):
+    """ Get the header of a fits file in s3, reading only the start of the file.
 
-    parts = filename.split('-')
+    Args:
+        bucket (str): name of the s3 bucket
+        key (str): key of a .fits or .fits.bz2 object
+        write_sidecar (bool): if True, save the header as a .txt file (see get_header_sidecar_key), so later
+            readers don't need the fits file.
 
-    # check that the base filename has four sections separated by '-'
-    assert len(parts) == 4
+    Returns:
+        dict: the parsed header, as returned by scan_header_file.
+    """
+    header_bytes = read_fits_header_bytes(bucket, key)
+    if write_sidecar:
+        # Pad to a full fits block, like the header files uploaded by sites
+        padding = -len(header_bytes) % FITS_BLOCK_SIZE
+        get_s3_client().put_object(
+            Bucket=bucket,
+            Key=get_header_sidecar_key(key),
+            Body=header_bytes + b' ' * padding,
+            ContentType='text/plain'
+        )
+    return parse_header_bytes(header_bytes)
 
-    # check that the file starts with 3-letter site code 
-    # like 'wmd'
-    site = parts[0] 
-    assert len(site) >= 3 and len(site) <=6
 
-    # check for date formatted as yyymmdd
-    # like '20190621'
-    date = parts[2]  
-    assert len(date) == 8 and date.isdigit()
 
-    # check for 8-digit image number
-    # like '00000007'
-    incr = parts[3]  
-    assert len(incr) == 8 and incr.isdigit()
+def parse_file_key(file_key):
+    """ Get the parts of a full filename as a dict. See filenames.FileKey for the parts.
 
-    # If no exceptions are raised, the base filename is valid
-    return True
+    Raises:
+        AssertionError: if the filename is invalid.
+    """
+    return FileKey.parse(file_key).to_dict()
 
 
+# Example base filename: wmd-ea03-20190621-00000007
+def validate_base_filename(filename):
+    assert is_valid_base_filename(filename), f"Invalid base filename: {filename}"
+    return True
+
 
 # Example filename: wmd-ea03-20190621-00000007-EX00.fits.bz2
 def validate_filename(filename):
-
-    parts = filename.split('-')
-
-    base_filename = '-'.join(parts[:4])
-    print(base_filename)
-    assert validate_base_filename(base_filename)
-
-    extensions = parts[4]   
-    extension_parts = extensions.split('.')
-
-
-    # This expression gets the first string of alpha chars and the next group of numeric chars.
-    obstype_reduction_level_re = re.compile("([a-zA-Z]+)([0-9]+)")
-    observation_type, reduction_level = obstype_reduction_level_re.match(extension_parts[0]).groups()
-
-    # check for the data type (usually ex (exposure), sometimes ep (experiemental))
-    # example value: 'EX'
-    #data_type = extension_parts[0][0:2] 
-    assert observation_type and observation_type.isalpha()
-
-    # check for the reduction_level, which directly follows the data_type.
-    # example value: '01'
-    #reduction_level = extension_parts[0][2:4]
-    assert len(reduction_level) == 2 and reduction_level.isdigit()
-
-    # check for a file extension that is letters only 
-    # like 'txt', 'fits', or 'jpg'
-    file_extension = extension_parts[1]
-    assert file_extension.isalpha()
-
-    # If none of the assert statements raise an exception, then the filename is valid
+    FileKey.parse(filename)  # raises an AssertionError (InvalidFilename) if the filename is invalid
     return True
 
 
@@ -225,28 +347,17 @@ def get_base_filename_from_full_filename(full_filename):
     Example full filename: tst-aa00-20201231-12345678-EX01.fits.bz2
     Corresponding base filename: tst-aa00-20201231-12345678
     """
-    assert validate_filename(full_filename)
-    return '-'.join(full_filename.split('-')[:4])
+    return FileKey.parse(full_filename).base_filename
 
 def get_data_type_from_filename(full_filename):
-    assert validate_filename(full_filename) 
-    #return full_filename.split('-')[4].split('.')[0][0:2]
-    obstype_reductionlevel = full_filename.split('-')[4].split('.')[0]
-    obstype_regex = re.compile("([a-zA-Z]+)([0-9]+)")
-    observation_type, _ = obstype_regex.match(obstype_reductionlevel).groups()
-    return observation_type
+    return FileKey.parse(full_filename).data_type
 
 def get_reduction_level_from_filename(full_filename):
-    assert validate_filename(full_filename)
-    obstype_reductionlevel = full_filename.split('-')[4].split('.')[0]
-    obstype_regex = re.compile("([a-zA-Z]+)([0-9]+)")
-    _, reduction_level = obstype_regex.match(obstype_reductionlevel).groups()
-    return reduction_level
+    return FileKey.parse(full_filename).reduction_level
 
 
 def get_site_from_filename(full_filename):
-    assert validate_filename(full_filename)
-    return full_filename.split('-')[0]
+    return FileKey.parse(full_filename).site
 
 
 def get_site_from_base_filename(base_filename):
@@ -254,29 +365,99 @@ def get_site_from_base_filename(base_filename):
     return base_filename.split('-')[0]
 
 
-def s3_remove_base_filename(base_filename, s3_directory='data'):
-    """ Remove data matching the base_filename from s3.
+def get_s3_prefixes_for_base_filename(base_filename, s3_directory='data') -> list:
+    """ The s3 prefixes that hold every file of an exposure.
 
-    This typically includes the header .txt, jpgs, large and small .fits. 
+    This typically includes the header .txt, jpgs, large and small .fits, and for the data directory, the jpg
+    renditions and header sidecars. Prefixes end with the dash that follows the base filename, so they can't match another exposure.
 
-    Args: 
-        base_filename(str): specifies the files to delete from s3. 
-            Example: wmd-ea03-20190621-00000007
-        s3_directory (str): this is the s3 'folder' the file is stored in. 
-    """
+    Args:
+        base_filename (str): Example: wmd-ea03-20190621-00000007
+        s3_directory (str): this is the s3 'folder' the files are stored in.
 
-    # first ensure that the base filename is in a valid format. 
+    Returns:
+        list: Example: ['data/wmd-ea03-20190621-00000007-', 'renditions/wmd-ea03-20190621-00000007-',
+            'headers/wmd-ea03-20190621-00000007-']
+    """
+    # first ensure that the base filename is in a valid format.
     # otherwise, bad filenames might match with data that shouldn't be deleted.
-    if validate_base_filename(base_filename): 
+    validate_base_filename(base_filename)
+    prefixes = [f"{s3_directory}/{base_filename}-"]
+    if s3_directory == 'data':
+        prefixes.append(f"renditions/{base_filename}-")
+        prefixes.append(f"headers/{base_filename}-")
+    return prefixes
+
+
+def list_s3_keys(prefix, bucket=BUCKET_NAME) -> list:
+    """ The keys of every object in the bucket that starts with prefix. """
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    return [
+        obj['Key']
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+        for obj in page.get('Contents', [])
+    ]
+
+
+def s3_remove_prefixes(prefixes, bucket=BUCKET_NAME) -> int:
+    """ Remove every object under any of the prefixes from s3.
 
-        prefix_to_delete = f"{s3_directory}/{base_filename}"
-        print("prefix to delete: ")
-        print(prefix_to_delete)
+    The prefixes are listed in parallel, then the objects are removed with as few delete_objects calls as possible
+    (each removes up to 1000 keys).
 
-        # delete everything in the s3 bucket with the given prefix
-        s3 = boto3.resource('s3')
-        bucket = s3.Bucket(BUCKET_NAME)
-        response = bucket.objects.filter(Prefix=f"{s3_directory}/{base_filename}").delete()
-        print("delete response: ")
-        print(response)
+    Args:
+        prefixes (list): Example: ['data/wmd-ea03-20190621-00000007-']
+        bucket (str): the s3 bucket to delete from.
 
+    Returns:
+        int: the number of objects removed.
+
+    Raises:
+        S3DeleteError: if any of the objects could not be removed. The rest are still removed.
+    """
+    with ThreadPoolExecutor(max_workers=S3_LIST_MAX_WORKERS) as executor:
+        keys = [key for keys in executor.map(lambda p: list_s3_keys(p, bucket), prefixes) for key in keys]
+
+    errors = []
+    for i in range(0, len(keys), S3_DELETE_OBJECTS_MAX_KEYS):
+        response = get_s3_client().delete_objects(
+            Bucket=bucket,
+            Delete={
+                'Objects': [{'Key': key} for key in keys[i:i + S3_DELETE_OBJECTS_MAX_KEYS]],
+                'Quiet': True,  # only report the keys that failed
+            },
+        )
+        errors.extend(response.get('Errors', []))
+
+    if errors:
+        raise S3DeleteError(errors)
+    logger.info(f"Removed {len(keys)} objects under {len(prefixes)} prefixes")
+    return len(keys)
+
+
+def s3_remove_base_filenames(base_filenames, s3_directory='data') -> int:
+    """ Remove the files of many exposures from s3. See s3_remove_prefixes.
+
+    Args:
+        base_filenames (list): Example: ['wmd-ea03-20190621-00000007']
+        s3_directory (str): this is the s3 'folder' the files are stored in.
+
+    Returns:
+        int: the number of objects removed.
+    """
+    prefixes = [
+        prefix for base_filename in base_filenames
+        for prefix in get_s3_prefixes_for_base_filename(base_filename, s3_directory)
+    ]
+    return s3_remove_prefixes(prefixes)
+
+
+def s3_remove_base_filename(base_filename, s3_directory='data'):
+    """ Remove data matching the base_filename from s3.
+
+    Args:
+        base_filename(str): specifies the files to delete from s3.
+            Example: wmd-ea03-20190621-00000007
+        s3_directory (str): this is the s3 'folder' the file is stored in.
+    """
+    return s3_remove_base_filenames([base_filename], s3_directory)
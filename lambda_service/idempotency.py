@@ -0,0 +1,168 @@
+""" Recognize s3 notifications that have already been processed.
+
+s3 delivers each notification at least once, so the same object-created record can arrive twice. Each record is
+identified by its bucket, key, version (or ETag) and sequencer, and claimed with a conditional write to the
+idempotency table before any work is done for it:
+
+    if not claim(record_id):
+        skip the record (it was processed, or is being processed by another invocation)
+    ... process the record ...
+    complete([record_id])   or, if it failed, release(record_id) so a retry can claim it again
+
+A claim only lasts a lease until it's completed, so a record whose invocation timed out (without releasing it) can be
+processed by a later retry. The lease must outlast the invocation that claimed it, so a redelivery can't start on a
+record while that invocation might still be writing. Records from the ingest queue are claimed for IDEMPOTENCY_LEASE_S
+(the ingest function's timeout plus the queue's visibility timeout, plus a margin), and records from the direct s3
+trigger for the shorter IDEMPOTENCY_S3_LEASE_S (the ingest function's timeout plus a margin), which lapses before
+lambda's second async retry. A record claimed by an invocation that hasn't finished raises RecordInProgress, and is
+retried later rather than skipped. Completed records are remembered for IDEMPOTENCY_TTL_S seconds, and in memory for
+warm invocations of the same container.
+
+The table is an optimization: if it can't be reached, records are processed as if they were new.
+"""
+import logging
+import os
+import time
+from functools import lru_cache
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+from lambda_service.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_TABLE_NAME = os.getenv('IDEMPOTENCY_TABLE', 'ptrdata-processed-events')
+IDEMPOTENCY_ENABLED = os.getenv('IDEMPOTENCY_ENABLED', 'true').lower() == 'true'
+
+# The longest an ingest invocation can run, and how long an SQS message stays hidden after it's received (see
+# serverless.yml)
+INGEST_TIMEOUT_S = int(os.getenv('INGEST_TIMEOUT_S', 60))
+INGEST_QUEUE_VISIBILITY_TIMEOUT_S = int(os.getenv('INGEST_QUEUE_VISIBILITY_TIMEOUT_S', 360))
+IDEMPOTENCY_LEASE_MARGIN_S = 60
+
+# How long a completed record is recognized, and how long a claim lasts before it's completed: on the SQS path, and
+# on the direct s3 path
+IDEMPOTENCY_TTL_S = int(os.getenv('IDEMPOTENCY_TTL_S', 86400))
+IDEMPOTENCY_LEASE_S = int(os.getenv(
+    'IDEMPOTENCY_LEASE_S', INGEST_TIMEOUT_S + INGEST_QUEUE_VISIBILITY_TIMEOUT_S + IDEMPOTENCY_LEASE_MARGIN_S
+))
+IDEMPOTENCY_S3_LEASE_S = int(os.getenv('IDEMPOTENCY_S3_LEASE_S', INGEST_TIMEOUT_S + IDEMPOTENCY_LEASE_MARGIN_S))
+
+_completed = TTLCache(maxsize=10000, ttl_s=IDEMPOTENCY_TTL_S)
+
+
+class RecordInProgress(Exception):
+    """ Raised by claim when another invocation holds an unexpired claim on a record it hasn't completed. """
+
+
+@lru_cache(maxsize=None)
+def get_idempotency_table():
+    """ The idempotency dynamodb table, created the first time it's needed. """
+    dynamodb = boto3.resource('dynamodb', region_name=os.getenv('REGION'))
+    return dynamodb.Table(IDEMPOTENCY_TABLE_NAME)
+
+
+def get_record_id(record) -> str:
+    """ Identify an object-created record from an s3 notification.
+
+    A redelivered record has the same id. A new upload to the same key has a different ETag (or version) and
+    sequencer, so it is processed again.
+
+    Returns:
+        str: {bucket}/{key}#{version or ETag}#{sequencer}.
+            Example: photonranch-001/data/wmd-ea03-20190621-00000007-EX10.jpg#268182655972e76f...#0055AED6DCD90281E5
+    """
+    s3_object = record['s3']['object']
+    version = s3_object.get('versionId') or s3_object.get('eTag', '')
+    return f"{record['s3']['bucket']['name']}/{s3_object['key']}#{version}#{s3_object.get('sequencer', '')}"
+
+
+def claim(record_id, lease_s=None) -> bool:
+    """ Claim a record for processing.
+
+    Args:
+        record_id (str): see get_record_id.
+        lease_s (int): how long the claim lasts if it isn't completed. Defaults to IDEMPOTENCY_LEASE_S.
+
+    Returns:
+        bool: True if the record should be processed, False if it has already been processed.
+
+    Raises:
+        RecordInProgress: if another invocation holds an unexpired claim on the record, and hasn't completed it. The
+            record should be retried once the claim has lapsed.
+    """
+    if not IDEMPOTENCY_ENABLED:
+        return True
+    if record_id in _completed:
+        return False
+
+    if lease_s is None:
+        lease_s = IDEMPOTENCY_LEASE_S
+    now = int(time.time())
+    try:
+        get_idempotency_table().put_item(
+            Item={
+                'pk': record_id,
+                'status': 'claimed',
+                'claimed_until': now + lease_s,
+                'expiration_timestamp': now + IDEMPOTENCY_TTL_S,
+            },
+            ConditionExpression="attribute_not_exists(pk) OR claimed_until < :now",
+            ExpressionAttributeValues={':now': now},
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return not _check_completed(record_id)
+        logger.exception(f"Could not claim {record_id}; processing it anyway")
+    except BotoCoreError:
+        logger.exception(f"Could not claim {record_id}; processing it anyway")
+    return True
+
+
+def _check_completed(record_id) -> bool:
+    """ Confirm that a record another invocation claimed has been completed. Raises RecordInProgress if not. """
+    try:
+        item = get_idempotency_table().get_item(Key={'pk': record_id}, ConsistentRead=True).get('Item')
+    except (BotoCoreError, ClientError):
+        logger.exception(f"Could not read the claim on {record_id}")
+        raise RecordInProgress(record_id)
+    # A missing item was released since the put; let the retry claim it. Entries without a status are completed.
+    if item is None or item.get('status') == 'claimed':
+        raise RecordInProgress(record_id)
+    _completed.set(record_id, True)
+    return True
+
+
+def complete(record_ids):
+    """ Mark claimed records as processed, so later deliveries are skipped until the entries expire. """
+    if not IDEMPOTENCY_ENABLED or not record_ids:
+        return
+
+    now = int(time.time())
+    try:
+        # Completed entries hold their claim until they expire. Plain puts can be batched.
+        with get_idempotency_table().batch_writer(overwrite_by_pkeys=['pk']) as batch:
+            for record_id in record_ids:
+                batch.put_item(Item={
+                    'pk': record_id,
+                    'status': 'completed',
+                    'claimed_until': now + IDEMPOTENCY_TTL_S,
+                    'expiration_timestamp': now + IDEMPOTENCY_TTL_S,
+                })
+    except (BotoCoreError, ClientError):
+        # The claims will lapse, and a redelivery would be processed again.
+        logger.exception(f"Could not mark {len(record_ids)} records as processed")
+    for record_id in record_ids:
+        _completed.set(record_id, True)
+
+
+def release(record_id):
+    """ Give up the claim on a record that failed, so a retry can process it straight away. """
+    if not IDEMPOTENCY_ENABLED:
+        return
+    try:
+        get_idempotency_table().delete_item(Key={'pk': record_id})
+    except (BotoCoreError, ClientError):
+        # The claim lapses after its lease anyway
+        logger.exception(f"Could not release {record_id}")
@@ -1,126 +1,149 @@
 import urllib.parse
 import boto3 
+import json
 import logging
 import os
 import time
 from botocore.exceptions import ClientError
+from decimal import Decimal
+from functools import lru_cache
 
-from lambda_service.helpers import validate_filename, parse_file_key
+from lambda_service.cache import TTLCache
+from lambda_service.filenames import FileKey
 from lambda_service.helpers import scan_header_file
+from lambda_service.helpers import RecordProcessingError
 
-from lambda_service.datastreamer import send_to_datastream
+from lambda_service.datastreamer import send_to_datastream, flush_datastream
+from lambda_service.metrics import timed, flush_metrics
+
+@lru_cache(maxsize=None)
+def get_info_table():
+    """ The info-images dynamodb table, created the first time it's needed. """
+    dynamodb = boto3.resource("dynamodb", region_name=os.getenv('REGION'))
+    return dynamodb.Table(os.getenv('INFO_IMAGES_TABLE'))
+
+
+def __getattr__(name):
+    # info_table is created on first access rather than at import
+    if name == 'info_table':
+        return get_info_table()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-dynamodb = boto3.resource("dynamodb", region_name=os.getenv('REGION'))
-info_table = dynamodb.Table(os.getenv('INFO_IMAGES_TABLE'))
 info_images_ttl_s = int(os.getenv('INFO_IMAGES_TTL_HOURS')) * 3600
 
+# Site metadata (which base filename is in each channel) is reused for a short time, and indexed by base filename
+SITE_METADATA_TTL_S = int(os.getenv('SITE_METADATA_TTL_S', 30))
+_site_metadata = TTLCache(maxsize=1000, ttl_s=SITE_METADATA_TTL_S)
+_info_channels = TTLCache(maxsize=10000, ttl_s=SITE_METADATA_TTL_S)  # (site, base_filename): channel number
+
+# A channel is written with a conditional update or put; retry if another invocation changes it in between
+INFO_IMAGE_WRITE_ATTEMPTS = 3
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 def handle_info_image_created(event, context): 
-    logger.info("event: ", event)
+    """ Update the info-images table for every new object in an s3 notification.
+
+    Returns:
+        dict: 'records' holds the key and status ('ok', 'skipped' or 'failed') of each record in the event.
+        If any record failed, RecordProcessingError is raised instead, after the rest of the batch is processed.
+    """
+    logger.info(f"event: {event}")
+
+    results = []
+    info_images = {}  # base_filename: list of (result, file_path, file_parts)
+
+    for record in event['Records']:
+        key = record['s3']['object']['key']
+        result = {"key": key, "status": "ok"}
+        results.append(result)
+
+        # Sample file_path is like: data/wmd-ea03-20190621-00000007-EX00.fits.bz2
+        file_path = urllib.parse.unquote_plus(key, encoding='utf-8')
+
+        # assume base filename is {site}-{instrument}-{yyyymmdd}-[12345678].{jpg|fits.bz2}
+        file_key = file_path.split('/', 1)[-1]
+        # Extract the various pieces of information from the filename
+        try:
+            file_parts = FileKey.parse(file_key)
+        except AssertionError:
+            logger.exception(f"Invalid filename {file_key}; failed to update database")
+            result["status"] = "skipped"
+            continue
+
+        logger.info(f"Parsed filename: {file_parts}")
+        info_images.setdefault(file_parts.base_filename, []).append((result, file_path, file_parts))
 
-    # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    
-    # Sample file_path is like: data/wmd-ea03-20190621-00000007-EX00.fits.bz2
-    file_path = urllib.parse.unquote_plus(
-            event['Records'][0]['s3']['object']['key'], 
-            encoding='utf-8'
-        )
-
-    # assume base filename is {site}-{instrument}-{yyyymmdd}-[12345678].{jpg|fits.bz2}
-    file_key = file_path.split('/', 1)[-1]
     try:
-        validate_filename(file_key)
-    except AssertionError:
-        logger.exception(f"Invalid filename {file_key}; failed to update database")
-        return
-    
-    # Extract the various pieces of information from the filename
-    file_parts = parse_file_key(file_key)
-    base_filename = file_parts["base_filename"]
-    file_extension = file_parts["file_extension"]
-    site = file_parts["site"]
-    instrument = file_parts["instrument"]
-    file_date = file_parts["file_date"]
-    file_counter = file_parts["file_counter"]
-    data_type = file_parts["data_type"]
-    reduction_level = file_parts["reduction_level"]
-
-    logger.info(f"Parsed filename: {file_parts}")
-
-    # Query dynamodb to find out which channel this image is intended for
-    site_metadata = get_site_metadata(site)
-    channel_number = get_info_channel(base_filename, site_metadata)
+        for base_filename, new_files in info_images.items():
+            try:
+                process_info_image(base_filename, [(path, parts) for _, path, parts in new_files])
+            except Exception:
+                logger.exception(f"Failed to update info image {base_filename}")
+                for result, _, _ in new_files:
+                    result["status"] = "failed"
+    finally:
+        flush_datastream()
+        flush_metrics()
+
+    if any(r["status"] == "failed" for r in results):
+        raise RecordProcessingError(results)
+    return {"records": results}
+
+
+def process_info_image(base_filename, new_files):
+    """ Save all the new files for one info image in its channel, then notify subscribers.
+
+    Args:
+        base_filename (str): the info image the files belong to. Example: wmd-ea03-20190621-00000007
+        new_files (list): (file_path, FileKey) tuples for the new files that share this base filename.
+    """
+
+    site = new_files[0][1].site
+    data_type = new_files[-1][1].data_type
+    file_date = new_files[-1][1].file_date
+
+    # Find out which channel this image is intended for (from the cached site metadata when possible)
+    dimensions = {"site": site, "data_type": data_type}
+    with timed('channel_lookup', **dimensions):
+        channel_number = find_info_channel(site, base_filename)
     if channel_number is None:
-        logger.exception(f"Could not find channel number for {base_filename} in {site_metadata}")
+        logger.error(f"Could not find channel number for {base_filename} in the {site} site metadata")
         return 
     logger.info(f"Channel number for {base_filename} is {channel_number}")
     info_image_pk = f"{site}#{channel_number}"
 
-    # Delete the existing record if uses an older (different) base_filename
-    try:
-        delete_response = info_table.delete_item(
-            Key={
-                'pk': info_image_pk,
-            },
-            ConditionExpression="base_filename <> :bf",  # <> is the not-equal comparator
-            ExpressionAttributeValues={
-                ':bf': base_filename
-            },
-            ReturnValues="ALL_OLD"
-        )
-    except ClientError as e:  
-        # the delete did not happen because the condition check failed
-        if e.response['Error']['Code'] == "ConditionalCheckFailedException":
-            print(e.response['Error']['Message'])
-        else:  # undexpected error
-            raise 
-
-    # Compute the type of file-existence key to update the database with
-    # eg. we might set "fits_01_exits" = True. 
-    # TODO: maybe make this a list of files that exist, and update photonranch-api or ptr_ui to use that instead.
-    file_exists_key = ''
-    if file_extension == "jpg" and reduction_level == "10":
-        file_exists_key = "jpg_medium_exists"
-    elif file_extension == "jpg" and reduction_level == "11":
-        file_exists_key = "jpg_small_exists"
-    elif file_extension == "fits":
-        file_exists_key = f"fits_{reduction_level}_exists"
-    else:
-        file_exists_key = f"other_{file_extension}_{reduction_level}_exists"
-
     # define dynamodb entry expiration time (timestamp, seconds)
     expiration_timestamp = int(time.time()) + info_images_ttl_s # 2 days from the present
-    
-    # Update the info-images table with the new data
-    # This will create a new record if one does not currently exist. 
-    update_response = info_table.update_item(
-        Key={ 'pk': info_image_pk },
-        UpdateExpression=f"set \
-            base_filename=:bf, \
-            expiration_timestamp=:et, \
-            data_type=:dt, \
-            file_date=:fd, \
-            {file_extension}_{reduction_level}_file_path=:filepath, \
-            {file_exists_key}=:fileexists",
-        ExpressionAttributeValues={
-            ':bf': base_filename,
-            ':et': expiration_timestamp,
-            ':dt': data_type,
-            ':fd': file_date,
-            ':filepath': file_path,
-            ':fileexists': True,
-        },
-        ReturnValues="ALL_OLD"
-    )
-    print(update_response)
-
-    if file_extension == "txt":
-        header = scan_header_file(os.getenv('BUCKET_NAME'), file_path)
-        header.pop('JSON')  # this key is not used for info images, we can remove it. 
-        update_info_image_header(info_image_pk, header)
+
+    attributes = {
+        "base_filename": base_filename,
+        "expiration_timestamp": expiration_timestamp,
+        "data_type": data_type,
+        "file_date": file_date,
+    }
+
+    # A redelivered file appears twice in the batch; the attributes it sets are the same both times.
+    for file_path, file_parts in new_files:
+        file_extension = file_parts.extension
+        reduction_level = file_parts.reduction_level
+        attributes[f"{file_extension}_{reduction_level}_file_path"] = file_path
+        attributes[get_file_exists_key(file_extension, reduction_level)] = True
+
+    # The header is saved in the same write as the rest of the image
+    for file_path, file_parts in new_files:
+        if file_parts.extension == "txt":
+            with timed('header', **dimensions):
+                header = scan_header_file(os.getenv('BUCKET_NAME'), file_path)
+            header.pop('JSON')  # this key is not used for info images, we can remove it. 
+            # dynamodb doesn't accept floats, so typed header values are stored as Decimals
+            attributes["header"] = json.loads(json.dumps(header), parse_float=Decimal)
+
+    with timed('db_write', **dimensions):
+        saved = save_info_image(info_image_pk, attributes)
+    if not saved:
+        return
 
     # After we update the database, notify subscribers.
     try:
@@ -132,32 +155,134 @@ def handle_info_image_created(event, context):
             "site": site,
             "channel": channel_number,
         }
-        send_to_datastream(site, websocket_payload)
+        with timed('notify', **dimensions):
+            send_to_datastream(site, websocket_payload)
 
     except Exception as e:
         logger.exception(f'failed to send to subscribers: {str(e)}')
 
 
-def update_info_image_header(info_image_pk, header):
-    update_response = info_table.update_item(
-        Key={ 'pk': info_image_pk }, 
-        UpdateExpression="set header=:h",
-        ExpressionAttributeValues={':h': header},
-        ReturnValues="ALL_OLD"
-    )
-    print('saved header to database')
+def get_file_exists_key(file_extension, reduction_level):
+    """ Compute the type of file-existence key to update the database with.
+
+    eg. we might set "fits_01_exits" = True. 
+    TODO: maybe make this a list of files that exist, and update photonranch-api or ptr_ui to use that instead.
+    """
+    if file_extension == "jpg" and reduction_level == "10":
+        return "jpg_medium_exists"
+    elif file_extension == "jpg" and reduction_level == "11":
+        return "jpg_small_exists"
+    elif file_extension == "fits":
+        return f"fits_{reduction_level}_exists"
+    else:
+        return f"other_{file_extension}_{reduction_level}_exists"
+
+
+def save_info_image(info_image_pk, attributes) -> bool:
+    """ Save an info image's attributes in its channel, replacing any older image in the channel.
+
+    This is usually a single conditional write. If the channel already holds the same image (same base filename),
+    the attributes are added to it; otherwise the whole item is replaced, so nothing from the previous image is left
+    behind. If another invocation writes the channel in between, the write is retried.
 
+    The channel may come from cached site metadata, so before replacing an image the metadata is read again to
+    confirm the channel is still meant for this one. A late file of an image the site has since moved out of the
+    channel is not saved.
+
+    Args:
+        info_image_pk (str): the channel's item. Example: wmd#2
+        attributes (dict): attribute name: value. Must include the base_filename.
+
+    Returns:
+        bool: False if the channel now belongs to another image, and nothing was saved.
+    """
+    site, channel_number = info_image_pk.rsplit('#', 1)
+    names = {f"#a{i}": name for i, name in enumerate(attributes)}
+    values = {f":v{i}": value for i, value in enumerate(attributes.values())}
+    names["#bf"] = "base_filename"
+    values[":bf"] = attributes["base_filename"]
 
-def get_site_metadata(site):
+    for _ in range(INFO_IMAGE_WRITE_ATTEMPTS):
+        try:
+            get_info_table().update_item(
+                Key={'pk': info_image_pk},
+                UpdateExpression="set " + ", ".join(f"#a{i}=:v{i}" for i in range(len(attributes))),
+                ConditionExpression="#bf = :bf",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != "ConditionalCheckFailedException":
+                raise
+
+        # The channel is empty or holds another image
+        site_metadata = get_site_metadata(site, refresh=True)
+        if get_info_channel(attributes["base_filename"], site_metadata) != int(channel_number):
+            logger.info(f"{attributes['base_filename']} is no longer assigned to {info_image_pk}; not saving it")
+            return False
+        try:
+            get_info_table().put_item(
+                Item={'pk': info_image_pk, **attributes},
+                ConditionExpression="attribute_not_exists(pk) OR #bf <> :bf",  # <> is the not-equal comparator
+                ExpressionAttributeNames={"#bf": "base_filename"},
+                ExpressionAttributeValues={":bf": attributes["base_filename"]},
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != "ConditionalCheckFailedException":
+                raise
+    raise RuntimeError(f"Could not save {attributes['base_filename']} in {info_image_pk}: the channel kept changing")
+
+
+def get_site_metadata(site, refresh=False):
     """ Get the item in the info-images table with pk {site}#metadata. 
     This object is used to check what channel is intended for a given image. 
+
+    Items are cached for SITE_METADATA_TTL_S seconds, and the channels they list are added to the channel index
+    used by find_info_channel.
+
+    Args:
+        site (str): Example: wmd
+        refresh (bool): ignore any cached item and read the table.
+
+    Returns:
+        dict: the site metadata, or None if the site has none.
     """
+    if not refresh:
+        site_metadata = _site_metadata.get(site)
+        if site_metadata is not None:
+            return site_metadata
+
     try: 
-        response = info_table.get_item(Key={'pk': f'{site}#metadata'})
+        response = get_info_table().get_item(Key={'pk': f'{site}#metadata'})
     except ClientError as e:
-        print(e.response(['Error']['Message']))
-    else:
-        return response['Item']
+        logger.error(e.response['Error']['Message'])
+        raise
+
+    site_metadata = response.get('Item')
+    if site_metadata is not None:
+        _site_metadata.set(site, site_metadata)
+        for key, value in site_metadata.items():
+            if 'channel' in key and len(key) == 8:  # same 'channelX' format as get_info_channel
+                _info_channels.set((site, value), int(key.split('channel')[1]))
+    return site_metadata
+
+
+def find_info_channel(site, base_filename):
+    """ The channel an info image belongs in, or None if the site metadata doesn't list it.
+
+    Uses the index built from cached site metadata. On a miss, the site metadata is read again, since sites assign
+    the channel just before uploading the image.
+    """
+    channel_number = _info_channels.get((site, base_filename))
+    if channel_number is not None:
+        return channel_number
+
+    site_metadata = get_site_metadata(site, refresh=True)
+    if site_metadata is None:
+        return None
+    return get_info_channel(base_filename, site_metadata)
 
     
 def get_info_channel(base_filename, site_metadata):
@@ -174,6 +299,8 @@ def get_info_channel(base_filename, site_metadata):
             It will probably contain a key 'channel{n}' with a value matching the provided base_filename. 
 
     """
+    if site_metadata is None:
+        return None
     for key, val in site_metadata.items():
         if val == base_filename:
             # get the number from the key; ie. '2' from 'channel2'.        
@@ -1,121 +1,375 @@
 import urllib.parse
-import boto3
+import json
 import os
 
-from lambda_service.db import update_header_data, update_new_image, header_data_exists
-from lambda_service.db import DB_ADDRESS
+from botocore.exceptions import BotoCoreError, ClientError
 
-from lambda_service.helpers import validate_filename, parse_file_key
+from lambda_service.db import upsert_image, update_header_data, header_data_exists
+from lambda_service.db import get_header_updates, get_file_exists_column
+from lambda_service.db import get_db_address
+
+from lambda_service.filenames import FileKey
+from lambda_service import idempotency
 from lambda_service.helpers import scan_header_file, get_header_from_fits
 from lambda_service.helpers import isodate_to_timestamp
+from lambda_service.helpers import get_s3_rendition_path, JPG_RENDITION_HEIGHTS_PX
+from lambda_service.helpers import RecordProcessingError
 from lambda_service.expirations import add_expiration_entry
 from lambda_service.expirations import data_type_has_expiration
 from lambda_service.expirations import get_image_lifespan
-from lambda_service.thumbnails import resize_handler
-from lambda_service.datastreamer import send_to_datastream
-from lambda_service.s3_log import log_new_upload
+from lambda_service.thumbnails import rendition_handler
+from lambda_service.previews import preview_handler, preview_enabled
+from lambda_service.datastreamer import send_to_datastream, flush_datastream
+from lambda_service.s3_log import log_new_upload, flush_uploads_log
+from lambda_service.stages import StageExecutor
+from lambda_service.metrics import timed, flush_metrics
+from lambda_service.db_profiling import flush_profile
 
 import logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-dynamodb = boto3.resource("dynamodb", region_name=os.getenv('REGION'))
-s3_c = boto3.client('s3', region_name=os.getenv('REGION'))
-
 info_image_lifetime_hours = os.getenv('INFO_IMAGE_TTL_HOURS', 48)
 info_image_lifetime_s = info_image_lifetime_hours * 3600
-jpg_thumbnail_height_px = int(os.getenv('JPG_THUMBNAIL_HEIGHT_PX', 128))
+
 
 def handle_s3_object_created(event, context):
+    """ Update the database for every new object in an s3 notification.
+
+    Returns:
+        dict: 'records' holds the key and status ('ok', 'skipped' or 'failed') of each record in the event.
+        If any record failed, RecordProcessingError is raised instead, after the rest of the batch is processed, so
+        that lambda retries the event.
+    """
+
+    logger.info(f"event: {event}")
+
+    try:
+        results = process_s3_records(event['Records'], lease_s=idempotency.IDEMPOTENCY_S3_LEASE_S)
+    finally:
+        flush_buffers()
+        flush_profile()
+        flush_metrics()
+    if any(r["status"] == "failed" for r in results):
+        raise RecordProcessingError(results)
+    return {"records": results}
+
+
+def handle_sqs_batch(event, context):
+    """ Alternate entry point that reads s3 notifications from an SQS queue.
+
+    The queue's event source mapping collects messages into micro-batches (up to a maximum batch size or batching
+    window), so the files of one exposure usually arrive in the same invocation and are merged into a single
+    database write by process_s3_records. The direct s3 trigger (handle_s3_object_created) is still the default.
+
+    Returns:
+        dict: SQS partial batch response. Only messages with a failed record are returned to the queue.
+    """
+
+    logger.info(f"event: {event}")
+
+    s3_records = []
+    message_ids = []  # the SQS message each s3 record came from
+    failed_message_ids = []
+    for message in event['Records']:
+        try:
+            notification = json.loads(message['body'])
+        except ValueError:
+            logger.exception(f"Could not parse message {message['messageId']}")
+            failed_message_ids.append(message['messageId'])
+            continue
+
+        # s3 sends a test event when the notification is first configured
+        if notification.get('Event') == 's3:TestEvent':
+            continue
+
+        for s3_record in notification.get('Records', []):
+            s3_records.append(s3_record)
+            message_ids.append(message['messageId'])
+
+    try:
+        results = process_s3_records(s3_records)
+    finally:
+        flush_buffers()
+        flush_profile()
+        flush_metrics()
+    for message_id, result in zip(message_ids, results):
+        if result["status"] == "failed" and message_id not in failed_message_ids:
+            failed_message_ids.append(message_id)
+
+    return {"batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed_message_ids]}
+
+
+def parse_s3_record(record):
+    """ Extract the details of a new object from one record in an s3 notification.
+
+    The filename is parsed once, into the 'file_parts' FileKey.
+
+    Raises:
+        AssertionError: if the object does not have a valid filename.
+    """
 
-    logger.info("event: ", event)
-    
     # Get the object from the event and show its content type
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    
+    bucket = record['s3']['bucket']['name']
+
     # Sample file_path is like: data/wmd-ea03-20190621-00000007-EX00.fits.bz2
-    file_path = urllib.parse.unquote_plus(
-            event['Records'][0]['s3']['object']['key'], 
-            encoding='utf-8'
-        )
-
-    # Do the logging routine for new files that arrive in s3
-    event_time = isodate_to_timestamp(event['Records'][0]['eventTime'])
-    object_size = event['Records'][0]['s3']['object']['size']
-    log_new_upload(file_path, event_time, object_size)
-    
-    # Format amazon upload timestamp (yyyy-mm-ddThh:mm:ss.mmmZ) 
-    # to psql timestamp without timezone (yyyy-mm-dd hh:mm:ss).
-    last_modified = list(urllib.parse.unquote_plus(
-            event['Records'][0]['eventTime']))
-    last_modified[10] = ' '
-    last_modified = last_modified[:-5]
-    last_modified = "".join(last_modified)
-    
-    # The file_key is the full filename that looks something like 
+    file_path = urllib.parse.unquote_plus(record['s3']['object']['key'], encoding='utf-8')
+
+    # The file_key is the full filename that looks something like
     # 'wmd-ea03-20190621-00000007-EX00.fits.bz2'
     file_key = file_path.split('/')[-1]
 
+    return {
+        "bucket": bucket,
+        "file_path": file_path,
+        "file_key": file_key,
+        "file_parts": FileKey.parse(file_key),
+        "event_time": record['eventTime'],
+        "size": record['s3']['object']['size'],
+        "etag": record['s3']['object'].get('eTag'),
+    }
+
+
+def process_s3_records(records, lease_s=None):
+    """ Process a list of s3 object-created records.
+
+    Records are grouped by exposure (base filename), and the files of each exposure are merged into one set of
+    database writes. Records that were already processed (s3 can deliver a notification more than once) are skipped
+    before any work is done for them; see lambda_service.idempotency.
+
+    Args:
+        records (list): the 'Records' from one or more s3 notifications.
+        lease_s (int): how long each record's idempotency claim lasts, if it isn't completed. Defaults to the lease for
+            the SQS path (see lambda_service.idempotency).
+
+    Returns:
+        list: one dict per record, in order, with the object 'key' and a 'status' of 'ok', 'skipped' or 'failed'.
+    """
+
+    results = []
+    exposures = {}  # base_filename: list of (result, new file)
+    claimed = []  # (result, record id) for every record claimed in the idempotency table
+
+    for record in records:
+        key = record['s3']['object']['key']
+        result = {"key": key, "status": "ok"}
+        results.append(result)
+
+        try:
+            with timed('parse') as timer:
+                new_file = parse_s3_record(record)
+                timer.set_dimensions(**get_metric_dimensions(new_file["file_parts"], extension=True))
+        except AssertionError:
+            logger.exception(f"Invalid filename {key}; failed to update database")
+            result["status"] = "skipped"
+            continue
+
+        logger.info(f"Parsed filename: {new_file['file_parts']}")
+
+        record_id = idempotency.get_record_id(record)
+        try:
+            if not idempotency.claim(record_id, lease_s=lease_s):
+                logger.info(f"Skipping {key}: this notification was already processed")
+                result["status"] = "skipped"
+                continue
+        except idempotency.RecordInProgress:
+            # Failed, so the record is retried after the other invocation's claim lapses (not dropped)
+            logger.warning(f"{key} is claimed by an invocation that hasn't finished; retrying later")
+            result["status"] = "failed"
+            continue
+        claimed.append((result, record_id))
+
+        try:
+            # Do the logging routine for new files that arrive in s3. The log is written (and timed) by flush_buffers.
+            event_time = isodate_to_timestamp(new_file["event_time"])
+            log_new_upload(new_file["file_path"], event_time, new_file["size"])
+        except Exception:
+            logger.exception(f"Failed to process {key}")
+            result["status"] = "failed"
+            continue
+
+        base_filename = new_file["file_parts"].base_filename
+        exposures.setdefault(base_filename, []).append((result, new_file))
+
+    for base_filename, exposure in exposures.items():
+        exposure_results = [result for result, _ in exposure]
+        new_files = [new_file for _, new_file in exposure]
+        try:
+            process_exposure(base_filename, new_files)
+        except Exception:
+            logger.exception(f"Failed to update {base_filename}")
+            for result in exposure_results:
+                result["status"] = "failed"
+
+    # Failed records are released so that the retry can process them
+    idempotency.complete([record_id for result, record_id in claimed if result["status"] == "ok"])
+    for result, record_id in claimed:
+        if result["status"] == "failed":
+            idempotency.release(record_id)
+
+    return results
+
+
+def add_exposure_expiration(new_files):
+    """ Set the TTL for an exposure that should expire, using the first of its files with an expiring data type.
+
+    The expiration table has one entry per exposure, so it's written once per exposure in a batch (and once per
+    container, see add_expiration_entry), not once per file.
+    """
+    for new_file in new_files:
+        if data_type_has_expiration(new_file["file_parts"].data_type):
+            time_until_expiration = get_image_lifespan(new_file["file_key"])
+            add_expiration_entry(new_file["file_parts"].base_filename, time_until_expiration)
+            return
+
+
+def process_exposure(base_filename, new_files):
+    """ Update the database with all the new files from one exposure, then notify subscribers.
+
+    Args:
+        base_filename (str): the exposure the files belong to. Example: wmd-ea03-20190621-00000007
+        new_files (list): new files (from parse_s3_record) that share this base filename, in the order they
+            arrived.
+
+    Raises:
+        StageError: if the expiration entry, the header download or the database update failed. A header that
+            downloads but is unusable is logged, and the file flags are saved without it.
+    """
+
+    # Files are processed in order, so the data_type of the latest file wins
+    data_type = new_files[-1]["file_parts"].data_type
+    site = new_files[-1]["file_parts"].site
+
+    updates = {}
+    header_file = None
+    fits_files = []
+    medium_jpg_files = []
+    for new_file in new_files:
+        file_extension = new_file["file_parts"].extension
+        reduction_level = new_file["file_parts"].reduction_level
+
+        # If the new file is the header file (in txt format)
+        if file_extension == 'txt':
+            header_file = new_file
+
+        # If the new file is an image (jpg or fits)
+        elif file_extension in ['jpg', 'fits']:
+            file_exists_column = get_file_exists_column(reduction_level, file_extension)
+            if file_exists_column is None:
+                print(f"Unknown filetype added: {new_file['file_key']}")
+            else:
+                updates[file_exists_column] = True
+
+            if file_extension == 'fits':
+                fits_files.append(new_file)
+            elif reduction_level == "10":
+                medium_jpg_files.append(new_file)
+
+        # Unknown file extension:
+        else:
+            logger.warning(f"Unrecognized file extension {file_extension}. Skipping file.")
+
+    # The s3 and dynamodb requests below don't depend on each other, so they run at the same time. The database is
+    # written once the header and renditions are ready, and subscribers are only notified after that.
+    dimensions = get_metric_dimensions(new_files[-1]["file_parts"])
+    stages = StageExecutor()
+    stages.add('expiration', timed('expiration', **dimensions)(add_exposure_expiration), new_files)
+    if header_file is not None:
+        stages.add('header', timed('header', **dimensions)(read_header_updates), header_file)
+    stages.add('renditions', timed('thumbnail', **dimensions)(make_exposure_renditions), base_filename,
+               medium_jpg_files)
+
+    # Render the jpgs from the fits data for sites that don't upload them
+    if fits_files and not medium_jpg_files and preview_enabled(fits_files[0]["file_parts"].site):
+        stages.add('preview', timed('preview', **dimensions)(make_exposure_preview), base_filename, fits_files)
+
+    def update_database():
+        # Add the header values and renditions to the same database write as the file flags
+        header_updates = stages.result('header') if header_file is not None else None
+        if header_updates is not None:
+            updates.update(header_updates)
+        if stages.result('renditions'):
+            updates["jpg_renditions"] = JPG_RENDITION_HEIGHTS_PX
+
+        if updates:
+            updates["data_type"] = data_type
+            with timed('db_write', **dimensions):
+                upsert_image(get_db_address(), base_filename, updates)
+
+        # Fallback on the fits file for the header data if the header has not yet been supplied (or was unusable)
+        if fits_files and header_updates is None:
+            with timed('header_fallback', **dimensions):
+                if not header_data_exists(get_db_address(), base_filename):
+                    fits_file = fits_files[0]
+                    header_data = get_header_from_fits(fits_file["bucket"], fits_file["file_path"])
+                    update_header_data(get_db_address(), base_filename, fits_file["file_parts"].data_type,
+                                       header_data)
+
+    stages.add('database', update_database, after=[name for name in ('header', 'renditions') if name in stages])
+    stages.add('notify', timed('notify', **dimensions)(notify_subscribers), site, base_filename, after=['database'])
+    stages.run()
+
+
+def read_header_updates(header_file):
+    """ Read an exposure's header file, and get the column values it sets.
+
+    A header that can't be parsed, or is missing required keys, is logged and left out, so the rest of the exposure
+    (the file flags) is still saved; retrying wouldn't fix it. s3 errors are raised, so the event is retried.
+
+    Returns:
+        dict: column names and values (see db.get_header_updates), or None if the header is unusable.
+    """
     try:
-        validate_filename(file_key)
-    except AssertionError:
-        logger.exception(f"Invalid filename {file_key}; failed to update database")
-        return
-    
-    # Extract the various pieces of information from the filename
-    file_parts = parse_file_key(file_key)
-    base_filename = file_parts["base_filename"]
-    file_extension = file_parts["file_extension"]
-    site = file_parts["site"]
-    instrument = file_parts["instrument"]
-    file_date = file_parts["file_date"]
-    file_counter = file_parts["file_counter"]
-    data_type = file_parts["data_type"]
-    reduction_level = file_parts["reduction_level"]
-
-    logger.info(f"Parsed filename: {file_parts}")
-
-    # Set the TTL for images that should expire
-    if data_type_has_expiration(data_type):
-        time_until_expiration = get_image_lifespan(file_key)
-        add_expiration_entry(base_filename, time_until_expiration)
-
-    # If the new file is the header file (in txt format)
-    if file_extension == 'txt':
-        # Parse the header txt file
-        header_data = scan_header_file(bucket, file_path)
-        # Update the database
-        update_header_data(DB_ADDRESS, base_filename, data_type, header_data)
-
-    # If the new file is an image (jpg or fits)
-    #elif file_extension in ['jpg', 'fits']:
-    elif file_extension == 'fits':
-        update_new_image(DB_ADDRESS, base_filename, data_type, reduction_level, file_extension)
-
-        # Fallback on the fits file for the header data if the header has not yet been supplied
-        if not header_data_exists(DB_ADDRESS, base_filename):
-            header_data = get_header_from_fits(bucket, file_path)
-            update_header_data(DB_ADDRESS, base_filename, data_type, header_data)
-
-    elif file_extension == 'jpg':
-        update_new_image(DB_ADDRESS, base_filename, data_type, reduction_level, file_extension)
-
-        # generate thumbnail from the larger jpg
-        if reduction_level == "10":
-            thumbnail_key = f"{file_path.split('/')[0]}/{site}-{instrument}-{file_date}-{file_counter}-{data_type}11.jpg"
-            thumbnail_height = jpg_thumbnail_height_px  # height in pixels for the rescaling output
-            try:
-                resize_handler(bucket, file_path, thumbnail_key, thumbnail_height)
-            except Exception as e:
-                logger.exception(e)
-                pass  
-
-
-    # Unknown file extension:
-    else: 
-        logger.warn(f"Unrecognized file extension {file_extension}. Skipping file.")
-
-    # After we update the database, notify subscribers.
+        header_data = scan_header_file(header_file["bucket"], header_file["file_path"])
+        return get_header_updates(header_data, header_file["file_parts"].data_type)
+    except (BotoCoreError, ClientError):
+        raise
+    except Exception:
+        logger.exception(f"Could not read the header {header_file['file_path']}; saving the exposure without it")
+        return None
+
+
+def get_metric_dimensions(file_parts, extension=False) -> dict:
+    """ The dimensions that stage timings are reported with (see lambda_service.metrics). """
+    dimensions = {"site": file_parts.site, "data_type": file_parts.data_type}
+    if extension:
+        dimensions["extension"] = file_parts.extension
+    return dimensions
+
+
+def make_exposure_renditions(base_filename, medium_jpg_files) -> bool:
+    """ Generate the thumbnail and other renditions from the medium jpg.
+
+    Returns:
+        bool: True if the renditions were made (or were already up to date).
+    """
+    made = False
+    for jpg_file in medium_jpg_files:
+        s3_directory = jpg_file["file_path"].split('/')[0]
+        rendition_keys = {
+            height: get_s3_rendition_path(base_filename, jpg_file["file_parts"].data_type, height, s3_directory)
+            for height in JPG_RENDITION_HEIGHTS_PX
+        }
+        try:
+            rendition_handler(jpg_file["bucket"], jpg_file["file_path"], rendition_keys, source_etag=jpg_file["etag"])
+            made = True
+        except Exception as e:
+            logger.exception(e)
+    return made
+
+
+def make_exposure_preview(base_filename, fits_files):
+    """ Render the medium jpg and renditions from the fits data. Uses the small fits file when possible. """
+    fits_file = next((f for f in fits_files if f["file_parts"].reduction_level == "10"), fits_files[0])
+    try:
+        preview_handler(fits_file["bucket"], fits_file["file_path"], base_filename,
+                        fits_file["file_parts"].data_type, fits_file["file_path"].split('/')[0])
+    except Exception as e:
+        logger.exception(e)
+
+
+def notify_subscribers(site, base_filename):
+    """ Tell subscribers about the updated exposure. The message is sent when the handler flushes the datastream. """
     try:
         logger.info('sending to subscribers: ')
         websocket_payload = {
@@ -127,3 +381,11 @@ def handle_s3_object_created(event, context):
 
     except Exception as e:
         logger.exception(f'failed to send to subscribers: {str(e)}')
+
+
+def flush_buffers():
+    """ Send the datastream messages and write the uploads log entries queued by this invocation, in parallel. """
+    stages = StageExecutor()
+    stages.add('datastream', flush_datastream)
+    stages.add('uploads_log', timed('uploads_log')(flush_uploads_log))
+    stages.run()
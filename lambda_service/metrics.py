@@ -0,0 +1,193 @@
+""" Time the stages of the handlers, and report the timings as CloudWatch metrics.
+
+Wrap a stage with timed(), as a context manager or a decorator:
+
+    with timed('db_write', site='wmd', data_type='EX'):
+        upsert_image(...)
+
+    @timed('s3_delete')
+    def remove_files(...):
+
+Timings are collected in memory and written when the handler calls flush_metrics(), in the CloudWatch embedded
+metric format. CloudWatch turns these log lines into metrics (in the METRICS_NAMESPACE namespace) without any api
+calls, so percentiles of each stage can be graphed per site. Usually that's a single json line per invocation; see
+MetricsRecorder.flush for when it takes more.
+
+Every timing is also added to an in-process histogram, which is handy for local runs and benchmarks:
+
+    print(get_histogram('db_write').summary())
+"""
+import json
+import math
+import os
+import threading
+import time
+from contextlib import ContextDecorator
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'ptrdata')
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+
+# An embedded metric format document can hold at most 100 values per metric
+EMF_MAX_VALUES = 100
+
+# Histogram buckets grow by a factor of 2 ** (1 / HISTOGRAM_BUCKETS_PER_DOUBLING), so reported percentiles are within
+# about 10% of the true value.
+HISTOGRAM_BUCKETS_PER_DOUBLING = 8
+
+
+class Histogram:
+    """ Counts of values in logarithmic buckets, for approximate percentiles. Safe to share between threads. """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = {}  # bucket index: count
+        self._lock = threading.Lock()
+
+    def add(self, value):
+        index = math.floor(math.log2(max(value, 1e-3)) * HISTOGRAM_BUCKETS_PER_DOUBLING)
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+            self._buckets[index] = self._buckets.get(index, 0) + 1
+
+    def percentile(self, p):
+        """ The upper edge of the bucket holding the p-th percentile (0-100), or None if the histogram is empty. """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = p / 100 * self.count
+            seen = 0
+            for index in sorted(self._buckets):
+                seen += self._buckets[index]
+                if seen >= rank:
+                    return min(self.max, 2 ** ((index + 1) / HISTOGRAM_BUCKETS_PER_DOUBLING))
+            return self.max
+
+    def summary(self) -> dict:
+        """ count, mean, p50, p90, p99 and max. """
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max if self.count else None,
+        }
+
+
+class MetricsRecorder:
+    """ Collects stage timings until they're flushed, and keeps histograms of every timing seen.
+
+    Args:
+        namespace (str): the CloudWatch namespace of the metrics.
+        emit (callable): called with each json line. Defaults to print, since CloudWatch reads metrics from stdout.
+    """
+
+    def __init__(self, namespace=METRICS_NAMESPACE, emit=print):
+        self.namespace = namespace
+        self.emit = emit
+        self.histograms = {}
+        self._pending = {}  # (dimension items): {metric name: [values]}
+        self._lock = threading.Lock()
+
+    def record(self, name, value_ms, **dimensions):
+        """ Record one timing, in milliseconds. Dimensions with a value of None are left out. """
+        dimensions = tuple(sorted((key, str(value)) for key, value in dimensions.items() if value is not None))
+        with self._lock:
+            self._pending.setdefault(dimensions, {}).setdefault(name, []).append(round(value_ms, 3))
+            histogram = self.histograms.setdefault(name, Histogram())
+        histogram.add(value_ms)
+
+    def timed(self, name, **dimensions):
+        """ A context manager (or decorator) that records how long its body takes. """
+        return _Timer(self, name, dimensions)
+
+    def flush(self) -> list:
+        """ Emit the recorded timings, in as few embedded metric format documents as possible.
+
+        A document holds one value for each dimension, and one list of values for each metric, so timings recorded
+        with different dimensions share a document (as separate CloudWatchMetrics directives) unless they give a
+        dimension two values (eg. two sites in one batch), or record the same metric twice (eg. parse, for a jpg
+        and a fits file). Those go in another document.
+
+        Returns:
+            list: the documents, as dicts.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        documents = []  # (dimension values, {dimensions: {metric name: values}})
+        for dimensions, values in pending.items():
+            for document_dimensions, directives in documents:
+                conflict = any(document_dimensions.get(key, value) != value for key, value in dimensions)
+                shared_metric = any(name in metrics for metrics in directives.values() for name in values)
+                if not conflict and not shared_metric:
+                    document_dimensions.update(dimensions)
+                    directives[dimensions] = values
+                    break
+            else:
+                documents.append((dict(dimensions), {dimensions: values}))
+
+        timestamp_ms = int(time.time() * 1000)
+        emitted = []
+        for document_dimensions, directives in documents:
+            document = {
+                '_aws': {
+                    'Timestamp': timestamp_ms,
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [[key for key, _ in dimensions]],
+                        'Metrics': [{'Name': name, 'Unit': 'Milliseconds'} for name in metrics],
+                    } for dimensions, metrics in directives.items()],
+                },
+                **document_dimensions,
+            }
+            for metrics in directives.values():
+                document.update({name: values[-EMF_MAX_VALUES:] for name, values in metrics.items()})
+            self.emit(json.dumps(document, separators=(',', ':')))
+            emitted.append(document)
+        return emitted
+
+
+class _Timer(ContextDecorator):
+
+    def __init__(self, recorder, name, dimensions):
+        self.recorder = recorder
+        self.name = name
+        self.dimensions = dimensions
+        self._local = threading.local()  # a decorated function can run in several threads at once
+
+    def set_dimensions(self, **dimensions):
+        """ Add dimensions that are only known once the stage is underway. """
+        self.dimensions = {**self.dimensions, **dimensions}
+
+    def __enter__(self):
+        self._local.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if METRICS_ENABLED:
+            elapsed_ms = (time.perf_counter() - self._local.start) * 1000
+            self.recorder.record(self.name, elapsed_ms, **self.dimensions)
+        return False
+
+
+recorder = MetricsRecorder()
+
+
+def timed(name, **dimensions):
+    """ Time a stage, as a context manager or decorator. See the module docstring. """
+    return recorder.timed(name, **dimensions)
+
+
+def flush_metrics() -> list:
+    """ Emit the timings recorded since the last flush. The handlers call this at the end of each invocation. """
+    return recorder.flush()
+
+
+def get_histogram(name) -> Histogram:
+    """ The in-process histogram of every timing recorded for a stage in this process. """
+    return recorder.histograms.get(name, Histogram())
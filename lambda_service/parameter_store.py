@@ -0,0 +1,171 @@
+""" Read configuration and secrets from the AWS Systems Manager Parameter Store.
+
+Parameters are fetched together with a single get_parameters call and kept in memory for PARAMETER_TTL_S seconds,
+so warm invocations don't call ssm at all. Set PARAMETER_CACHE_FILE (for example to /tmp/ptrdata-parameters.json)
+to also keep a copy on the container's disk. Call invalidate() when a value is found to be stale, like after a
+database authentication failure, so that the next read fetches the current value.
+"""
+import json
+import os
+import time
+from functools import lru_cache
+
+import boto3
+
+from lambda_service.cache import TTLCache
+
+# Parameters used by the handlers. They're all fetched the first time any one of them is needed.
+REQUIRED_PARAMETERS = ['db-url']
+
+PARAMETER_TTL_S = int(os.getenv('PARAMETER_TTL_S', 900))
+PARAMETER_CACHE_FILE = os.getenv('PARAMETER_CACHE_FILE')
+
+# get_parameters accepts at most 10 names per call
+GET_PARAMETERS_MAX_NAMES = 10
+
+_parameters = TTLCache(maxsize=100, ttl_s=PARAMETER_TTL_S)
+
+
+class ParameterNotFound(KeyError):
+    """ Raised when a parameter doesn't exist in the parameter store. """
+
+
+@lru_cache(maxsize=None)
+def get_ssm_client():
+    """ The parameter store client, created the first time it's needed. """
+    return boto3.client('ssm', region_name=os.getenv('REGION'))
+
+
+def get_parameter(name, refresh=False):
+    """ Get the decrypted value of a parameter.
+
+    Args:
+        name (str): name of the parameter. Example: db-url
+        refresh (bool): ignore any cached value and read the parameter store.
+
+    Returns:
+        str: the parameter value.
+
+    Raises:
+        ParameterNotFound: if the parameter doesn't exist.
+    """
+    return get_parameters([name], refresh=refresh)[name]
+
+
+def get_parameters(names, refresh=False) -> dict:
+    """ Get the decrypted values of several parameters.
+
+    Values are read from memory, then from the cache file (if enabled). Anything still missing is fetched from the
+    parameter store along with the rest of REQUIRED_PARAMETERS, in as few calls as possible.
+
+    Args:
+        names (list): parameter names.
+        refresh (bool): ignore any cached values and read the parameter store.
+
+    Returns:
+        dict: name: value for every name.
+
+    Raises:
+        ParameterNotFound: if a parameter doesn't exist.
+    """
+    values = {}
+    if not refresh:
+        for name in names:
+            value = _parameters.get(name)
+            if value is not None:
+                values[name] = value
+
+        missing = [name for name in names if name not in values]
+        if missing and PARAMETER_CACHE_FILE:
+            now = time.time()
+            for name, (value, expires_at) in _read_cache_file(missing).items():
+                _parameters.set(name, value, ttl_s=expires_at - now)
+                values[name] = value
+
+    missing = [name for name in names if name not in values]
+    if missing:
+        # Fetch the other required parameters at the same time, so they're already cached when they're needed.
+        to_fetch = list(dict.fromkeys(missing + REQUIRED_PARAMETERS))
+        fetched = fetch_parameters(to_fetch)
+        for name, value in fetched.items():
+            _parameters.set(name, value)
+        if PARAMETER_CACHE_FILE:
+            _write_cache_file(fetched)
+
+        not_found = [name for name in missing if name not in fetched]
+        if not_found:
+            raise ParameterNotFound(f"Parameters not found: {not_found}")
+        values.update(fetched)
+
+    return {name: values[name] for name in names}
+
+
+def fetch_parameters(names) -> dict:
+    """ Read parameters from the parameter store, bypassing the cache.
+
+    Returns:
+        dict: name: value for each of the names that exist.
+    """
+    values = {}
+    for i in range(0, len(names), GET_PARAMETERS_MAX_NAMES):
+        response = get_ssm_client().get_parameters(
+            Names=names[i:i + GET_PARAMETERS_MAX_NAMES],
+            WithDecryption=True
+        )
+        for parameter in response['Parameters']:
+            values[parameter['Name']] = parameter['Value']
+    return values
+
+
+def invalidate(name=None):
+    """ Forget a cached parameter (or every cached parameter, if name is None), in memory and on disk. """
+    if name is None:
+        _parameters.clear()
+    else:
+        _parameters.pop(name)
+
+    # The file is only a copy of what's in memory, so it's simplest to remove it; it's rewritten on the next fetch.
+    if PARAMETER_CACHE_FILE:
+        try:
+            os.remove(PARAMETER_CACHE_FILE)
+        except OSError:
+            pass
+
+
+def _read_cache_file(names) -> dict:
+    """ Read unexpired parameters from the cache file.
+
+    Returns:
+        dict: name: (value, expiration timestamp) for each of the names found. Empty if there's no usable file.
+    """
+    try:
+        with open(PARAMETER_CACHE_FILE) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    now = time.time()
+    return {
+        name: (entry['value'], entry['expires_at']) for name, entry in cached.items()
+        if entry['expires_at'] > now and name in names
+    }
+
+
+def _write_cache_file(values):
+    """ Save parameters to the cache file, readable only by this user. Errors are ignored; the file is optional. """
+    expires_at = time.time() + PARAMETER_TTL_S
+    entries = {name: {'value': value, 'expires_at': expires_at} for name, value in values.items()}
+    try:
+        with open(PARAMETER_CACHE_FILE) as f:
+            entries = {**json.load(f), **entries}
+    except (OSError, ValueError):
+        pass
+
+    try:
+        temporary_path = f"{PARAMETER_CACHE_FILE}.{os.getpid()}"
+        fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temporary_path, PARAMETER_CACHE_FILE)
+    except OSError:
+        pass
@@ -0,0 +1,273 @@
+""" Render jpg previews from fits files, for exposures that arrive without any jpgs.
+
+Sites on slow connections can upload only their fits files. For the sites listed in FITS_PREVIEW_SITES, the data
+handler renders the medium (EX10) jpg from the fits pixel data, along with the jpg renditions (see
+thumbnails.make_renditions). Other sites upload their own jpgs, often a few seconds after the fits files.
+
+The fits file is decompressed to a temporary file and memory-mapped, so the full frame is never loaded into memory.
+The frame is downsampled by averaging blocks of pixels, a strip of rows at a time; the stretch (zscale limits from a
+sample of the pixels, then asinh) is only applied to the small downsampled image.
+"""
+import bz2
+import io
+import logging
+import math
+import os
+import tempfile
+
+from lambda_service.fits_header import parse_header
+from lambda_service.helpers import FITS_BLOCK_SIZE
+from lambda_service.helpers import find_fits_header_end
+from lambda_service.helpers import get_s3_client
+from lambda_service.helpers import get_s3_image_path
+from lambda_service.helpers import get_s3_rendition_path
+from lambda_service.helpers import JPG_RENDITION_HEIGHTS_PX
+from lambda_service.thumbnails import make_renditions
+from lambda_service.thumbnails import upload_renditions
+
+logger = logging.getLogger(__name__)
+
+# Comma separated site codes, eg. 'sro,mrc'. Empty means no previews are made.
+FITS_PREVIEW_SITES = {site.strip() for site in os.getenv('FITS_PREVIEW_SITES', '').split(',') if site.strip()}
+
+# The medium jpg is at least this tall (the frame is reduced by a whole number of pixels in each direction)
+FITS_PREVIEW_HEIGHT_PX = int(os.getenv('FITS_PREVIEW_HEIGHT_PX', 768))
+
+# zscale parameters, as in IRAF
+ZSCALE_SAMPLES = 10000
+ZSCALE_CONTRAST = 0.25
+ZSCALE_REJECTION_SIGMA = 2.5
+ZSCALE_MAX_ITERATIONS = 5
+ZSCALE_MIN_GOOD_FRACTION = 0.5
+
+# Strength of the asinh stretch. Larger values bring out fainter detail.
+ASINH_SOFTENING = 10
+
+DECOMPRESS_CHUNK_BYTES = 1024 * 1024
+
+# numpy dtypes for each fits BITPIX (fits data is big-endian)
+BITPIX_DTYPES = {8: 'u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+
+def open_fits_image(path):
+    """ Memory-map the primary image of an uncompressed fits file.
+
+    Args:
+        path (str): path to the fits file.
+
+    Returns:
+        tuple: (numpy.memmap with shape (NAXIS2, NAXIS1), header dict). For data cubes, the first plane is used.
+    """
+    import numpy as np
+
+    with open(path, 'rb') as f:
+        header_bytes = b''
+        header_end = None
+        while header_end is None:
+            block = f.read(FITS_BLOCK_SIZE)
+            if not block:
+                raise ValueError(f"No END card in the header of {path}")
+            checked = len(header_bytes)
+            header_bytes += block
+            header_end = find_fits_header_end(header_bytes, checked)
+
+    header = parse_header(header_bytes[:header_end])
+    if header.get('NAXIS', 0) < 2:
+        raise ValueError(f"{path} has no image in its primary hdu")
+
+    shape = (header['NAXIS2'], header['NAXIS1'])
+    data_offset = math.ceil(header_end / FITS_BLOCK_SIZE) * FITS_BLOCK_SIZE
+    image = np.memmap(path, dtype=BITPIX_DTYPES[header['BITPIX']], mode='r', offset=data_offset, shape=shape)
+    return image, header
+
+
+def zscale(samples):
+    """ Find display limits for an image from a sample of its pixels, with the IRAF zscale algorithm.
+
+    A line is fitted to the sorted sample values, iteratively rejecting outliers, and the limits are placed where
+    the line (with its slope divided by the contrast) meets the ends of the sample.
+
+    Args:
+        samples (numpy.ndarray): pixel values, in any order. Non-finite values are ignored.
+
+    Returns:
+        tuple: (z1, z2), the values to show as black and white.
+    """
+    import numpy as np
+
+    samples = np.sort(samples[np.isfinite(samples)])
+    npix = samples.size
+    if npix == 0:
+        return 0.0, 1.0
+    z_min, z_max = float(samples[0]), float(samples[-1])
+    center = (npix - 1) // 2
+    median = float(np.median(samples))
+
+    x = np.arange(npix, dtype=np.float64)
+    good = np.ones(npix, dtype=bool)
+    min_good = max(5, int(npix * ZSCALE_MIN_GOOD_FRACTION))
+    slope = 0.0
+    for _ in range(ZSCALE_MAX_ITERATIONS):
+        if good.sum() < min_good:
+            break
+        slope, intercept = np.polyfit(x[good], samples[good], 1)
+        residuals = samples - (slope * x + intercept)
+        sigma = residuals[good].std()
+        new_good = np.abs(residuals) < ZSCALE_REJECTION_SIGMA * sigma if sigma > 0 else good
+        if (new_good == good).all():
+            break
+        good = new_good
+
+    if good.sum() < min_good:
+        return z_min, z_max
+
+    slope /= ZSCALE_CONTRAST
+    z1 = max(z_min, median - center * slope)
+    z2 = min(z_max, median + (npix - 1 - center) * slope)
+    if z2 <= z1:
+        return z_min, z_max
+    return z1, z2
+
+
+def sample_pixels(image, n_samples=ZSCALE_SAMPLES):
+    """ Take about n_samples pixels spread evenly over an image, without reading the rest of it. """
+    import numpy as np
+
+    rows, columns = image.shape
+    stride = max(1, int(math.sqrt(rows * columns / n_samples)))
+    return np.asarray(image[stride // 2::stride, stride // 2::stride], dtype=np.float32).ravel()
+
+
+def block_mean(image, factor, rows_per_strip=None):
+    """ Downsample an image by averaging factor x factor blocks of pixels.
+
+    The image is read a strip of rows at a time, so only one strip (as float32) is in memory at once. Rows and
+    columns that don't fill a whole block are dropped.
+
+    Args:
+        image (numpy.ndarray): 2d array, eg. a numpy.memmap.
+        factor (int): size of the blocks.
+        rows_per_strip (int): number of rows to read at once. Rounded to a whole number of blocks.
+
+    Returns:
+        numpy.ndarray: float32 array of shape (rows // factor, columns // factor).
+    """
+    import numpy as np
+
+    rows, columns = image.shape
+    out_rows, out_columns = rows // factor, columns // factor
+    blocks_per_strip = max(1, (rows_per_strip or 8 * factor) // factor)
+    reduced = np.empty((out_rows, out_columns), dtype=np.float32)
+
+    for out_start in range(0, out_rows, blocks_per_strip):
+        out_end = min(out_rows, out_start + blocks_per_strip)
+        strip = np.asarray(image[out_start * factor:out_end * factor, :out_columns * factor], dtype=np.float32)
+        strip = strip.reshape(out_end - out_start, factor, out_columns, factor)
+        reduced[out_start:out_end] = strip.mean(axis=(1, 3))
+    return reduced
+
+
+def asinh_stretch(image, z1, z2, softening=ASINH_SOFTENING):
+    """ Scale an image to 8 bits, with z1 as black and z2 as white, through an asinh curve. """
+    import numpy as np
+
+    scaled = np.clip((image - z1) / (z2 - z1), 0, 1)
+    np.nan_to_num(scaled, copy=False)
+    stretched = np.arcsinh(softening * scaled) / np.arcsinh(softening)
+    return (stretched * 255 + 0.5).astype(np.uint8)
+
+
+def render_preview(image, height_px=FITS_PREVIEW_HEIGHT_PX) -> bytes:
+    """ Render a jpg preview of a fits image.
+
+    Args:
+        image (numpy.ndarray): 2d image data. Raw stored values are fine: BZERO and BSCALE are a linear scaling,
+            which doesn't change how the image looks once it's stretched.
+        height_px (int): minimum height of the preview. Smaller images keep their size.
+
+    Returns:
+        bytes: the preview, as a jpg.
+    """
+    import numpy as np
+    from PIL import Image
+
+    factor = max(1, image.shape[0] // height_px)
+    reduced = block_mean(image, factor)
+    z1, z2 = zscale(sample_pixels(image))
+    pixels = asinh_stretch(reduced, z1, z2)
+
+    # fits images start at the bottom row; jpgs start at the top
+    preview = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(pixels[::-1])).save(preview, format='JPEG', quality=90)
+    return preview.getvalue()
+
+
+def preview_enabled(site) -> bool:
+    """ Whether jpgs should be rendered from the fits files of a site's exposures. """
+    return site in FITS_PREVIEW_SITES
+
+
+def download_fits(bucket, key, destination):
+    """ Stream a .fits or .fits.bz2 object from s3 into a file, decompressing as it goes. """
+    body = get_s3_client().get_object(Bucket=bucket, Key=key)['Body']
+    decompressor = bz2.BZ2Decompressor() if key.endswith('.bz2') else None
+    for chunk in iter(lambda: body.read(DECOMPRESS_CHUNK_BYTES), b''):
+        destination.write(chunk if decompressor is None else decompressor.decompress(chunk))
+
+
+def preview_handler(bucket, fits_key, base_filename, data_type, s3_directory='data') -> bool:
+    """ Make the medium jpg and renditions for an exposure from one of its fits files.
+
+    Does nothing if the exposure already has a medium jpg, including one the site uploads while the preview is being
+    rendered: the preview is only written if the key is still free. The jpg is uploaded like one from a site, so the
+    data handler records it when its s3 event arrives. The renditions are uploaded here (from the same in-memory jpg)
+    and tagged with the medium jpg's ETag, so that event doesn't make them again.
+
+    Args:
+        bucket (str): s3 bucket with the fits file.
+        fits_key (str): the fits file. Example: data/wmd-ea03-20190621-00000007-EX10.fits.bz2
+        base_filename (str): Example: wmd-ea03-20190621-00000007
+        data_type (str): Example: EX
+
+    Returns:
+        bool: True if a preview was made.
+    """
+    from botocore.exceptions import ClientError
+
+    medium_jpg_key = get_s3_image_path(s3_directory, base_filename, data_type, "10", "jpg")
+    try:
+        get_s3_client().head_object(Bucket=bucket, Key=medium_jpg_key)
+        logger.info(f"{medium_jpg_key} already exists; not rendering a preview")
+        return False
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+
+    with tempfile.NamedTemporaryFile(suffix='.fits') as fits_file:
+        download_fits(bucket, fits_key, fits_file)
+        fits_file.flush()
+        image, _ = open_fits_image(fits_file.name)
+        try:
+            preview = render_preview(image)
+        finally:
+            del image  # close the memory map before the file is removed
+
+    try:
+        response = get_s3_client().put_object(
+            Bucket=bucket, Key=medium_jpg_key, Body=preview, ContentType='image/jpeg', IfNoneMatch='*',
+        )
+    except ClientError as e:
+        # 409 is returned when another write to the key is in progress
+        if e.response['Error']['Code'] not in ('PreconditionFailed', '412', 'ConditionalRequestConflict', '409'):
+            raise
+        logger.info(f"{medium_jpg_key} was uploaded while the preview was rendered; keeping it")
+        return False
+    etag = response['ETag'].strip('"')
+
+    rendition_keys = {
+        height: get_s3_rendition_path(base_filename, data_type, height, s3_directory)
+        for height in JPG_RENDITION_HEIGHTS_PX
+    }
+    renditions = make_renditions(io.BytesIO(preview), JPG_RENDITION_HEIGHTS_PX)
+    upload_renditions(bucket, rendition_keys, renditions, etag)
+    return True
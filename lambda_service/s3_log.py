@@ -1,19 +1,133 @@
 import os
 import boto3
 import json
-import requests
+import logging
+import threading
 import time
+from functools import lru_cache
 
 from lambda_service.helpers import timestamp_to_isodate_utc
 from lambda_service.helpers import filesize_readable
-from lambda_service.helpers import get_site_from_filename
+from lambda_service.filenames import FileKey
+
+logger = logging.getLogger(__name__)
+
+# Limits and retries for batch_write_item. Unprocessed items are retried after 50, 100, 200 and 400 ms.
+BATCH_WRITE_MAX_ITEMS = 25
+BATCH_WRITE_MAX_ATTEMPTS = 5
+BATCH_WRITE_BACKOFF_S = 0.05
+
+
+@lru_cache(maxsize=None)
+def get_dynamodb_resource():
+    return boto3.resource("dynamodb", region_name=os.getenv('REGION'))
+
+
+@lru_cache(maxsize=None)
+def get_recent_uploads_table():
+    """ The s3 uploads log dynamodb table, created the first time it's needed. """
+    return get_dynamodb_resource().Table(os.getenv('UPLOADS_LOG_TABLE'))
+
+
+@lru_cache(maxsize=None)
+def get_recent_uploads_key_names():
+    """ The names of the uploads log table's key attributes. Looked up (with DescribeTable) once per container. """
+    return tuple(key['AttributeName'] for key in get_recent_uploads_table().key_schema)
 
-dynamodb = boto3.resource("dynamodb", region_name=os.getenv('REGION'))
-recent_uploads_table = dynamodb.Table(os.getenv('UPLOADS_LOG_TABLE'))
 
 # Expire s3 log entries after this amount of time
 log_entry_ttl_s = int(os.getenv('UPLOADS_LOG_TTL_HOURS', 48)) * 3600
 
+
+class UploadsLogWriter:
+    """ Collects uploads log entries and writes them to the table in batches.
+
+    Entries are held until flush() is called (the handlers flush at the end of each invocation, after the database
+    updates), then written with batch_write_item, up to 25 entries per request. Safe to share between threads.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._lock = threading.Lock()
+
+    def add(self, log_entry):
+        """ Queue an entry for the next flush. """
+        with self._lock:
+            self._entries.append(log_entry)
+
+    def flush(self) -> int:
+        """ Write every queued entry.
+
+        Entries that can't be written are logged and dropped; the uploads log is informational, so a failed write
+        doesn't fail the upload that caused it.
+
+        Returns:
+            int: the number of entries that could not be written.
+        """
+        with self._lock:
+            entries, self._entries = self._entries, []
+        if not entries:
+            return 0
+
+        try:
+            batches = batch_log_entries(entries, get_recent_uploads_key_names())
+        except Exception:
+            logger.exception(f"Failed to write {len(entries)} entries to the uploads log")
+            return len(entries)
+
+        failed = 0
+        for batch in batches:
+            try:
+                failed += self._write_batch(batch)
+            except Exception:
+                logger.exception(f"Failed to write {len(batch)} entries to the uploads log")
+                failed += len(batch)
+        return failed
+
+    def _write_batch(self, batch) -> int:
+        table_name = get_recent_uploads_table().name
+        put_requests = [{"PutRequest": {"Item": log_entry}} for log_entry in batch]
+        for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+            if attempt:
+                time.sleep(BATCH_WRITE_BACKOFF_S * 2 ** (attempt - 1))
+            response = get_dynamodb_resource().batch_write_item(RequestItems={table_name: put_requests})
+            put_requests = response.get("UnprocessedItems", {}).get(table_name, [])
+            if not put_requests:
+                return 0
+        logger.error(f"Uploads log entries were not written after {BATCH_WRITE_MAX_ATTEMPTS} attempts: {put_requests}")
+        return len(put_requests)
+
+
+def batch_log_entries(entries, key_names) -> list:
+    """ Split log entries into batches that fit in one batch_write_item request.
+
+    A request can't hold two entries with the same key, so only the last entry for each key is kept. That matches
+    writing the entries one at a time, where the last write wins.
+
+    Args:
+        entries (list): log entries, in the order they were added.
+        key_names (tuple): names of the table's key attributes.
+
+    Returns:
+        list: lists of at most BATCH_WRITE_MAX_ITEMS entries.
+    """
+    unique_entries = {}
+    for log_entry in entries:
+        unique_entries[tuple(log_entry[name] for name in key_names)] = log_entry
+    unique_entries = list(unique_entries.values())
+    return [
+        unique_entries[i:i + BATCH_WRITE_MAX_ITEMS]
+        for i in range(0, len(unique_entries), BATCH_WRITE_MAX_ITEMS)
+    ]
+
+
+uploads_log_writer = UploadsLogWriter()
+
+
+def flush_uploads_log() -> int:
+    """ Write all the queued uploads log entries. Returns the number of entries that could not be written. """
+    return uploads_log_writer.flush()
+
 def log_new_upload(filename: str, upload_timestamp_s: int, size_bytes: int):
     """ Handler function that calls all the subroutines involved logging new s3 uploads.
     That includes saving some info in a dynamodb table and streaming a notice to the userstatus panel in the UI. 
@@ -26,7 +140,7 @@ def log_new_upload(filename: str, upload_timestamp_s: int, size_bytes: int):
 
     # filename will be full object key like
     # data/wmd-ea03-20190621-00000007-EX00.fits.bz2
-    site = get_site_from_filename(filename.split('/')[-1])
+    site = FileKey.parse(filename.split('/')[-1]).site
 
     add_to_recent_uploads_log(filename, upload_timestamp_s, size_bytes, site)
 
@@ -39,6 +153,8 @@ def log_new_upload(filename: str, upload_timestamp_s: int, size_bytes: int):
 def add_to_recent_uploads_log(filename: str, upload_timestamp_s: int, size_bytes: int, site: str):
     """ Add the file to the s3 uploads log dynamodb table. Entries are set to expire in 2 days.
 
+    The entry is written by the next flush_uploads_log() call.
+
     Args:
         filename (str): full filename for the new object in s3. Eg: data/wmd-ea03-20190621-00000007-EX00.fits.bz2
         upload_timestamp_s (int): unix timestamp in seconds when the file was recieved in s3
@@ -46,7 +162,7 @@ def add_to_recent_uploads_log(filename: str, upload_timestamp_s: int, size_bytes
         site (str): site associated with the file
 
     Returns:
-        dynamodb table put_item response
+        dict: the queued log entry.
     """
 
     log_entry = {
@@ -56,8 +172,8 @@ def add_to_recent_uploads_log(filename: str, upload_timestamp_s: int, size_bytes
         "filename": filename,
         "size_bytes": int(size_bytes),
     }
-    response = recent_uploads_table.put_item( Item=log_entry )
-    return response
+    uploads_log_writer.add(log_entry)
+    return log_entry
 
 
 def send_new_upload_to_site_activity_log(filename: str, upload_timestamp_s: int, size_bytes: int, site: str): # aka userstatus
@@ -85,5 +201,6 @@ def send_new_upload_to_site_activity_log(filename: str, upload_timestamp_s: int,
         "log_level": "info",
         "timestamp": time.time(),
     })
+    import requests  # only needed here, so it isn't loaded on every cold start
     resp = requests.post(url, body)
     print(resp)
@@ -0,0 +1,120 @@
+""" Run the independent steps of a handler at the same time.
+
+Most of the time spent handling an upload is waiting on s3, dynamodb and postgres, and many of those requests don't
+depend on each other. A StageExecutor runs named stages on a shared, bounded thread pool, starting each stage as soon
+as the stages it depends on have finished:
+
+    stages = StageExecutor()
+    stages.add('header', scan_header_file, bucket, key)
+    stages.add('renditions', rendition_handler, bucket, jpg_key, rendition_keys)
+    stages.add('database', lambda: upsert_image(..., stages.result('header')), after=['header', 'renditions'])
+    stages.add('notify', send_to_datastream, site, payload, after=['database'])
+    stages.run()
+
+If a stage raises, the stages that depend on it are not run, and run() raises a StageError once every other stage
+has finished.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+STAGE_MAX_WORKERS = int(os.getenv('STAGE_MAX_WORKERS', 8))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_stage_pool():
+    """ The thread pool shared by every StageExecutor, created the first time it's needed. """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=STAGE_MAX_WORKERS, thread_name_prefix='stage')
+        return _pool
+
+
+class StageError(Exception):
+    """ Raised by StageExecutor.run when stages failed.
+
+    The errors attribute maps the name of each failed stage to its exception, and skipped lists the stages that
+    were not run because a stage they depend on failed.
+    """
+    def __init__(self, errors, skipped):
+        self.errors = errors
+        self.skipped = skipped
+        failures = ', '.join(f"{name}: {error!r}" for name, error in errors.items())
+        super().__init__(f"{len(errors)} stages failed ({failures}); skipped {skipped}")
+
+
+class StageExecutor:
+    """ Runs a set of named stages, each once its dependencies have finished, on a bounded thread pool.
+
+    Stages are only scheduled from the thread that calls run(), so a stage never waits on another from inside the
+    pool, and a small pool can't deadlock.
+
+    Args:
+        pool (concurrent.futures.Executor): where to run the stages. Defaults to the shared pool.
+    """
+
+    def __init__(self, pool=None):
+        self._pool = pool
+        self._stages = {}  # name: (function, args, kwargs, dependencies)
+        self._results = {}
+
+    def add(self, name, function, *args, after=(), **kwargs):
+        """ Add a stage that calls function(*args, **kwargs) once every stage named in after has succeeded. """
+        if name in self._stages:
+            raise ValueError(f"There is already a stage named {name}")
+        unknown = [dependency for dependency in after if dependency not in self._stages]
+        if unknown:
+            raise ValueError(f"Stage {name} depends on stages that haven't been added: {unknown}")
+        self._stages[name] = (function, args, kwargs, tuple(after))
+
+    def __contains__(self, name):
+        return name in self._stages
+
+    def result(self, name):
+        """ The return value of a stage that has finished. Stages can read the results of their dependencies. """
+        return self._results[name]
+
+    def run(self) -> dict:
+        """ Run every stage, and wait for them to finish.
+
+        Returns:
+            dict: stage name: return value.
+
+        Raises:
+            StageError: if any stage raised.
+        """
+        pool = self._pool or get_stage_pool()
+        pending = dict(self._stages)
+        running = {}  # future: stage name
+        errors = {}
+        skipped = []
+
+        while pending or running:
+            for name, (function, args, kwargs, after) in list(pending.items()):
+                if any(dependency in errors or dependency in skipped for dependency in after):
+                    del pending[name]
+                    skipped.append(name)
+                elif all(dependency in self._results for dependency in after):
+                    del pending[name]
+                    running[pool.submit(function, *args, **kwargs)] = name
+
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    self._results[name] = future.result()
+                except Exception as e:
+                    logger.exception(f"Stage {name} failed")
+                    errors[name] = e
+
+        if errors:
+            raise StageError(errors, skipped)
+        return dict(self._results)
@@ -0,0 +1,62 @@
+""" Count database connection setups per 1,000 simulated ingest events.
+
+Each simulated event opens three sessions, like the .fits path in handle_s3_object_created
+(update_new_image, header_data_exists, update_header_data). The 'before' case builds a new engine for every
+session, which is what get_session used to do; the 'after' case uses the cached engine from db.get_engine.
+"""
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker
+
+from lambda_service import db
+
+EVENTS = 1000
+SESSIONS_PER_EVENT = 3
+
+
+def count_connections(engine, counter):
+    event.listen(engine, 'connect', lambda *args: counter.append(1))
+
+
+def run_uncached(db_address):
+    connections = []
+    start = time.perf_counter()
+    for _ in range(EVENTS * SESSIONS_PER_EVENT):
+        engine = create_engine(db_address)
+        count_connections(engine, connections)
+        session = sessionmaker(bind=engine)()
+        session.execute(text('SELECT 1'))
+        session.close()
+    return len(connections), time.perf_counter() - start
+
+
+def run_cached(db_address):
+    connections = []
+    db.dispose_engines(db_address)
+    count_connections(db.get_engine(db_address), connections)
+    start = time.perf_counter()
+    for _ in range(EVENTS * SESSIONS_PER_EVENT):
+        with db.get_session(db_address) as session:
+            session.execute(text('SELECT 1'))
+    elapsed = time.perf_counter() - start
+    db.dispose_engines(db_address)
+    return len(connections), elapsed
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_address = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+        before = run_uncached(db_address)
+        after = run_cached(db_address)
+
+    print(f"{EVENTS} events, {SESSIONS_PER_EVENT} sessions per event")
+    print(f"{'':<22}{'connections':>12}{'seconds':>10}")
+    print(f"{'engine per session':<22}{before[0]:>12}{before[1]:>10.3f}")
+    print(f"{'cached engine':<22}{after[0]:>12}{after[1]:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
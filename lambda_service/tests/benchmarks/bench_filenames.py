@@ -0,0 +1,126 @@
+""" Time the filename and event time parsing done for each s3 record.
+
+    legacy: the validators as they were before filenames.FileKey. Every record validated its filename five times
+        (in the handler, three times in parse_file_key, and again in log_new_upload), and each validation printed
+        the base filename and compiled a regex. The event time was parsed with dateutil.
+    FileKey: parse the filename once with FileKey.parse (the lookup in log_new_upload hits its cache) and the event
+        time with datetime.fromisoformat.
+
+Every filename in the run is new, so the FileKey cache only helps with repeated lookups of the same record.
+"""
+import contextlib
+import io
+import os
+import re
+import time
+
+os.environ.setdefault('BUCKET_NAME', 'photonranch-001')
+os.environ.setdefault('REGION', 'us-east-1')
+
+import dateutil.parser
+
+from lambda_service.filenames import FileKey, _parse_filename
+from lambda_service.helpers import isodate_to_timestamp
+
+EXPOSURES = 2000
+FILES_PER_EXPOSURE = ['EX00.txt', 'EX10.jpg', 'EX11.jpg', 'EX10.fits.bz2', 'EX01.fits.bz2']
+EVENT_TIME = '2020-09-24T17:40:17.597Z'
+
+
+def legacy_validate_base_filename(filename):
+    parts = filename.split('-')
+    assert len(parts) == 4
+    site = parts[0]
+    assert len(site) >= 3 and len(site) <= 6
+    date = parts[2]
+    assert len(date) == 8 and date.isdigit()
+    incr = parts[3]
+    assert len(incr) == 8 and incr.isdigit()
+    return True
+
+
+def legacy_validate_filename(filename):
+    parts = filename.split('-')
+    base_filename = '-'.join(parts[:4])
+    print(base_filename)
+    assert legacy_validate_base_filename(base_filename)
+    extension_parts = parts[4].split('.')
+    obstype_reduction_level_re = re.compile("([a-zA-Z]+)([0-9]+)")
+    observation_type, reduction_level = obstype_reduction_level_re.match(extension_parts[0]).groups()
+    assert observation_type and observation_type.isalpha()
+    assert len(reduction_level) == 2 and reduction_level.isdigit()
+    assert extension_parts[1].isalpha()
+    return True
+
+
+def legacy_get_data_type(full_filename):
+    assert legacy_validate_filename(full_filename)
+    obstype_reductionlevel = full_filename.split('-')[4].split('.')[0]
+    return re.compile("([a-zA-Z]+)([0-9]+)").match(obstype_reductionlevel).groups()[0]
+
+
+def legacy_get_reduction_level(full_filename):
+    assert legacy_validate_filename(full_filename)
+    obstype_reductionlevel = full_filename.split('-')[4].split('.')[0]
+    return re.compile("([a-zA-Z]+)([0-9]+)").match(obstype_reductionlevel).groups()[1]
+
+
+def legacy_parse_file_key(file_key):
+    filename_no_extension, filename_extension = file_key.split('.', 1)
+    filename_extension = filename_extension.split('.')[0]
+    site, instrument, file_date, file_counter, data_type_level = filename_no_extension.split('-')
+    return {
+        "base_filename": '-'.join([site, instrument, file_date, file_counter]),
+        "file_extension": filename_extension,
+        "site": site,
+        "instrument": instrument,
+        "file_date": file_date,
+        "file_counter": file_counter,
+        "data_type": legacy_get_data_type(file_key),
+        "reduction_level": legacy_get_reduction_level(file_key),
+    }
+
+
+def legacy_record(filename):
+    legacy_validate_filename(filename)
+    file_parts = legacy_parse_file_key(filename)
+    dateutil.parser.parse(EVENT_TIME).timestamp()
+    legacy_validate_filename(filename)  # get_site_from_filename in log_new_upload
+    return file_parts["base_filename"]
+
+
+def file_key_record(filename):
+    file_key = FileKey.parse(filename)
+    isodate_to_timestamp(EVENT_TIME)
+    FileKey.parse(filename).site  # log_new_upload
+    return file_key.base_filename
+
+
+def filenames():
+    return [f"tst-ec002zs-20230314-{i:08d}-{suffix}" for i in range(EXPOSURES) for suffix in FILES_PER_EXPOSURE]
+
+
+def time_records(parse_record, names):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name in names:
+            parse_record(name)
+    return (time.perf_counter() - start) / len(names)
+
+
+def main():
+    names = filenames()
+    _parse_filename.cache_clear()
+    legacy = time_records(legacy_record, names)
+    _parse_filename.cache_clear()
+    file_key = time_records(file_key_record, names)
+
+    print(f"{len(names)} records")
+    print(f"{'':<10}{'us/record':>10}")
+    print(f"{'legacy':<10}{legacy * 1e6:>10.1f}")
+    print(f"{'FileKey':<10}{file_key * 1e6:>10.1f}")
+    print(f"speedup: {legacy / file_key:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+""" Compare fits header parsers on the corpus of site headers in testing_data/headers.
+
+Parsers:
+    legacy: the card-by-card loop that scan_header_file used before fits_header.parse_header
+    parse_header: lambda_service.fits_header.parse_header
+    parse_headers: lambda_service.fits_header.parse_headers (bulk mode), per header, over many copies of the corpus
+    astropy: astropy.io.fits.Header.fromstring (skipped if astropy isn't installed)
+
+Add more headers to the corpus by saving the .txt header files that sites upload to s3.
+"""
+import glob
+import os
+import random
+import re
+import timeit
+
+from lambda_service.fits_header import parse_header
+from lambda_service.fits_header import parse_headers
+
+CORPUS_DIRECTORY = os.path.join(os.path.dirname(__file__), '..', 'testing_data', 'headers')
+REPEAT = 5
+NUMBER = 200
+BULK_COPIES = 500
+
+# Keywords that change from one exposure to the next; the bulk benchmark gives each copy new values for these.
+VARYING_KEYWORDS = [b'DATE-OBS', b'EXPTIME ', b'EXPOSURE', b'ALTITUDE', b'AZIMUTH ', b'AIRMASS ', b'FOCUS   ',
+                    b'MJD-OBS ', b'JD-START', b'RA      ', b'DEC     ', b'CRVAL1  ', b'CRVAL2  ', b'RAHRS   ']
+
+
+def legacy_parse(contents):
+    data_entry = {}
+    fits_line_length = 80
+    for i in range(0, len(contents), fits_line_length):
+        single_header_line = contents[i:i+fits_line_length].decode('utf8')
+        values = re.split('=|/|',single_header_line)
+        try:
+            attribute = single_header_line[:8].strip()
+            after_attr = single_header_line[10:-1]
+            if "'" in after_attr.split('/')[0]:
+                value = after_attr.split("'")[1].strip()
+            else:
+                value = after_attr.split("/")[0].strip()
+            data_entry[attribute] = value
+            if attribute == 'END': break
+        except Exception as e:
+            print(f"Error with parsing fits header: {e}")
+    return data_entry
+
+
+def astropy_parse(contents):
+    from astropy.io.fits import Header
+    return Header.fromstring(contents.decode('latin-1'))
+
+
+def vary(contents, rng):
+    """ Give the cards in VARYING_KEYWORDS new numeric values, like another exposure from the same site. """
+    cards = [contents[i:i+80] for i in range(0, len(contents), 80)]
+    for i, card in enumerate(cards):
+        if card[:8] in VARYING_KEYWORDS:
+            cards[i] = card[:10] + f"{rng.uniform(0, 360):>20.6f}".encode() + card[30:]
+    return b''.join(cards)
+
+
+def load_corpus():
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIRECTORY, '*.txt'))):
+        with open(path, 'rb') as f:
+            corpus.append((os.path.basename(path), f.read()))
+    return corpus
+
+
+def best_time_us(parser, contents):
+    timer = timeit.Timer(lambda: parser(contents))
+    return min(timer.repeat(repeat=REPEAT, number=NUMBER)) / NUMBER * 1e6
+
+
+def main():
+    parsers = [('legacy', legacy_parse), ('parse_header', parse_header)]
+    try:
+        import astropy  # noqa: F401
+        parsers.append(('astropy', astropy_parse))
+    except ImportError:
+        print("astropy is not installed; skipping Header.fromstring")
+
+    print(f"{'header':<22}{'cards':>7}" + ''.join(f"{name + ' (us)':>20}" for name, _ in parsers))
+    for name, contents in load_corpus():
+        times = [best_time_us(parser, contents) for _, parser in parsers]
+        print(f"{name:<22}{len(contents) // 80:>7}" + ''.join(f"{t:>20.1f}" for t in times))
+
+    rng = random.Random(0)
+    buffers = [vary(contents, rng) for _, contents in load_corpus() for _ in range(BULK_COPIES)]
+    single = min(timeit.repeat(lambda: [parse_header(b) for b in buffers], repeat=REPEAT, number=1))
+    bulk = min(timeit.repeat(lambda: parse_headers(buffers), repeat=REPEAT, number=1))
+    print(f"\n{len(buffers)} headers: parse_header {single / len(buffers) * 1e6:.1f} us/header, "
+          f"parse_headers {bulk / len(buffers) * 1e6:.1f} us/header")
+
+
+if __name__ == '__main__':
+    main()
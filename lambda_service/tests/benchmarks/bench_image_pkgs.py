@@ -0,0 +1,104 @@
+""" Compare ways of building image packages for a listing of 10,000 images.
+
+    orm: load full Image objects (including the header) and call get_image_pkg on each, like the frontend
+         listings used to
+    projected: db.query_image_pkgs, which selects only the package columns and builds packages in bulk
+
+Uses a temporary sqlite database with a realistic header in every row. Presigning doesn't make network requests,
+so placeholder credentials are used if none are configured. Reported memory is the peak traced by tracemalloc.
+"""
+import datetime
+import glob
+import os
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.ext.compiler import compiles
+
+from lambda_service import db
+from lambda_service import helpers
+from lambda_service.fits_header import parse_header
+
+ROWS = 10000
+
+
+@compiles(JSONB, 'sqlite')
+@compiles(ARRAY, 'sqlite')
+def compile_jsonb_for_sqlite(type_, compiler, **kw):
+    return 'JSON'
+
+
+def fill_database(db_address):
+    db.Base.metadata.create_all(db.get_engine(db_address))
+    header_path = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'testing_data', 'headers', '*')))[0]
+    with open(header_path, 'rb') as f:
+        header = parse_header(f.read())
+    start = datetime.datetime(2023, 3, 14)
+    rows = [{
+        "base_filename": f"tst-ec002zs-20230314-{i:08d}",
+        "site": "tst",
+        "data_type": "EX",
+        "capture_date": start + datetime.timedelta(seconds=30 * i),
+        "sort_date": start + datetime.timedelta(seconds=30 * i),
+        "right_ascension": 112.29,
+        "declination": 20.91,
+        "exposure_time": 30.0,
+        "filter_used": "PL",
+        "header": header,
+        "fits_10_exists": True,
+        "jpg_medium_exists": True,
+        "jpg_small_exists": True,
+    } for i in range(ROWS)]
+    with db.get_session(db_address) as session:
+        session.bulk_insert_mappings(db.Image, rows)
+
+
+def orm_listing(db_address):
+    with db.get_session(db_address) as session:
+        images = session.query(db.Image).order_by(db.Image.capture_date.desc()).all()
+        return [image.get_image_pkg() for image in images]
+
+
+def projected_listing(db_address):
+    return db.query_image_pkgs(db_address)
+
+
+def measure(function, db_address):
+    """ Time one run, then trace the memory of a second run (tracing slows python down too much to time it). """
+    helpers._presigned_urls.clear()
+    start = time.perf_counter()
+    packages = function(db_address)
+    elapsed = time.perf_counter() - start
+    assert len(packages) == ROWS
+    del packages
+
+    helpers._presigned_urls.clear()
+    tracemalloc.start()
+    function(db_address)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db_address = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+        fill_database(db_address)
+        helpers.get_signing_client()
+        measure(projected_listing, db_address)  # warm up imports and the connection
+
+        print(f"{ROWS} rows")
+        print(f"{'':<12}{'seconds':>10}{'peak MiB':>10}")
+        for name, function in [('orm', orm_listing), ('projected', projected_listing)]:
+            elapsed, peak = measure(function, db_address)
+            print(f"{name:<12}{elapsed:>10.2f}{peak / 2**20:>10.1f}")
+        db.dispose_engines(db_address)
+
+
+if __name__ == '__main__':
+    main()
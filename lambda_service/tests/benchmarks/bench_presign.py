@@ -0,0 +1,66 @@
+""" Time presigning the jpg urls for a page of 500 image packages (two urls per image).
+
+    uncached: a new s3 client for every url, which is what get_s3_file_url used to do
+    batch, cold: get_s3_file_urls with an empty url cache (cached signing client)
+    batch, warm: get_s3_file_urls again, answered from the url cache
+
+Presigning doesn't make network requests, so placeholder credentials are used if none are configured.
+"""
+import os
+import time
+
+os.environ.setdefault('BUCKET_NAME', 'photonranch-001')
+os.environ.setdefault('REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+import boto3
+from botocore.client import Config
+
+from lambda_service import helpers
+
+IMAGES = 500
+
+
+def image_paths():
+    paths = []
+    for i in range(IMAGES):
+        base_filename = f"tst-ec002zs-20230314-{i:08d}"
+        paths.append(helpers.get_s3_image_path("data", base_filename, "EX", "10", "jpg"))
+        paths.append(helpers.get_s3_image_path("data", base_filename, "EX", "11", "jpg"))
+    return paths
+
+
+def presign_uncached(paths):
+    for path in paths:
+        s3 = boto3.client('s3', helpers.REGION, config=Config(signature_version='s3v4'))
+        s3.generate_presigned_url(
+            ClientMethod="get_object",
+            Params={"Bucket": helpers.BUCKET_NAME, "Key": path},
+            ExpiresIn=604800
+        )
+
+
+def timed_us_per_image(function, paths):
+    start = time.perf_counter()
+    function(paths)
+    return (time.perf_counter() - start) / IMAGES * 1e6
+
+
+def main():
+    paths = image_paths()
+    helpers.get_signing_client()  # exclude the one-time client creation from the batch timings
+    helpers._presigned_urls.clear()
+
+    results = [
+        ('uncached', timed_us_per_image(presign_uncached, paths)),
+        ('batch, cold', timed_us_per_image(helpers.get_s3_file_urls, paths)),
+        ('batch, warm', timed_us_per_image(helpers.get_s3_file_urls, paths)),
+    ]
+    print(f"{IMAGES} images, 2 urls each")
+    for name, us in results:
+        print(f"{name:<14}{us:>12.1f} us/image")
+
+
+if __name__ == '__main__':
+    main()
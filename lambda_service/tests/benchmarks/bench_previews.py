@@ -0,0 +1,88 @@
+""" Time rendering a jpg preview from 16 bit fits frames of 4k x 4k and larger.
+
+    full load: read the whole frame with astropy (scaled to float), take percentile limits over every pixel, stretch
+        the full frame, then let Pillow shrink it
+    previews: lambda_service.previews: memory-map the file, zscale a sample of the pixels, block-mean in strips, and
+        stretch only the reduced image
+
+The fits files are uncompressed (decompression costs the same for both). Peak memory is traced by tracemalloc, which
+includes numpy arrays but not pages of the memory-mapped file, which the OS can drop at any time.
+"""
+import gc
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+
+os.environ.setdefault('BUCKET_NAME', 'photonranch-001')
+os.environ.setdefault('REGION', 'us-east-1')
+
+import numpy as np
+from astropy.io import fits
+from PIL import Image
+
+from lambda_service.previews import FITS_PREVIEW_HEIGHT_PX
+from lambda_service.previews import open_fits_image
+from lambda_service.previews import render_preview
+
+SIZES = [4096, 6144, 8192]
+
+
+def make_frame(path, size):
+    rng = np.random.default_rng(0)
+    data = rng.normal(1000, 30, (size, size)).astype(np.int16)
+    stars = rng.integers(0, size - 8, (500, 2))
+    for y, x in stars:
+        data[y:y + 8, x:x + 8] = 30000
+    hdu = fits.PrimaryHDU(data)
+    hdu.header['BZERO'] = 32768  # how most cameras store unsigned 16 bit data
+    hdu.writeto(path, overwrite=True)
+
+
+def full_load_preview(path):
+    data = fits.getdata(path).astype(np.float64)
+    z1, z2 = np.percentile(data, [0.5, 99.5])
+    scaled = np.clip((data - z1) / (z2 - z1), 0, 1)
+    pixels = (np.arcsinh(10 * scaled) / np.arcsinh(10) * 255).astype(np.uint8)[::-1]
+    image = Image.fromarray(pixels)
+    height = FITS_PREVIEW_HEIGHT_PX
+    image = image.resize((image.width * height // image.height, height))
+    preview = io.BytesIO()
+    image.save(preview, format='JPEG', quality=90)
+    return preview.getvalue()
+
+
+def previews_preview(path):
+    image, _ = open_fits_image(path)
+    return render_preview(image)
+
+
+def measure(function, path):
+    gc.collect()
+    start = time.perf_counter()
+    function(path)
+    elapsed = time.perf_counter() - start
+
+    gc.collect()
+    tracemalloc.start()
+    function(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    print(f"{'size':<8}{'':<12}{'seconds':>9}{'peak MiB':>10}")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in SIZES:
+            path = os.path.join(tmpdir, f"frame-{size}.fits")
+            make_frame(path, size)
+            for name, function in [('full load', full_load_preview), ('previews', previews_preview)]:
+                elapsed, peak = measure(function, path)
+                print(f"{size:<8}{name:<12}{elapsed:>9.2f}{peak / 2**20:>10.0f}")
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
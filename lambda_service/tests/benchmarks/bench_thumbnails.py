@@ -0,0 +1,81 @@
+""" Compare thumbnail pipelines on a 4096 x 4096 jpg, without s3.
+
+    tmp files: the old resize_handler: write the download to /tmp, decode at full resolution, save the thumbnail to
+        another /tmp file (neither file was ever removed)
+    in memory: thumbnails.resize_image: decode a reduced image from the bytes with Image.draft, encode to BytesIO
+
+Each pipeline runs in its own process so the reported peak RSS (ru_maxrss) isn't shared between them.
+"""
+import io
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+import uuid
+
+from PIL import Image
+
+from lambda_service.thumbnails import resize_image
+
+SIZE = 4096
+HEIGHT_PIX = 128
+REPEAT = 5
+
+
+def make_source_jpg():
+    # A smooth gradient with some noise compresses like a real stretched astronomical image
+    gradient = Image.linear_gradient('L').resize((SIZE, SIZE))
+    noise = Image.effect_noise((SIZE, SIZE), 40)
+    image = Image.merge('RGB', [gradient, noise, gradient.transpose(Image.Transpose.ROTATE_90)])
+    jpg = io.BytesIO()
+    image.save(jpg, format='JPEG', quality=90)
+    return jpg.getvalue()
+
+
+def tmp_files_thumbnail(source, tmpdir):
+    download_path = os.path.join(tmpdir, f"{uuid.uuid4()}source.jpg")
+    upload_path = os.path.join(tmpdir, "resized-source.jpg")
+    with open(download_path, 'wb') as f:
+        f.write(source)
+    with Image.open(download_path) as image:
+        width, height = image.size
+        scale_factor = height / HEIGHT_PIX
+        image.load()  # the old code decoded the whole image before resizing
+        image.thumbnail((int(width / scale_factor), HEIGHT_PIX))
+        image.save(upload_path)
+    with open(upload_path, 'rb') as f:
+        return f.read()
+
+
+def in_memory_thumbnail(source, tmpdir):
+    return resize_image(io.BytesIO(source), HEIGHT_PIX)
+
+
+def run(name, source, results):
+    function = {'tmp files': tmp_files_thumbnail, 'in memory': in_memory_thumbnail}[name]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        for _ in range(REPEAT):
+            function(source, tmpdir)
+        elapsed = (time.perf_counter() - start) / REPEAT
+        disk_files = len(os.listdir(tmpdir))
+    results[name] = (elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, disk_files)
+
+
+def main():
+    source = make_source_jpg()
+    print(f"{SIZE} x {SIZE} jpg ({len(source) / 2**20:.1f} MiB) to a {HEIGHT_PIX} px thumbnail")
+    print(f"{'':<12}{'ms':>8}{'peak RSS MiB':>14}{'tmp files':>11}")
+
+    results = multiprocessing.Manager().dict()
+    for name in ['tmp files', 'in memory']:
+        process = multiprocessing.Process(target=run, args=(name, source, results))
+        process.start()
+        process.join()
+        elapsed, peak_rss_mib, disk_files = results[name]
+        print(f"{name:<12}{elapsed * 1000:>8.1f}{peak_rss_mib:>14.0f}{disk_files:>11}")
+
+
+if __name__ == '__main__':
+    main()
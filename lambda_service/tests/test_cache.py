@@ -0,0 +1,42 @@
+import pytest
+
+from lambda_service.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expires_entries():
+    clock = FakeClock()
+    cache = TTLCache(maxsize=10, ttl_s=60, clock=clock)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl_s=120)
+    assert cache.get('a') == 1 and 'b' in cache
+
+    clock.now = 90
+    assert cache.get('a') is None
+    assert 'a' not in cache
+    assert cache.get('b') == 2
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl_s=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_ttl_cache_pop():
+    cache = TTLCache(maxsize=2, ttl_s=60)
+    cache.set('a', 1)
+    assert cache.pop('a') == 1
+    assert cache.pop('a', 'missing') == 'missing'
@@ -0,0 +1,67 @@
+import json
+
+from lambda_service import datastreamer
+from lambda_service.datastreamer import batch_messages
+from lambda_service.datastreamer import DatastreamPublisher
+from lambda_service.datastreamer import SEND_MESSAGE_BATCH_MAX_BYTES
+
+
+def test_batch_messages_by_count():
+    messages = [json.dumps({"n": i}) for i in range(23)]
+    batches = list(batch_messages(messages))
+    assert [len(batch) for batch in batches] == [10, 10, 3]
+    assert [m for batch in batches for m in batch] == messages
+
+
+def test_batch_messages_by_size():
+    large_message = 'x' * (SEND_MESSAGE_BATCH_MAX_BYTES // 3 + 1)
+    batches = list(batch_messages([large_message] * 4))
+    assert [len(batch) for batch in batches] == [2, 2]
+
+
+def test_publisher_flushes_nothing_when_empty():
+    assert DatastreamPublisher().flush() == 0
+
+
+class FakeSqsClient:
+    """ Stands in for the sqs client, recording the entries of each send_message_batch request. """
+    def __init__(self, failed_ids=()):
+        self.failed_ids = set(failed_ids)
+        self.batches = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self.batches.append(Entries)
+        failed = [{"Id": e["Id"], "SenderFault": False} for e in Entries if e["Id"] in self.failed_ids]
+        self.failed_ids.clear()  # the retry succeeds
+        return {"Failed": failed} if failed else {"Successful": Entries}
+
+
+def use_fake_sqs(monkeypatch, client):
+    monkeypatch.setattr(datastreamer, 'get_sqs_client', lambda: client)
+    monkeypatch.setattr(datastreamer, 'get_queue_url', lambda queue_name: f"https://sqs.test/{queue_name}")
+
+
+def test_publisher_sends_queued_messages(monkeypatch):
+    sqs = FakeSqsClient()
+    use_fake_sqs(monkeypatch, sqs)
+    publisher = DatastreamPublisher()
+    for i in range(12):
+        publisher.publish('tst', {"base_filename": f"tst-aa00-20201231-{i:08d}"})
+    assert publisher.flush() == 0
+    assert publisher.flush() == 0  # nothing left to send
+
+    assert [len(entries) for entries in sqs.batches] == [10, 2]
+    bodies = [json.loads(entry["MessageBody"]) for entries in sqs.batches for entry in entries]
+    assert [body["data"]["base_filename"] for body in bodies] == [f"tst-aa00-20201231-{i:08d}" for i in range(12)]
+    assert all(body["topic"] == "imagedata" and body["site"] == "tst" for body in bodies)
+
+
+def test_publisher_retries_failed_entries_once(monkeypatch):
+    sqs = FakeSqsClient(failed_ids={"1"})
+    use_fake_sqs(monkeypatch, sqs)
+    publisher = DatastreamPublisher()
+    for i in range(3):
+        publisher.publish('tst', {"n": i})
+    assert publisher.flush() == 0
+    assert [len(entries) for entries in sqs.batches] == [3, 1]
+    assert json.loads(sqs.batches[1][0]["MessageBody"])["data"] == {"n": 1}
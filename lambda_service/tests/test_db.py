@@ -5,8 +5,13 @@ from lambda_service.db import header_data_exists
 from lambda_service.db import update_new_image
 from lambda_service.db import update_header_data
 from lambda_service.db import db_remove_base_filename
+from lambda_service.db import db_remove_base_filenames
 from lambda_service.db import get_session, Image
+from lambda_service.db import query_images_by_header
+from lambda_service.db import query_image_pkgs
+from lambda_service.db import upsert_image
 from lambda_service.db import DB_ADDRESS
+from lambda_service.tests.testutils import assert_max_statements
 
 TEST_BASE_FILENAME = 'tst-test-20200924-00000041'
 
@@ -98,9 +103,107 @@ def test_db_remove_base_filename(setup_teardown):
             .scalar() is None
 
 
-#def test_update_header_data():
-    #pass
+def test_db_remove_base_filenames_ignores_missing_rows(setup_teardown):
+    with get_session(db_address=DB_ADDRESS) as session:
+        session.add(Image(base_filename=TEST_BASE_FILENAME, site="tst", data_type="EX"))
+        session.commit()
+
+    assert db_remove_base_filenames([TEST_BASE_FILENAME, 'tst-test-20200924-00000042']) == 1
+    assert db_remove_base_filenames([TEST_BASE_FILENAME]) == 0
+    assert db_remove_base_filenames([]) == 0
+
+
+def test_upsert_image_is_a_single_statement(setup_teardown):
+    # Every file of an exposure is written with one INSERT ... ON CONFLICT statement
+    with assert_max_statements(1, DB_ADDRESS):
+        upsert_image(DB_ADDRESS, TEST_BASE_FILENAME, {"data_type": "EX", "fits_10_exists": True})
+    with assert_max_statements(1, DB_ADDRESS):
+        upsert_image(DB_ADDRESS, TEST_BASE_FILENAME, {"data_type": "EX", "jpg_medium_exists": True})
+
+
+def test_update_new_image_upserts_single_row(setup_teardown):
+
+    # Files from the same exposure should all land in one row
+    update_new_image(DB_ADDRESS, TEST_BASE_FILENAME, 'EX', '10', 'fits')
+    update_new_image(DB_ADDRESS, TEST_BASE_FILENAME, 'EX', '10', 'jpg')
+    update_new_image(DB_ADDRESS, TEST_BASE_FILENAME, 'EX', '10', 'jpg')
+
+    with get_session(db_address=DB_ADDRESS) as session:
+        rows = session.query(Image)\
+            .filter_by(base_filename=TEST_BASE_FILENAME)\
+            .all()
+        assert len(rows) == 1
+        assert rows[0].fits_10_exists and rows[0].jpg_medium_exists
+        assert not rows[0].jpg_small_exists
+
+
+def test_query_images_by_header(setup_teardown):
+    header = {
+        "CRVAL1": 12.34,
+        "CRVAL2": 56.78,
+        "IMAGETYP": 'Light Frame',
+        "OBJECT": 'M31',
+        "FOCUS": 10234,
+        "DATE-OBS": '2021-01-01T12:34:54'
+    }
+    update_header_data(DB_ADDRESS, TEST_BASE_FILENAME, 'EX', header)
+
+    def matching_base_filenames(**kwargs):
+        images = query_images_by_header(DB_ADDRESS, site='tst', **kwargs)
+        return [image['base_filename'] for image in images]
+
+    assert TEST_BASE_FILENAME in matching_base_filenames(equals={'IMAGETYP': 'Light Frame', 'OBJECT': 'M31'})
+    assert TEST_BASE_FILENAME in matching_base_filenames(ranges={'FOCUS': (10000, None)})
+    assert TEST_BASE_FILENAME not in matching_base_filenames(ranges={'FOCUS': (9000, 10000)})
+    assert TEST_BASE_FILENAME not in matching_base_filenames(equals={'OBJECT': 'M32'})
 
 
-#def test_update_new_image():
+def test_query_images_by_header_matches_legacy_string_values(setup_teardown):
+    # Headers saved before values were typed hold numbers as strings
+    with get_session(db_address=DB_ADDRESS) as session:
+        session.add(Image(
+            base_filename=TEST_BASE_FILENAME,
+            site="tst",
+            data_type="EX",
+            header={"EXPTIME": "30", "FOCUS": "10234.0", "OBJECT": "M31"}
+        ))
+        session.commit()
+
+    def matching_base_filenames(**kwargs):
+        images = query_images_by_header(DB_ADDRESS, site='tst', **kwargs)
+        return [image['base_filename'] for image in images]
+
+    assert TEST_BASE_FILENAME in matching_base_filenames(equals={'EXPTIME': 30, 'OBJECT': 'M31'})
+    assert TEST_BASE_FILENAME in matching_base_filenames(equals={'FOCUS': 10234})
+    assert TEST_BASE_FILENAME not in matching_base_filenames(equals={'EXPTIME': 60})
+
+
+def test_query_image_pkgs_matches_get_image_pkg(setup_teardown):
+    header = {
+        "CRVAL1": 12.34,
+        "CRVAL2": 56.78,
+        "DATE-OBS": '2021-01-01T12:34:54'
+    }
+    update_header_data(DB_ADDRESS, TEST_BASE_FILENAME, 'EX', header)
+    update_new_image(DB_ADDRESS, TEST_BASE_FILENAME, 'EX', '10', 'jpg')
+
+    packages = query_image_pkgs(DB_ADDRESS, Image.base_filename == TEST_BASE_FILENAME)
+    assert len(packages) == 1
+    with get_session(db_address=DB_ADDRESS) as session:
+        image = session.query(Image).filter(Image.base_filename == TEST_BASE_FILENAME).one()
+        assert packages[0] == image.get_image_pkg()
+    assert packages[0]["jpg_url"] != ""
+    assert packages[0]["jpg_thumbnail_url"] == ""
+    assert packages[0]["jpg_rendition_urls"] == {}
+
+
+def test_image_pkg_includes_rendition_urls(setup_teardown):
+    upsert_image(DB_ADDRESS, TEST_BASE_FILENAME, {"data_type": "EX", "jpg_renditions": [64, 256]})
+
+    package = query_image_pkgs(DB_ADDRESS, Image.base_filename == TEST_BASE_FILENAME)[0]
+    assert sorted(package["jpg_rendition_urls"]) == [64, 256]
+    assert f"renditions/{TEST_BASE_FILENAME}-EX10-h256.jpg" in package["jpg_rendition_urls"][256]
+
+
+#def test_update_header_data():
     #pass
@@ -0,0 +1,35 @@
+from lambda_service.db import get_engine, dispose_engines
+from lambda_service.db import DB_MAX_OVERFLOW, DB_POOL_SIZE
+from lambda_service.stages import STAGE_MAX_WORKERS
+
+
+def test_get_engine_is_cached():
+    db_address = 'sqlite://'
+    engine = get_engine(db_address)
+    assert get_engine(db_address) is engine
+
+    # A disposed engine is replaced on the next request
+    dispose_engines(db_address)
+    assert get_engine(db_address) is not engine
+    dispose_engines(db_address)
+
+
+def test_get_engine_disposes_engine_for_previous_url():
+    # eg. after the db-url parameter is refreshed with rotated credentials
+    old_engine = get_engine('sqlite:///file:old?mode=memory&uri=true')
+    old_engine.connect().close()  # leave a connection in the pool
+    assert old_engine.pool.checkedin() == 1
+
+    new_engine = get_engine('sqlite:///file:new?mode=memory&uri=true')
+    assert new_engine is not old_engine
+    assert old_engine.pool.checkedin() == 0
+    assert get_engine('sqlite:///file:new?mode=memory&uri=true') is new_engine
+    dispose_engines()
+
+
+def test_pool_covers_every_stage():
+    # Stages run on a thread pool, so each of them may need its own connection at the same time
+    engine = get_engine('sqlite:///file:pool?mode=memory&uri=true')
+    assert engine.pool.size() == DB_POOL_SIZE
+    assert DB_POOL_SIZE + DB_MAX_OVERFLOW >= STAGE_MAX_WORKERS
+    dispose_engines()
@@ -0,0 +1,62 @@
+import logging
+
+import pytest
+from sqlalchemy import text
+
+from lambda_service.db import get_engine, dispose_engines
+from lambda_service.db_profiling import count_statements
+from lambda_service.db_profiling import redact_parameters
+from lambda_service.tests.testutils import assert_max_statements
+
+DB_ADDRESS = 'sqlite://'
+
+
+@pytest.fixture
+def engine():
+    engine = get_engine(DB_ADDRESS)
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE images (base_filename TEXT, site TEXT)"))
+    yield engine
+    dispose_engines(DB_ADDRESS)
+
+
+def insert_image(engine, base_filename):
+    with engine.begin() as connection:
+        connection.execute(text("INSERT INTO images VALUES (:base_filename, :site)"),
+                           {"base_filename": base_filename, "site": "tst"})
+
+
+def test_count_statements(engine):
+    with count_statements(engine) as profile:
+        insert_image(engine, 'tst-aa00-20201231-00000001')
+        insert_image(engine, 'tst-aa00-20201231-00000002')
+    assert profile.statements == 2
+    assert profile.checkouts == 2
+    assert len(profile.durations_ms) == 2
+
+    # The listeners are removed after the block
+    insert_image(engine, 'tst-aa00-20201231-00000003')
+    assert profile.statements == 2
+
+
+def test_slow_queries_are_logged_without_their_parameters(engine, caplog):
+    with caplog.at_level(logging.WARNING, logger='lambda_service.db_profiling'):
+        with count_statements(engine, slow_query_ms=0):
+            insert_image(engine, 'tst-aa00-20201231-00000001')
+    assert "INSERT INTO images" in caplog.text
+    assert "tst-aa00-20201231-00000001" not in caplog.text
+    assert "<str>" in caplog.text
+
+
+def test_redact_parameters():
+    assert redact_parameters({"site": "tst", "exptime": 1.5}) == {"site": "<str>", "exptime": "<float>"}
+    assert redact_parameters([("tst", 1), ("wmd", None)]) == [("<str>", "<int>"), ("<str>", "<NoneType>")]
+
+
+def test_assert_max_statements(engine):
+    with assert_max_statements(1, DB_ADDRESS):
+        insert_image(engine, 'tst-aa00-20201231-00000001')
+    with pytest.raises(AssertionError):
+        with assert_max_statements(1, DB_ADDRESS):
+            insert_image(engine, 'tst-aa00-20201231-00000002')
+            insert_image(engine, 'tst-aa00-20201231-00000003')
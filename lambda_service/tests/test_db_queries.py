@@ -0,0 +1,9 @@
+from lambda_service.db import header_equals_criteria
+
+
+def test_header_equals_criteria_groups_non_numeric_values():
+    criteria = header_equals_criteria({'OBJECT': 'M31', 'EXPTIME': 30, 'IMAGETYP': 'Light Frame', 'FLIP': True})
+    # One containment test for the strings and booleans, one typed-or-text test for the number
+    assert len(criteria) == 2
+    assert criteria[0].right.value == {'OBJECT': 'M31', 'IMAGETYP': 'Light Frame', 'FLIP': True}
+    assert 'jsonb_typeof' in str(criteria[1])
@@ -1,9 +1,12 @@
 import pytest
 
+from lambda_service import expirations
+
 from lambda_service.expirations import add_expiration_entry
 from lambda_service.expirations import remove_expired_data_handler
 from lambda_service.expirations import data_type_has_expiration
 from lambda_service.expirations import get_image_lifespan
+from lambda_service.expirations import get_expired_base_filenames
 
 
 def test_data_type_has_expiration():
@@ -43,3 +46,40 @@ def test_get_image_lifespan_good():
     assert not errors, "errors occured:\n{}".format("\n".join(errors))
 
 
+def expiration_record(event_name, base_filename, s3_directory='data'):
+    image = {"pk": {"S": base_filename}, "s3_directory": {"S": s3_directory}}
+    return {"eventName": event_name, "dynamodb": {"Keys": {"pk": image["pk"]}, "OldImage": image}}
+
+
+def test_get_expired_base_filenames():
+    records = [
+        expiration_record("REMOVE", 'tst-aa00-20201231-00000001'),
+        expiration_record("INSERT", 'tst-aa00-20201231-00000002'),
+        expiration_record("REMOVE", 'tst-aa00-20201231-00000003', 'info-images'),
+        expiration_record("REMOVE", 'tst-aa00-20201231-00000004'),
+        expiration_record("REMOVE", 'tst-aa00-20201231-00000001'),
+    ]
+    assert get_expired_base_filenames(records) == {
+        'data': ['tst-aa00-20201231-00000001', 'tst-aa00-20201231-00000004'],
+        'info-images': ['tst-aa00-20201231-00000003'],
+    }
+
+
+class RecordingTable:
+    """ Stands in for the expiration table, recording the entries written to it. """
+    def __init__(self):
+        self.items = []
+
+    def put_item(self, Item, ConditionExpression):
+        self.items.append(Item)
+
+
+def test_add_expiration_entry_writes_once_per_exposure(monkeypatch):
+    table = RecordingTable()
+    monkeypatch.setattr(expirations, 'get_expiration_table', lambda: table)
+    monkeypatch.setattr(expirations, '_registered_expirations', expirations.TTLCache(maxsize=10, ttl_s=60))
+
+    assert add_expiration_entry('tst-aa00-20201231-00000001', 300)
+    assert not add_expiration_entry('tst-aa00-20201231-00000001', 300)
+    assert add_expiration_entry('tst-aa00-20201231-00000001', 300, s3_directory='info-images')
+    assert [item['pk'] for item in table.items] == ['tst-aa00-20201231-00000001'] * 2
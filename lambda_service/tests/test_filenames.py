@@ -0,0 +1,58 @@
+import pytest
+
+from lambda_service.filenames import FileKey, InvalidFilename, is_valid_base_filename
+
+
+def test_file_key_parse():
+    file_key = FileKey.parse('wmd-ea03-20190621-00000007-EX00.fits.bz2')
+    assert file_key.site == 'wmd'
+    assert file_key.instrument == 'ea03'
+    assert file_key.file_date == '20190621'
+    assert file_key.file_counter == '00000007'
+    assert file_key.data_type == 'EX'
+    assert file_key.reduction_level == '00'
+    assert file_key.extension == 'fits'
+    assert file_key.compression == 'bz2'
+    assert file_key.base_filename == 'wmd-ea03-20190621-00000007'
+    assert file_key.filename == 'wmd-ea03-20190621-00000007-EX00.fits.bz2'
+
+
+def test_file_key_parse_uncompressed():
+    file_key = FileKey.parse('wmd02-ea03-20190621-00000007-EX10.jpg')
+    assert file_key.site == 'wmd02'
+    assert file_key.extension == 'jpg'
+    assert file_key.compression is None
+
+
+def test_file_key_parse_is_cached():
+    assert FileKey.parse('tst-aa00-20201231-12345678-EX01.txt') is FileKey.parse('tst-aa00-20201231-12345678-EX01.txt')
+
+
+def test_file_key_is_immutable():
+    file_key = FileKey.parse('tst-aa00-20201231-12345678-EX01.txt')
+    with pytest.raises(AttributeError):
+        file_key.site = 'wmd'
+    with pytest.raises(AttributeError):
+        file_key.other = 1
+
+
+@pytest.mark.parametrize('filename', [
+    'bad_filename',
+    'tst-aa00-20201231-12345678',           # no data type or extension
+    'tst-aa00-20201231-12345678-EX01',      # no extension
+    'tst-aa00-20201231-12345678-EX001.txt', # three digit reduction level
+    'tst-aa00-2020123-12345678-EX01.txt',   # seven digit date
+    'tstsite1-aa00-20201231-12345678-EX01.txt',  # site too long
+    'tst-aa00-20201231-12345678-01.txt',    # no data type
+])
+def test_file_key_parse_invalid(filename):
+    with pytest.raises(InvalidFilename):
+        FileKey.parse(filename)
+    with pytest.raises(AssertionError):
+        FileKey.parse(filename)
+
+
+def test_is_valid_base_filename():
+    assert is_valid_base_filename('tst-aa00-20201231-12345678')
+    assert not is_valid_base_filename('tst-aa00-20201231-1234567')
+    assert not is_valid_base_filename('tst-aa00-20201231-12345678-EX01.txt')
@@ -0,0 +1,112 @@
+import glob
+import pytest
+
+from lambda_service.fits_header import parse_header
+from lambda_service.fits_header import parse_headers
+from lambda_service.fits_header import convert_value
+
+HEADER_CORPUS = sorted(glob.glob('lambda_service/tests/testing_data/headers/*.txt'))
+
+
+def make_header(*cards):
+    """ Build header bytes from card strings, padding each card to 80 characters. """
+    return ''.join(card.ljust(80) for card in cards).encode('latin-1')
+
+
+def test_parse_header_values_and_comments():
+    header = parse_header(make_header(
+        "SIMPLE  =                    T / conforms to FITS standard",
+        "NAXIS1  =                 4800",
+        "EXPTIME =               30.000 / [s] exposure length",
+        "FILTER  = 'PL      '           / Filter type",
+        "END",
+    ))
+    assert header == {'SIMPLE': True, 'NAXIS1': 4800, 'EXPTIME': 30.0, 'FILTER': 'PL'}
+
+
+def test_parse_header_quoted_strings():
+    header = parse_header(make_header(
+        "OBJECT  = 'NGC 2392 / Eskimo'  / comment with a 'quote'",
+        "USERNAME= 'Jane O''Hara'",
+        "EMPTY   = ''",
+        "END",
+    ))
+    assert header['OBJECT'] == 'NGC 2392 / Eskimo'
+    assert header['USERNAME'] == "Jane O'Hara"
+    assert header['EMPTY'] == ''
+
+
+def test_parse_header_continue_cards():
+    header = parse_header(make_header(
+        "PLANNOTE= 'Part of a long &'",
+        "CONTINUE  'running campaign &'",
+        "CONTINUE  'ending here.'     / comment",
+        "NEXTKEY = 1",
+        "END",
+    ))
+    assert header['PLANNOTE'] == 'Part of a long running campaign ending here.'
+    assert header['NEXTKEY'] == 1
+
+
+def test_parse_header_commentary_cards():
+    header = parse_header(make_header(
+        "HISTORY Calibrated with bias/dark/flat frames",
+        "HISTORY Stacked = 3 frames",
+        "COMMENT   indented comment",
+        "",
+        "END",
+    ))
+    assert header['HISTORY'] == ['Calibrated with bias/dark/flat frames', 'Stacked = 3 frames']
+    assert header['COMMENT'] == ['  indented comment']
+    assert '' not in header
+
+
+def test_parse_header_stops_at_end():
+    header = parse_header(make_header(
+        "NAXIS   =                    0",
+        "END",
+        "AFTER   =                    1",
+    ))
+    assert 'AFTER' not in header
+
+
+def test_convert_value():
+    assert convert_value('T') is True
+    assert convert_value('F') is False
+    assert convert_value('') is None
+    assert convert_value('-42') == -42 and isinstance(convert_value('-42'), int)
+    assert convert_value('1.5') == 1.5
+    assert convert_value('.5E-3') == 0.0005
+    assert convert_value('1.5D2') == 150.0
+    assert convert_value('1E999') == '1E999'
+    assert convert_value('(1.0, 2.0)') == '(1.0, 2.0)'
+
+
+def test_parse_header_typed_values():
+    header = parse_header(make_header(
+        "BITPIX  =                   16",
+        "AIRMASS =               1.2345 / airmass",
+        "TDOUBLE =              1.5D-10",
+        "SMARTSTK=                    F",
+        "UNDEFKEY=                      / undefined",
+        "FOCUS   = '10234   '",
+        "END",
+    ))
+    assert header == {
+        'BITPIX': 16,
+        'AIRMASS': 1.2345,
+        'TDOUBLE': 1.5e-10,
+        'SMARTSTK': False,
+        'UNDEFKEY': None,
+        'FOCUS': '10234',
+    }
+
+
+def test_parse_headers_matches_parse_header():
+    buffers = []
+    for path in HEADER_CORPUS:
+        with open(path, 'rb') as f:
+            buffers.append(f.read())
+    # include an unpadded header with no END card
+    buffers.append(make_header("NAXIS   =                    0")[:-5])
+    assert parse_headers(buffers) == [parse_header(b) for b in buffers]
@@ -1,5 +1,10 @@
+import bz2
+import io
+import os
+
 import pytest
 
+from lambda_service import helpers
 from lambda_service.helpers import parse_file_key
 from lambda_service.helpers import validate_filename
 from lambda_service.helpers import validate_base_filename
@@ -8,6 +13,16 @@ from lambda_service.helpers import get_site_from_filename
 from lambda_service.helpers import get_base_filename_from_full_filename
 from lambda_service.helpers import isodate_to_timestamp
 from lambda_service.helpers import timestamp_to_isodate_utc
+from lambda_service.helpers import find_fits_header_end
+from lambda_service.helpers import parse_header_bytes
+from lambda_service.helpers import get_header_sidecar_key
+from lambda_service.helpers import get_s3_file_url
+from lambda_service.helpers import get_s3_file_urls
+from lambda_service.helpers import get_s3_prefixes_for_base_filename
+from lambda_service.helpers import read_fits_header_bytes
+from lambda_service.helpers import get_header_from_fits
+
+TEST_FITS_PATH = 'lambda_service/tests/testing_data/testdata.fits'
 
 def test_parse_file_key_good_fits():
     file_key = 'wmd-ea03-20190621-00000007-EX00.fits.bz2'
@@ -114,4 +129,161 @@ def test_isodate_to_timestamp_and_back():
 def test_timestamp_to_isodate_and_back():
     timestamp = 1642542786.453328
     assert isodate_to_timestamp(timestamp_to_isodate_utc(timestamp)) == timestamp
-    
\ No newline at end of file
+
+def test_find_fits_header_end():
+    with open(TEST_FITS_PATH, 'rb') as f:
+        contents = f.read()
+    end = find_fits_header_end(contents)
+    assert end % 80 == 0
+    assert contents[end-80:end].startswith(b'END')
+    assert find_fits_header_end(contents[:end-80]) is None
+
+def test_parse_header_bytes_from_fits():
+    with open(TEST_FITS_PATH, 'rb') as f:
+        contents = f.read()
+    header = parse_header_bytes(contents[:find_fits_header_end(contents)])
+    assert header['NAXIS1'] == 4
+    assert 'JSON' in header
+
+def test_get_header_sidecar_key():
+    key = 'data/wmd-ea03-20190621-00000007-EX10.fits.bz2'
+    assert get_header_sidecar_key(key) == 'headers/wmd-ea03-20190621-00000007-EX10.txt'
+
+def test_header_sidecar_does_not_trigger_the_data_handler():
+    # The insert_data handler is notified of every object under data/ (see serverless.yml)
+    sidecar_key = get_header_sidecar_key('data/wmd-ea03-20190621-00000007-EX10.fits.bz2')
+    assert not sidecar_key.startswith('data/')
+
+def test_get_s3_file_urls_reuses_urls():
+    paths = ['data/tst-aa00-20201231-12345678-EX10.jpg', 'data/tst-aa00-20201231-12345678-EX11.jpg']
+    urls = get_s3_file_urls(paths)
+    assert set(urls) == set(paths)
+    assert get_s3_file_url(paths[0]) == urls[paths[0]]
+
+def test_get_s3_prefixes_for_base_filename():
+    assert get_s3_prefixes_for_base_filename('tst-aa00-20201231-12345678') == [
+        'data/tst-aa00-20201231-12345678-', 'renditions/tst-aa00-20201231-12345678-',
+        'headers/tst-aa00-20201231-12345678-',
+    ]
+    assert get_s3_prefixes_for_base_filename('tst-aa00-20201231-12345678', 'info-images') == [
+        'info-images/tst-aa00-20201231-12345678-'
+    ]
+    with pytest.raises(AssertionError):
+        get_s3_prefixes_for_base_filename('tst-aa00-2020')
+
+def test_isodate_to_timestamp_s3_event_time():
+    assert isodate_to_timestamp('2020-09-24T17:40:17.597Z') == 1600969217.597
+
+def make_fits(n_cards, data_bytes=0, end=True):
+    """ The bytes of a fits file whose header has n_cards cards (plus END), padded to whole blocks. """
+    cards = [b'SIMPLE  =                    T'.ljust(80), b'NAXIS   =                    0'.ljust(80)]
+    # Random values, so compressed headers stay large
+    cards += [f"HISTORY {os.urandom(32).hex()}".encode().ljust(80) for _ in range(n_cards - len(cards))]
+    if end:
+        cards.append(b'END'.ljust(80))
+    header = b''.join(cards)
+    header += b' ' * (-len(header) % helpers.FITS_BLOCK_SIZE)
+    return header, header + os.urandom(data_bytes)
+
+class FakeS3Client:
+    """ Stands in for the s3 client, answering ranged gets like s3 and recording every request. """
+    def __init__(self, objects):
+        self.objects = objects
+        self.ranges = []
+        self.puts = {}
+
+    def get_object(self, Bucket, Key, Range):
+        start, end = (int(n) for n in Range[len('bytes='):].split('-'))
+        self.ranges.append((start, end))
+        body = self.objects[Key]
+        chunk = body[start:end + 1]
+        return {
+            'Body': io.BytesIO(chunk),
+            'ContentRange': f"bytes {start}-{start + len(chunk) - 1}/{len(body)}",
+        }
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.puts[Key] = Body
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    def use_objects(objects):
+        client = FakeS3Client(objects)
+        monkeypatch.setattr(helpers, 'get_s3_client', lambda: client)
+        return client
+    return use_objects
+
+def test_read_fits_header_in_first_range(fake_s3):
+    header, fits = make_fits(20, data_bytes=200000)
+    s3 = fake_s3({'data/a.fits': fits})
+    header_bytes = read_fits_header_bytes('bucket', 'data/a.fits')
+    assert header_bytes == header[:21 * 80]
+    assert s3.ranges == [(0, helpers.FITS_HEADER_CHUNK_BYTES - 1)]
+
+def test_read_bz2_fits_header_over_several_ranges(fake_s3):
+    header, fits = make_fits(300, data_bytes=20000)
+    s3 = fake_s3({'data/a.fits.bz2': bz2.compress(fits)})
+    header_bytes = read_fits_header_bytes('bucket', 'data/a.fits.bz2', chunk_size=1024)
+    assert header_bytes == header[:301 * 80]
+    # Each range is twice the size of the one before
+    assert len(s3.ranges) > 2
+    assert [end - start + 1 for start, end in s3.ranges[:3]] == [1024, 2048, 4096]
+
+def test_read_fits_header_of_object_shorter_than_first_range(fake_s3):
+    header, fits = make_fits(10)
+    s3 = fake_s3({'data/a.fits': fits})
+    assert len(fits) < helpers.FITS_HEADER_CHUNK_BYTES
+    assert read_fits_header_bytes('bucket', 'data/a.fits') == header[:11 * 80]
+    assert len(s3.ranges) == 1
+
+def test_read_fits_header_without_end_card_stops_at_cap(fake_s3, monkeypatch):
+    monkeypatch.setattr(helpers, 'FITS_HEADER_MAX_BYTES', 16 * 1024)
+    _, fits = make_fits(2000, end=False)
+    s3 = fake_s3({'data/a.fits': fits})
+    with pytest.raises(ValueError):
+        read_fits_header_bytes('bucket', 'data/a.fits', chunk_size=4096)
+    assert s3.ranges[-1][1] < 2 * helpers.FITS_HEADER_MAX_BYTES
+    assert s3.ranges[-1][1] < len(fits) - 1
+
+def test_get_header_from_fits_writes_sidecar(fake_s3):
+    header, fits = make_fits(20, data_bytes=10000)
+    s3 = fake_s3({'data/tst-aa00-20201231-12345678-EX10.fits.bz2': bz2.compress(fits)})
+    parsed = get_header_from_fits('bucket', 'data/tst-aa00-20201231-12345678-EX10.fits.bz2')
+    assert parsed['SIMPLE'] is True
+    assert list(s3.puts) == ['headers/tst-aa00-20201231-12345678-EX10.txt']
+    sidecar = s3.puts['headers/tst-aa00-20201231-12345678-EX10.txt']
+    assert len(sidecar) % helpers.FITS_BLOCK_SIZE == 0
+    assert sidecar == header
+
+
+def test_put_object_sends_if_none_match():
+    import boto3
+    from botocore.awsrequest import AWSResponse
+    from botocore.exceptions import ClientError
+
+    class Raw:
+        def stream(self, **kwargs):
+            yield b'<Error><Code>PreconditionFailed</Code><Message>At least one of the pre-conditions you specified'\
+                  b' did not hold</Message></Error>'
+
+    sent = []
+
+    def send(request, **kwargs):
+        sent.append(request)
+        return AWSResponse(request.url, 412, {}, Raw())
+
+    client = boto3.client('s3', region_name='us-east-1', aws_access_key_id='test', aws_secret_access_key='test')
+    helpers.add_if_none_match_support(client)
+    client.meta.events.register('before-send.s3.PutObject', send)
+
+    with pytest.raises(ClientError) as e:
+        client.put_object(Bucket='photonranch-001', Key='data/tst-aa00-20201231-00000001-EX10.jpg', Body=b'jpg',
+                          IfNoneMatch='*')
+    assert e.value.response['Error']['Code'] == 'PreconditionFailed'
+    assert sent[0].headers['If-None-Match'] == b'*'
+
+    # Other writes are unconditional
+    sent.clear()
+    with pytest.raises(ClientError):
+        client.put_object(Bucket='photonranch-001', Key='data/tst-aa00-20201231-00000001-EX10.jpg', Body=b'jpg')
+    assert 'If-None-Match' not in sent[0].headers
@@ -0,0 +1,108 @@
+import pytest
+from botocore.exceptions import ClientError
+
+from lambda_service import idempotency
+from lambda_service.cache import TTLCache
+from lambda_service.idempotency import claim, complete, release, get_record_id
+from lambda_service.idempotency import RecordInProgress
+
+
+def s3_record(key, etag='268182655972e76fefb712c5585993e8', sequencer='005F6CDA04CBC98813'):
+    return {'s3': {'bucket': {'name': 'photonranch-001'}, 'object': {'key': key, 'eTag': etag, 'sequencer': sequencer}}}
+
+
+class FakeIdempotencyTable:
+    """ Stands in for the idempotency table, evaluating the claim condition. """
+    def __init__(self):
+        self.items = {}
+        self.requests = 0
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None):
+        self.requests += 1
+        existing = self.items.get(Item['pk'])
+        if ConditionExpression and existing and existing['claimed_until'] >= ExpressionAttributeValues[':now']:
+            raise ClientError({"Error": {"Code": "ConditionalCheckFailedException", "Message": ""}}, "PutItem")
+        self.items[Item['pk']] = Item
+
+    def get_item(self, Key, ConsistentRead=False):
+        self.requests += 1
+        item = self.items.get(Key['pk'])
+        return {} if item is None else {'Item': dict(item)}
+
+    def delete_item(self, Key):
+        self.requests += 1
+        self.items.pop(Key['pk'], None)
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeIdempotencyTable()
+    monkeypatch.setattr(idempotency, 'get_idempotency_table', lambda: table)
+    monkeypatch.setattr(idempotency, '_completed', TTLCache(maxsize=10, ttl_s=60))
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_ENABLED', True)
+    return table
+
+
+def test_get_record_id():
+    key = 'data/tst-aa00-20201231-00000001-EX10.jpg'
+    record_id = get_record_id(s3_record(key))
+    assert record_id == f'photonranch-001/{key}#268182655972e76fefb712c5585993e8#005F6CDA04CBC98813'
+    # Uploading the object again is a new event
+    assert get_record_id(s3_record(key, sequencer='005F6CDA04CBC98900')) != record_id
+
+
+def test_completed_record_is_skipped(table):
+    record_id = get_record_id(s3_record('data/tst-aa00-20201231-00000001-EX10.jpg'))
+    assert claim(record_id)
+    with pytest.raises(RecordInProgress):
+        claim(record_id)  # claimed by another invocation that hasn't finished
+    complete([record_id])
+
+    requests = table.requests
+    assert not claim(record_id)
+    assert table.requests == requests  # known from memory
+
+    idempotency._completed.clear()
+    assert not claim(record_id)  # known from the table
+
+
+def test_released_record_can_be_claimed_again(table):
+    record_id = get_record_id(s3_record('data/tst-aa00-20201231-00000001-EX10.jpg'))
+    assert claim(record_id)
+    release(record_id)
+    assert claim(record_id)
+
+
+def test_expired_claim_can_be_claimed_again(table, monkeypatch):
+    record_id = get_record_id(s3_record('data/tst-aa00-20201231-00000001-EX10.jpg'))
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_LEASE_S', -1)
+    assert claim(record_id)
+    assert claim(record_id)
+
+
+def test_lease_outlasts_the_ingest_timeout_and_visibility_window():
+    assert idempotency.IDEMPOTENCY_LEASE_S > (
+        idempotency.INGEST_TIMEOUT_S + idempotency.INGEST_QUEUE_VISIBILITY_TIMEOUT_S
+    )
+
+
+def test_s3_lease_outlasts_the_ingest_timeout_but_not_the_async_retries():
+    assert idempotency.INGEST_TIMEOUT_S < idempotency.IDEMPOTENCY_S3_LEASE_S < idempotency.IDEMPOTENCY_LEASE_S
+    # lambda retries a failed async invocation about 1 and 3 minutes after it ends
+    assert idempotency.IDEMPOTENCY_S3_LEASE_S < idempotency.INGEST_TIMEOUT_S + 180
+
+
+def test_claim_uses_the_given_lease(table, monkeypatch):
+    record_id = get_record_id(s3_record('data/tst-aa00-20201231-00000001-EX10.jpg'))
+    monkeypatch.setattr(idempotency.time, 'time', lambda: 1000)
+    assert claim(record_id, lease_s=120)
+    assert table.items[record_id]['claimed_until'] == 1120
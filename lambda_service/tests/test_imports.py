@@ -0,0 +1,60 @@
+""" Guard the cold start time of the lambda handlers.
+
+Each handler module is imported in a fresh interpreter with `python -X importtime`, without any AWS credentials.
+The import must not load the heavy libraries that only some events need, and must not call AWS (which would fail
+without credentials). Run with -s to see the slowest imports.
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+HANDLER_MODULES = [
+    'lambda_service.insert_data',
+    'lambda_service.info_images',
+    'lambda_service.expirations',
+]
+
+# Libraries that must only be imported when they're used
+LAZY_MODULES = ['PIL', 'numpy', 'astropy', 'requests']
+
+REPORT_LENGTH = 10
+
+
+def import_times(module):
+    """ Import a module in a new interpreter and return {module name: cumulative import time in microseconds}. """
+    env = dict(os.environ)
+    for key in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN', 'AWS_PROFILE']:
+        env.pop(key, None)
+    env.update({
+        'AWS_CONFIG_FILE': os.devnull,
+        'AWS_SHARED_CREDENTIALS_FILE': os.devnull,
+        'AWS_EC2_METADATA_DISABLED': 'true',
+    })
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+    )
+    assert result.returncode == 0, f"Importing {module} failed:\n{result.stderr[-2000:]}"
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize('module', HANDLER_MODULES)
+def test_handler_import_is_lazy(module):
+    times = import_times(module)
+
+    print(f"\n{module}: {times[module] / 1000:.0f} ms")
+    slowest = sorted(times.items(), key=lambda item: item[1], reverse=True)[:REPORT_LENGTH]
+    for name, cumulative in slowest:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    loaded = sorted({name for name in times if name.split('.')[0] in LAZY_MODULES})
+    assert not loaded, f"{module} imports {loaded} at import time"
@@ -0,0 +1,93 @@
+import pytest
+from botocore.exceptions import ClientError
+
+from lambda_service import info_images
+from lambda_service.cache import TTLCache
+from lambda_service.info_images import find_info_channel
+from lambda_service.info_images import get_site_metadata
+from lambda_service.info_images import save_info_image
+
+TEST_BASE_FILENAME = "test-ptrdata-20200101-01234567"
+OLD_BASE_FILENAME = "test-ptrdata-20200101-01234566"
+
+
+def conditional_check_failed():
+    return ClientError({"Error": {"Code": "ConditionalCheckFailedException", "Message": ""}}, "PutItem")
+
+
+class FakeInfoTable:
+    """ Stands in for the info-images table, evaluating the conditions used by save_info_image. """
+    def __init__(self, items=None):
+        self.items = {item['pk']: dict(item) for item in items or []}
+        self.requests = []
+
+    def get_item(self, Key):
+        self.requests.append('get_item')
+        item = self.items.get(Key['pk'])
+        return {} if item is None else {'Item': dict(item)}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues):
+        self.requests.append('update_item')
+        item = self.items.get(Key['pk'])
+        if item is None or item.get('base_filename') != ExpressionAttributeValues[':bf']:
+            raise conditional_check_failed()
+        for assignment in UpdateExpression[len("set "):].split(", "):
+            name, value = assignment.split("=")
+            item[ExpressionAttributeNames[name]] = ExpressionAttributeValues[value]
+
+    def put_item(self, Item, ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        self.requests.append('put_item')
+        item = self.items.get(Item['pk'])
+        if item is not None and item.get('base_filename') == ExpressionAttributeValues[':bf']:
+            raise conditional_check_failed()
+        self.items[Item['pk']] = dict(Item)
+
+
+@pytest.fixture
+def info_table(monkeypatch):
+    table = FakeInfoTable([{'pk': 'test#metadata', 'channel1': OLD_BASE_FILENAME, 'channel2': TEST_BASE_FILENAME}])
+    monkeypatch.setattr(info_images, 'get_info_table', lambda: table)
+    monkeypatch.setattr(info_images, '_site_metadata', TTLCache(maxsize=10, ttl_s=60))
+    monkeypatch.setattr(info_images, '_info_channels', TTLCache(maxsize=10, ttl_s=60))
+    return table
+
+
+def test_find_info_channel_uses_cached_metadata(info_table):
+    assert find_info_channel('test', TEST_BASE_FILENAME) == 2
+    assert find_info_channel('test', OLD_BASE_FILENAME) == 1
+    assert info_table.requests == ['get_item']
+
+
+def test_find_info_channel_refreshes_on_miss(info_table):
+    assert get_site_metadata('test')['channel1'] == OLD_BASE_FILENAME
+    info_table.items['test#metadata']['channel1'] = "test-ptrdata-20200101-01234568"
+    assert find_info_channel('test', "test-ptrdata-20200101-01234568") == 1
+    assert find_info_channel('test', "test-ptrdata-20200101-01234569") is None
+    assert find_info_channel('missing_site', TEST_BASE_FILENAME) is None
+
+
+def test_save_info_image_replaces_older_image(info_table):
+    info_table.items['test#2'] = {'pk': 'test#2', 'base_filename': OLD_BASE_FILENAME, 'fits_10_exists': True}
+
+    assert save_info_image('test#2', {'base_filename': TEST_BASE_FILENAME, 'jpg_small_exists': True})
+    assert info_table.items['test#2'] == {'pk': 'test#2', 'base_filename': TEST_BASE_FILENAME, 'jpg_small_exists': True}
+
+    # Later files of the same image are added with a single update
+    info_table.requests.clear()
+    assert save_info_image('test#2', {'base_filename': TEST_BASE_FILENAME, 'header': {'EXPTIME': 1}})
+    assert info_table.requests == ['update_item']
+    assert info_table.items['test#2']['jpg_small_exists']
+    assert info_table.items['test#2']['header'] == {'EXPTIME': 1}
+
+
+def test_save_info_image_skips_image_moved_out_of_channel(info_table):
+    # The cached metadata still says channel 1 holds the old image, but the site has since put a newer one there
+    assert find_info_channel('test', OLD_BASE_FILENAME) == 1
+    info_table.items['test#metadata']['channel1'] = TEST_BASE_FILENAME
+    info_table.items['test#1'] = {'pk': 'test#1', 'base_filename': TEST_BASE_FILENAME, 'jpg_small_exists': True}
+
+    # A late file of the old image must not replace the newer one
+    assert find_info_channel('test', OLD_BASE_FILENAME) == 1
+    assert not save_info_image('test#1', {'base_filename': OLD_BASE_FILENAME, 'fits_10_exists': True})
+    assert info_table.items['test#1']['base_filename'] == TEST_BASE_FILENAME
@@ -1,12 +1,16 @@
 import pytest
 import boto3
 import os
+import json
 import time
 
+from lambda_service import idempotency
+from lambda_service import insert_data
 from lambda_service.db import get_session
 from lambda_service.db import Image
 from lambda_service.db import DB_ADDRESS
 from lambda_service.insert_data import handle_s3_object_created
+from lambda_service.insert_data import handle_sqs_batch
 
 from lambda_service.tests.testutils import make_data_files
 from lambda_service.tests.testutils import get_upload_url
@@ -72,6 +76,11 @@ def clear_db_entries_for_each_test():
     delete_test_entries(TEST_BASE_FILENAME)
     yield
     delete_test_entries(TEST_BASE_FILENAME)
+
+@pytest.fixture(autouse=True)
+def process_redelivered_events(monkeypatch):
+    # These tests replay the same events against a cleared database, so they must not be skipped as duplicates
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_ENABLED', False)
     
 def add_01fits():
     #s3_event_ex01_fits = get_s3_event()
@@ -128,3 +137,70 @@ def test_handle_s3_object_created_all_files():
             .filter(Image.base_filename==TEST_BASE_FILENAME)\
             .one()
         assert entry.fits_10_exists and entry.header
+
+def test_handle_s3_object_created_batch():
+    batch_event = {'Records': [
+        *s3_event_fits_header['Records'],
+        *s3_event_ex10_jpg['Records'],
+        *s3_event_ex10_fits['Records'],
+    ]}
+    response = handle_s3_object_created(batch_event, {})
+    assert [r['status'] for r in response['records']] == ['ok', 'ok', 'ok']
+    with get_session(db_address=DB_ADDRESS) as session:
+        entry = session.query(Image)\
+            .filter(Image.base_filename==TEST_BASE_FILENAME)\
+            .one()
+        assert entry.header and entry.jpg_medium_exists and entry.fits_10_exists
+
+
+def test_handle_sqs_batch():
+    sqs_event = {'Records': [
+        {'messageId': 'header-message', 'body': json.dumps(s3_event_fits_header)},
+        {'messageId': 'jpg-message', 'body': json.dumps(s3_event_ex10_jpg)},
+        {'messageId': 'test-message', 'body': json.dumps({'Event': 's3:TestEvent'})},
+    ]}
+    response = handle_sqs_batch(sqs_event, {})
+    assert response['batchItemFailures'] == []
+    with get_session(db_address=DB_ADDRESS) as session:
+        entry = session.query(Image)\
+            .filter(Image.base_filename==TEST_BASE_FILENAME)\
+            .one()
+        assert entry.header and entry.jpg_medium_exists
+
+
+def test_malformed_header_still_saves_file_flags(monkeypatch):
+    # The header has no coordinates, so db.get_header_updates raises MissingFitsHeaderKey
+    monkeypatch.setattr(insert_data, 'scan_header_file', lambda bucket, path: {'EXPTIME': 30.0, 'JSON': '{}'})
+    batch_event = {'Records': s3_event_fits_header['Records'] + s3_event_ex10_jpg['Records']}
+    response = handle_s3_object_created(batch_event, {})
+    assert [r['status'] for r in response['records']] == ['ok', 'ok']
+    with get_session(db_address=DB_ADDRESS) as session:
+        entry = session.query(Image)\
+            .filter(Image.base_filename==TEST_BASE_FILENAME)\
+            .one()
+        assert entry.jpg_medium_exists
+        assert entry.header is None
+
+
+def test_handle_s3_object_created_skips_redelivered_event(monkeypatch):
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_ENABLED', True)
+    event = json.loads(json.dumps(s3_event_ex10_jpg))
+    event['Records'][0]['s3']['object']['sequencer'] = f"{time.time_ns():018X}"  # a new upload each test run
+
+    assert [r['status'] for r in handle_s3_object_created(event, {})['records']] == ['ok']
+    delete_test_entries(TEST_BASE_FILENAME)
+    assert [r['status'] for r in handle_s3_object_created(event, {})['records']] == ['skipped']
+    with get_session(db_address=DB_ADDRESS) as session:
+        assert session.query(Image).filter(Image.base_filename==TEST_BASE_FILENAME).count() == 0
+
+
+def test_record_claimed_by_unfinished_invocation_is_retried(monkeypatch):
+    def claim_in_progress(record_id, lease_s=None):
+        raise idempotency.RecordInProgress(record_id)
+    released = []
+    monkeypatch.setattr(idempotency, 'claim', claim_in_progress)
+    monkeypatch.setattr(idempotency, 'release', released.append)
+
+    sqs_event = {'Records': [{'messageId': 'message-1', 'body': json.dumps(s3_event_ex10_jpg)}]}
+    assert handle_sqs_batch(sqs_event, {})['batchItemFailures'] == [{'itemIdentifier': 'message-1'}]
+    assert released == []  # the claim belongs to the other invocation
@@ -0,0 +1,87 @@
+import json
+
+from lambda_service.metrics import Histogram
+from lambda_service.metrics import MetricsRecorder
+
+
+def test_timed_stages_are_flushed_as_embedded_metrics():
+    lines = []
+    recorder = MetricsRecorder(namespace='ptrdata-test', emit=lines.append)
+
+    with recorder.timed('db_write', site='wmd', data_type='EX'):
+        pass
+
+    @recorder.timed('notify', site='wmd', data_type='EX')
+    def notify():
+        return 'sent'
+
+    assert notify() == 'sent'
+    with recorder.timed('parse') as timer:
+        timer.set_dimensions(site='tst', data_type='EF', extension='jpg')
+
+    documents = recorder.flush()
+    assert [json.loads(line) for line in lines] == documents
+    assert len(documents) == 2  # the sites differ, and a document holds one value per dimension
+
+    document = documents[0]
+    metric_directive = document['_aws']['CloudWatchMetrics'][0]
+    assert metric_directive['Namespace'] == 'ptrdata-test'
+    assert metric_directive['Dimensions'] == [['data_type', 'site']]
+    assert [metric['Name'] for metric in metric_directive['Metrics']] == ['db_write', 'notify']
+    assert document['site'] == 'wmd' and document['data_type'] == 'EX'
+    assert len(document['db_write']) == 1 and document['db_write'][0] >= 0
+
+    assert documents[1]['extension'] == 'jpg'
+    assert recorder.flush() == []  # nothing recorded since the last flush
+    assert recorder.histograms['parse'].count == 1
+
+
+def test_one_invocation_is_flushed_as_one_document():
+    lines = []
+    recorder = MetricsRecorder(emit=lines.append)
+    recorder.record('parse', 1.0, site='wmd', data_type='EX', extension='jpg')
+    recorder.record('db_write', 2.0, site='wmd', data_type='EX')
+    recorder.record('db_write', 3.0, site='wmd', data_type='EX')
+    recorder.record('uploads_log', 4.0)
+
+    document, = recorder.flush()
+    assert len(lines) == 1
+    directives = document['_aws']['CloudWatchMetrics']
+    assert [directive['Dimensions'] for directive in directives] == [
+        [['data_type', 'extension', 'site']], [['data_type', 'site']], [[]]
+    ]
+    assert document['parse'] == [1.0] and document['db_write'] == [2.0, 3.0] and document['uploads_log'] == [4.0]
+    assert document['site'] == 'wmd' and document['extension'] == 'jpg'
+
+
+def test_same_metric_with_other_dimensions_goes_in_another_document():
+    recorder = MetricsRecorder(emit=lambda line: None)
+    recorder.record('parse', 1.0, site='wmd', data_type='EX', extension='jpg')
+    recorder.record('parse', 2.0, site='wmd', data_type='EX', extension='fits')
+    recorder.record('db_write', 3.0, site='wmd', data_type='EX')
+    documents = recorder.flush()
+    assert [document['extension'] for document in documents] == ['jpg', 'fits']
+    assert [document['parse'] for document in documents] == [[1.0], [2.0]]
+    assert documents[0]['db_write'] == [3.0]
+
+
+def test_failed_stage_is_timed():
+    recorder = MetricsRecorder(emit=lambda line: None)
+    try:
+        with recorder.timed('thumbnail'):
+            raise ValueError
+    except ValueError:
+        pass
+    assert 'thumbnail' in recorder.flush()[0]
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    assert histogram.percentile(50) is None
+    for value in range(1, 1001):
+        histogram.add(value)
+    summary = histogram.summary()
+    assert summary['count'] == 1000
+    assert 450 <= summary['p50'] <= 550
+    assert 900 <= summary['p99'] <= 1000
+    assert summary['max'] == 1000
@@ -0,0 +1,79 @@
+import os
+import stat
+import time
+
+import pytest
+
+from lambda_service import parameter_store
+from lambda_service.cache import TTLCache
+
+
+@pytest.fixture
+def cache_file(tmp_path, monkeypatch):
+    path = str(tmp_path / 'parameters.json')
+    monkeypatch.setattr(parameter_store, 'PARAMETER_CACHE_FILE', path)
+    yield path
+    parameter_store.invalidate()
+
+
+class FakeSsmClient:
+    """ Stands in for the ssm client, counting get_parameters calls. Each call returns new values. """
+    def __init__(self):
+        self.calls = 0
+
+    def get_parameters(self, Names, WithDecryption):
+        self.calls += 1
+        return {'Parameters': [{'Name': name, 'Value': f"{name} v{self.calls}"} for name in Names]}
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_parameter_is_cached(monkeypatch):
+    ssm = FakeSsmClient()
+    clock = FakeClock()
+    monkeypatch.setattr(parameter_store, 'get_ssm_client', lambda: ssm)
+    monkeypatch.setattr(parameter_store, 'PARAMETER_CACHE_FILE', None)
+    monkeypatch.setattr(parameter_store, '_parameters',
+                        TTLCache(maxsize=10, ttl_s=parameter_store.PARAMETER_TTL_S, clock=clock))
+
+    assert parameter_store.get_parameter('db-url') == 'db-url v1'
+    assert parameter_store.get_parameter('db-url') == 'db-url v1'
+    clock.now = parameter_store.PARAMETER_TTL_S - 1
+    assert parameter_store.get_parameter('db-url') == 'db-url v1'
+    assert ssm.calls == 1
+
+    # Once the ttl has passed, the parameter is read again
+    clock.now = parameter_store.PARAMETER_TTL_S + 1
+    assert parameter_store.get_parameter('db-url') == 'db-url v2'
+    assert parameter_store.get_parameter('db-url') == 'db-url v2'
+    assert ssm.calls == 2
+
+
+def test_cache_file_round_trip(cache_file):
+    parameter_store._write_cache_file({'a': '1', 'b': '2'})
+    assert stat.S_IMODE(os.stat(cache_file).st_mode) == 0o600
+
+    cached = parameter_store._read_cache_file(['a'])
+    assert list(cached) == ['a']
+    value, expires_at = cached['a']
+    assert value == '1'
+    assert expires_at > time.time()
+
+
+def test_cache_file_is_read_before_the_parameter_store(cache_file):
+    parameter_store.invalidate()
+    parameter_store._write_cache_file({'not-in-the-parameter-store': 'cached value'})
+    assert parameter_store.get_parameter('not-in-the-parameter-store') == 'cached value'
+
+
+def test_invalidate_removes_cache_file(cache_file):
+    parameter_store._write_cache_file({'a': '1'})
+    parameter_store.invalidate('a')
+    assert not os.path.exists(cache_file)
+    assert parameter_store._read_cache_file(['a']) == {}
@@ -0,0 +1,106 @@
+import io
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from botocore.exceptions import ClientError
+from PIL import Image
+
+from lambda_service import previews
+from lambda_service.previews import block_mean
+from lambda_service.previews import open_fits_image
+from lambda_service.previews import preview_enabled
+from lambda_service.previews import preview_handler
+from lambda_service.previews import render_preview
+from lambda_service.previews import zscale
+
+
+def test_block_mean():
+    image = np.arange(36, dtype=np.int16).reshape(6, 6)
+    reduced = block_mean(image, 2, rows_per_strip=2)
+    assert reduced.shape == (3, 3)
+    assert reduced[0, 0] == np.mean([0, 1, 6, 7])
+    assert reduced[2, 2] == np.mean([28, 29, 34, 35])
+
+
+def test_zscale_ignores_outliers():
+    samples = np.random.default_rng(0).normal(1000, 10, 10000).astype(np.float32)
+    samples[:50] = 60000  # saturated stars
+    z1, z2 = zscale(samples)
+    assert 900 < z1 < 1000 < z2 < 1100
+
+
+def test_open_fits_image_and_render_preview(tmp_path):
+    data = np.random.default_rng(0).normal(1000, 20, (300, 450)).astype(np.int16)
+    path = str(tmp_path / 'test.fits')
+    fits.PrimaryHDU(data).writeto(path)
+
+    image, header = open_fits_image(path)
+    assert header['NAXIS1'] == 450
+    assert (image == data).all()
+
+    with Image.open(io.BytesIO(render_preview(image, height_px=100))) as preview:
+        assert preview.format == 'JPEG'
+        assert preview.size == (150, 100)
+
+
+class FakeS3Client:
+    """ An empty bucket, except for one fits file. A site's jpg can arrive just before the preview is written. """
+    def __init__(self, fits_bytes, jpg_uploaded_meanwhile=False):
+        self.objects = {'data/tst-aa00-20201231-00000001-EX10.fits': fits_bytes}
+        self.jpg_uploaded_meanwhile = jpg_uploaded_meanwhile
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {}
+
+    def get_object(self, Bucket, Key):
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, IfNoneMatch=None, **kwargs):
+        if self.jpg_uploaded_meanwhile:
+            self.objects[Key] = b'site jpg'
+        if IfNoneMatch == '*' and Key in self.objects:
+            raise ClientError({"Error": {"Code": "PreconditionFailed", "Message": ""}}, "PutObject")
+        self.objects[Key] = Body
+        return {'ETag': '"abc"'}
+
+
+@pytest.fixture
+def fits_bytes():
+    data = np.random.default_rng(0).normal(1000, 20, (300, 450)).astype(np.int16)
+    buffer = io.BytesIO()
+    fits.PrimaryHDU(data).writeto(buffer)
+    return buffer.getvalue()
+
+
+def make_preview(monkeypatch, s3):
+    uploaded = []
+    monkeypatch.setattr(previews, 'get_s3_client', lambda: s3)
+    monkeypatch.setattr(previews, 'upload_renditions', lambda *args: uploaded.append(args))
+    made = preview_handler('photonranch-001', 'data/tst-aa00-20201231-00000001-EX10.fits',
+                           'tst-aa00-20201231-00000001', 'EX')
+    return made, uploaded
+
+
+def test_preview_handler_writes_the_medium_jpg(monkeypatch, fits_bytes):
+    s3 = FakeS3Client(fits_bytes)
+    made, uploaded = make_preview(monkeypatch, s3)
+    assert made
+    assert s3.objects['data/tst-aa00-20201231-00000001-EX10.jpg'].startswith(b'\xff\xd8')  # a jpeg
+    assert len(uploaded) == 1
+
+
+def test_preview_handler_keeps_a_jpg_uploaded_while_rendering(monkeypatch, fits_bytes):
+    s3 = FakeS3Client(fits_bytes, jpg_uploaded_meanwhile=True)
+    made, uploaded = make_preview(monkeypatch, s3)
+    assert not made
+    assert s3.objects['data/tst-aa00-20201231-00000001-EX10.jpg'] == b'site jpg'
+    assert uploaded == []
+
+
+def test_preview_enabled_only_for_listed_sites(monkeypatch):
+    monkeypatch.setattr(previews, 'FITS_PREVIEW_SITES', {'tst'})
+    assert preview_enabled('tst')
+    assert not preview_enabled('sro')
@@ -0,0 +1,80 @@
+from lambda_service import s3_log
+from lambda_service.s3_log import add_to_recent_uploads_log
+from lambda_service.s3_log import batch_log_entries
+from lambda_service.s3_log import UploadsLogWriter
+from lambda_service.s3_log import BATCH_WRITE_MAX_ITEMS
+
+
+def log_entry(i, site='tst'):
+    return {"site": site, "upload_timestamp_s": i, "filename": f"data/tst-aa00-20201231-{i:08d}-EX10.jpg"}
+
+
+def test_batch_log_entries_by_count():
+    entries = [log_entry(i) for i in range(60)]
+    batches = batch_log_entries(entries, ("site", "upload_timestamp_s"))
+    assert [len(batch) for batch in batches] == [BATCH_WRITE_MAX_ITEMS, BATCH_WRITE_MAX_ITEMS, 10]
+    assert [e for batch in batches for e in batch] == entries
+
+
+def test_batch_log_entries_keeps_last_entry_per_key():
+    first, second = log_entry(1), dict(log_entry(1), filename="data/tst-aa00-20201231-00000001-EX00.fits.bz2")
+    assert batch_log_entries([first, log_entry(2), second], ("site", "upload_timestamp_s")) == [
+        [second, log_entry(2)]
+    ]
+
+
+class UnreliableDynamodb:
+    """ Stands in for the dynamodb resource. The first `failures` requests leave their last item unprocessed. """
+    def __init__(self, failures):
+        self.failures = failures
+        self.requests = []
+
+    def batch_write_item(self, RequestItems):
+        (table_name, put_requests), = RequestItems.items()
+        self.requests.append(put_requests)
+        if self.failures:
+            self.failures -= 1
+            return {"UnprocessedItems": {table_name: put_requests[-1:]}}
+        return {"UnprocessedItems": {}}
+
+
+class UploadsTable:
+    name = 'recent-uploads-log'
+
+
+def use_fake_dynamodb(monkeypatch, dynamodb):
+    monkeypatch.setattr(s3_log, 'get_dynamodb_resource', lambda: dynamodb)
+    monkeypatch.setattr(s3_log, 'get_recent_uploads_table', lambda: UploadsTable())
+    monkeypatch.setattr(s3_log, 'get_recent_uploads_key_names', lambda: ("site", "upload_timestamp_s"))
+    monkeypatch.setattr(s3_log, 'BATCH_WRITE_BACKOFF_S', 0)
+
+
+def test_writer_retries_unprocessed_items(monkeypatch):
+    dynamodb = UnreliableDynamodb(failures=2)
+    use_fake_dynamodb(monkeypatch, dynamodb)
+
+    writer = UploadsLogWriter()
+    for i in range(30):
+        writer.add(log_entry(i))
+    assert writer.flush() == 0
+    assert [len(r) for r in dynamodb.requests] == [25, 1, 1, 5]
+    assert writer.flush() == 0  # nothing left to write
+    assert len(dynamodb.requests) == 4
+
+
+def test_writer_gives_up_after_max_attempts(monkeypatch):
+    dynamodb = UnreliableDynamodb(failures=100)
+    use_fake_dynamodb(monkeypatch, dynamodb)
+
+    writer = UploadsLogWriter()
+    writer.add(log_entry(1))
+    assert writer.flush() == 1
+    assert len(dynamodb.requests) == s3_log.BATCH_WRITE_MAX_ATTEMPTS
+
+
+def test_add_to_recent_uploads_log_is_buffered(monkeypatch):
+    writer = UploadsLogWriter()
+    monkeypatch.setattr(s3_log, 'uploads_log_writer', writer)
+    entry = add_to_recent_uploads_log('data/tst-aa00-20201231-00000001-EX10.jpg', 1600969217.5, 1024, 'tst')
+    assert entry["upload_timestamp_s"] == 1600969217
+    assert writer._entries == [entry]
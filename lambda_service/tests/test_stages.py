@@ -0,0 +1,58 @@
+import threading
+import time
+
+import pytest
+
+from lambda_service.stages import StageError
+from lambda_service.stages import StageExecutor
+
+
+def test_independent_stages_run_concurrently():
+    barrier = threading.Barrier(3, timeout=5)  # only passes if all three stages are running at once
+    stages = StageExecutor()
+    for name in ('log', 'expiration', 'renditions'):
+        stages.add(name, barrier.wait)
+    assert set(stages.run()) == {'log', 'expiration', 'renditions'}
+
+
+def test_stages_run_after_their_dependencies():
+    order = []
+
+    def stage(name, delay_s=0):
+        time.sleep(delay_s)
+        order.append(name)
+        return name
+
+    stages = StageExecutor()
+    stages.add('header', stage, 'header', delay_s=0.05)
+    stages.add('renditions', stage, 'renditions')
+    stages.add('database', lambda: stage(f"database with {stages.result('header')}"), after=['header', 'renditions'])
+    stages.add('notify', stage, 'notify', after=['database'])
+    results = stages.run()
+
+    assert order[-2:] == ['database with header', 'notify']
+    assert results['notify'] == 'notify'
+
+
+def test_failed_stage_skips_its_dependents():
+    def fail():
+        raise ValueError("no header")
+
+    ran = []
+    stages = StageExecutor()
+    stages.add('header', fail)
+    stages.add('renditions', ran.append, 'renditions')
+    stages.add('database', ran.append, 'database', after=['header', 'renditions'])
+    stages.add('notify', ran.append, 'notify', after=['database'])
+
+    with pytest.raises(StageError) as e:
+        stages.run()
+    assert isinstance(e.value.errors['header'], ValueError)
+    assert e.value.skipped == ['database', 'notify']
+    assert ran == ['renditions']
+
+
+def test_dependencies_must_be_added_first():
+    stages = StageExecutor()
+    with pytest.raises(ValueError):
+        stages.add('notify', print, after=['database'])
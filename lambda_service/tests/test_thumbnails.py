@@ -0,0 +1,86 @@
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from lambda_service.thumbnails import resize_image
+from lambda_service.thumbnails import get_thumbnail_size
+from lambda_service.thumbnails import make_renditions
+from lambda_service.thumbnails import StreamReader
+
+
+def make_jpg(width, height):
+    image = Image.new('RGB', (width, height), (120, 60, 30))
+    jpg = io.BytesIO()
+    image.save(jpg, format='JPEG')
+    jpg.seek(0)
+    return jpg
+
+
+def test_get_thumbnail_size():
+    assert get_thumbnail_size(1536, 1024, 128) == (192, 128)
+
+
+def test_resize_image():
+    thumbnail = resize_image(make_jpg(3000, 2000), 128)
+    with Image.open(io.BytesIO(thumbnail)) as image:
+        assert image.format == 'JPEG'
+        assert image.size == (192, 128)
+
+
+def test_resize_image_does_not_enlarge():
+    test_jpg_path = 'lambda_service/tests/testing_data/testdata.jpg'
+    thumbnail = resize_image(test_jpg_path, 128)
+    with Image.open(io.BytesIO(thumbnail)) as image:
+        assert image.size == (4, 4)
+
+
+def test_make_renditions():
+    renditions = make_renditions(make_jpg(3000, 2000), [64, 128, 256, 512])
+    assert sorted(renditions) == [64, 128, 256, 512]
+    for height, rendition in renditions.items():
+        with Image.open(io.BytesIO(rendition)) as image:
+            assert image.size == (height * 3 // 2, height)
+
+
+class ForwardOnlyStream:
+    """ Stands in for an s3 response body: it can only be read forward. Records the largest read. """
+    def __init__(self, data):
+        self._data = io.BytesIO(data)
+        self.largest_read = 0
+
+    def read(self, size=-1):
+        chunk = self._data.read(size)
+        self.largest_read = max(self.largest_read, len(chunk))
+        return chunk
+
+
+def test_make_renditions_from_stream():
+    # Noise makes a jpg that's much larger than the lookback, so it can't fit in the reader's buffer
+    image = Image.frombytes('RGB', (1500, 1000), os.urandom(1500 * 1000 * 3))
+    jpg = io.BytesIO()
+    image.save(jpg, format='JPEG')
+    assert len(jpg.getvalue()) > 10 * 64 * 1024
+
+    body = ForwardOnlyStream(jpg.getvalue())
+    reader = StreamReader(body, lookback=64 * 1024)
+    renditions = make_renditions(io.BufferedReader(reader), [64, 128])
+    with Image.open(io.BytesIO(renditions[128])) as rendition:
+        assert rendition.size == (192, 128)
+    assert len(reader._buffer) <= 64 * 1024 + body.largest_read
+    assert body.largest_read < len(jpg.getvalue()) // 4
+
+
+def test_stream_reader_seeks():
+    reader = StreamReader(ForwardOnlyStream(bytes(range(100))), lookback=10)
+    assert reader.read(16) == bytes(range(16))
+    reader.seek(8)
+    assert reader.read(4) == bytes(range(8, 12))
+    reader.seek(50)
+    assert reader.read(2) == bytes([50, 51])
+    assert reader.tell() == 52
+    with pytest.raises(OSError):
+        reader.seek(0)
+    reader.seek(200)
+    assert reader.read(1) == b''
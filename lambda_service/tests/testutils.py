@@ -6,6 +6,7 @@ import os
 import datetime
 import random
 import time
+from contextlib import contextmanager
 from astropy.io import fits
 from PIL import Image
 
@@ -110,4 +111,21 @@ def get_s3_event(key):
                 }
             }
         ]
-    }
\ No newline at end of file
+    }
+
+@contextmanager
+def assert_max_statements(max_statements, db_address=None):
+    """ Fail if the code in the with block sends more than max_statements SQL statements to the database.
+
+    Use it to keep a code path from quietly growing extra queries:
+
+        with assert_max_statements(1):
+            upsert_image(DB_ADDRESS, base_filename, updates)
+    """
+    from lambda_service.db import get_db_address, get_engine
+    from lambda_service.db_profiling import count_statements
+
+    with count_statements(get_engine(db_address or get_db_address())) as profile:
+        yield profile
+    assert profile.statements <= max_statements, \
+        f"Expected at most {max_statements} statements, but {profile.statements} were run"
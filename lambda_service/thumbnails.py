@@ -1,27 +1,235 @@
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
 import boto3
-import uuid
-import PIL
-from PIL import Image
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+# The thumbnail's s3 metadata records the ETag of the jpg it was made from
+SOURCE_ETAG_METADATA_KEY = 'source-etag'
+
+# Let the jpeg decoder reduce the image to no less than this multiple of the thumbnail size, then resample the rest
+# of the way. Decoding straight to the thumbnail size is faster, but visibly blockier.
+DRAFT_REDUCING_GAP = 2
+
+MAX_UPLOAD_WORKERS = 8
+
+# How far back in a streamed jpg the decoder can seek. Pillow only seeks back to the start of the file while it
+# identifies the format; after that it reads forward.
+STREAM_LOOKBACK_BYTES = 64 * 1024
+
+
+@lru_cache(maxsize=None)
+def get_s3_client():
+    return boto3.client('s3')
+
+
+class StreamReader(io.RawIOBase):
+    """ A seekable view of a stream that can only be read forward, like the body of an s3 get_object response.
+
+    Pillow needs to seek in the files it opens, and copies any stream that can't seek into memory in full. This
+    keeps only the last `lookback` bytes read (and the bytes read but not yet consumed), so a large jpg can be decoded
+    while it downloads. Seeking forward reads and discards; seeking back further than lookback raises OSError.
+
+    Args:
+        stream (file-like): has a read(size) method.
+        lookback (int): number of bytes before the current position that can be sought back to.
+    """
+
+    def __init__(self, stream, lookback=STREAM_LOOKBACK_BYTES):
+        self._stream = stream
+        self._lookback = lookback
+        self._buffer = bytearray()
+        self._buffer_start = 0  # stream position of the first byte in the buffer
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("can't seek relative to the end of a stream")
+        if offset < self._buffer_start:
+            raise OSError(f"can't seek back to {offset}: only bytes from {self._buffer_start} are kept")
+        self._position = offset
+        return self._position
+
+    def readinto(self, buffer):
+        buffer_end = self._buffer_start + len(self._buffer)
+        while self._position >= buffer_end:
+            chunk = self._stream.read(max(len(buffer), self._position - buffer_end))
+            if not chunk:
+                return 0
+            self._buffer += chunk
+            buffer_end += len(chunk)
+
+        start = self._position - self._buffer_start
+        size = min(len(buffer), len(self._buffer) - start)
+        buffer[:size] = self._buffer[start:start + size]
+        self._position += size
+
+        # Drop what's no longer reachable
+        discard = self._position - self._lookback - self._buffer_start
+        if discard > 0:
+            del self._buffer[:discard]
+            self._buffer_start += discard
+        return size
+
+
+def get_thumbnail_size(width, height, height_pix):
+    """ The (width, height) of a thumbnail height_pix tall with the same aspect ratio as a width x height image. """
+    scale_factor = height / height_pix
+    return max(1, int(width / scale_factor)), height_pix
+
+
+def resize_image(image_file, height_pix) -> bytes:
+    """ Make a jpg thumbnail, entirely in memory.
+
+    Args:
+        image_file (file-like): a jpg, opened in binary mode.
+        height_pix (int): height of the thumbnail. Images that are already smaller are not enlarged.
+
+    Returns:
+        bytes: the thumbnail, as a jpg.
+    """
+    return make_renditions(image_file, [height_pix])[height_pix]
+
+
+def make_renditions(image_file, heights_pix) -> dict:
+    """ Make jpg renditions of several heights from a single decode of a jpg, entirely in memory.
+
+    The jpeg decoder is asked for a reduced image (Image.draft) just big enough for the largest rendition, so it
+    only does the work for a fraction of the pixels in large images. Each rendition is then resized from the next
+    larger one, largest first.
+
+    Args:
+        image_file (file-like): a jpg, opened in binary mode.
+        heights_pix (list): heights of the renditions. Images are never enlarged: a rendition taller than the
+            source is a copy of the source at its own size.
+
+    Returns:
+        dict: height: the rendition as jpg bytes.
+    """
+    from PIL import Image  # Pillow is only loaded for the events that make thumbnails
+    heights_pix = sorted(set(heights_pix), reverse=True)
+    renditions = {}
+    with Image.open(image_file) as image:
+        largest_dimensions = get_thumbnail_size(*image.size, heights_pix[0])
+        image.draft(None, tuple(DRAFT_REDUCING_GAP * d for d in largest_dimensions))
+
+        current = image
+        for height_pix in heights_pix:
+            resize_dimensions = get_thumbnail_size(*image.size, height_pix)
+            if resize_dimensions[1] < current.size[1]:
+                current = current.resize(resize_dimensions, Image.LANCZOS, reducing_gap=DRAFT_REDUCING_GAP)
+
+            rendition = io.BytesIO()
+            current.save(rendition, format='JPEG')
+            renditions[height_pix] = rendition.getvalue()
+    return renditions
+
+
+def get_thumbnail_source_etag(bucket, thumbnail_key):
+    """ The ETag of the jpg an existing thumbnail was made from, or None if there is no (tagged) thumbnail. """
+    try:
+        response = get_s3_client().head_object(Bucket=bucket, Key=thumbnail_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return response.get('Metadata', {}).get(SOURCE_ETAG_METADATA_KEY)
+
+
+def rendition_handler(bucket, key, rendition_keys, source_etag=None) -> dict:
+    """ Make renditions of the jpg at key, and save them in s3. Nothing is written to disk.
+
+    Renditions that were already made from the current version of the jpg (same ETag) are left alone. The jpg is
+    decoded once for all the others, and they're uploaded in parallel.
+
+    Args:
+        bucket (str): s3 bucket with the jpg.
+        key (str): the jpg to shrink. Example: data/wmd-ea03-20190621-00000007-EX10.jpg
+        rendition_keys (dict): height in pixels: key to save the rendition at.
+        source_etag (str): ETag of the jpg, if known (s3 notifications include it).
+
+    Returns:
+        dict: height: True if the rendition was saved, False if the existing one was up to date.
+    """
+    with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+        existing_source_etags = dict(zip(
+            rendition_keys,
+            executor.map(lambda k: get_thumbnail_source_etag(bucket, k), rendition_keys.values())
+        ))
+
+    if source_etag is not None:
+        source_etag = source_etag.strip('"')
+        outdated = [h for h, etag in existing_source_etags.items() if etag != source_etag]
+        if not outdated:
+            logger.info(f"Renditions of {key} are up to date")
+            return {height: False for height in rendition_keys}
+    else:
+        outdated = list(rendition_keys)
+
+    # If the ETag wasn't supplied, a conditional GET still avoids downloading an unchanged jpg
+    get_args = {"Bucket": bucket, "Key": key}
+    known_etags = set(existing_source_etags.values())
+    if source_etag is None and len(known_etags) == 1 and None not in known_etags:
+        get_args["IfNoneMatch"] = f'"{known_etags.pop()}"'
+    try:
+        response = get_s3_client().get_object(**get_args)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            logger.info(f"Renditions of {key} are up to date")
+            return {height: False for height in rendition_keys}
+        raise
+    etag = response['ETag'].strip('"')
+    if source_etag is None:
+        outdated = [h for h, existing_etag in existing_source_etags.items() if existing_etag != etag]
+        if not outdated:
+            return {height: False for height in rendition_keys}
 
+    # Decode while downloading, so the whole jpg is never held in memory
+    renditions = make_renditions(io.BufferedReader(StreamReader(response['Body'])), outdated)
+    upload_renditions(bucket, rendition_keys, renditions, etag)
+    return {height: height in renditions for height in rendition_keys}
 
-s3_client = boto3.client('s3')
 
-def resize_image(image_path, resized_path, height_pix):
-    with Image.open(image_path) as image:
+def upload_renditions(bucket, rendition_keys, renditions, source_etag):
+    """ Upload jpg renditions in parallel, tagged with the ETag of the jpg they were made from.
 
-        width, height = image.size
-        scale_factor = height / height_pix
-        resize_dimensions = (int(width / scale_factor), height_pix)
-        
-        image.thumbnail(resize_dimensions)
-        image.save(resized_path)
+    Args:
+        bucket (str): s3 bucket to save the renditions in.
+        rendition_keys (dict): height in pixels: key to save the rendition at.
+        renditions (dict): height in pixels: the rendition as jpg bytes (see make_renditions).
+        source_etag (str): ETag of the jpg the renditions were made from.
+    """
+    def upload(height):
+        get_s3_client().put_object(
+            Bucket=bucket,
+            Key=rendition_keys[height],
+            Body=renditions[height],
+            ContentType='image/jpeg',
+            Metadata={SOURCE_ETAG_METADATA_KEY: source_etag},
+        )
+    with ThreadPoolExecutor(max_workers=MAX_UPLOAD_WORKERS) as executor:
+        list(executor.map(upload, renditions))
 
 
-def resize_handler(bucket, key, thumbnail_key, height_pix):
-    tmpkey = key.replace('/', '')
-    download_path = f"/tmp/{uuid.uuid4()}{tmpkey}"
-    upload_path = f"/tmp/resized-{tmpkey}"
+def resize_handler(bucket, key, thumbnail_key, height_pix, source_etag=None):
+    """ Make a thumbnail of the jpg at key, and save it at thumbnail_key. See rendition_handler.
 
-    s3_client.download_file(bucket, key, download_path)
-    resize_image(download_path, upload_path, height_pix)
-    s3_client.upload_file(upload_path, bucket, thumbnail_key)
+    Returns:
+        bool: True if a thumbnail was saved, False if the existing one is up to date.
+    """
+    return rendition_handler(bucket, key, {height_pix: thumbnail_key}, source_etag=source_etag)[height_pix]
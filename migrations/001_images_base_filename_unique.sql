@@ -0,0 +1,70 @@
+-- Add a unique constraint on images.base_filename.
+--
+-- The ingest lambdas write with INSERT ... ON CONFLICT (base_filename) DO UPDATE, which requires this constraint.
+-- Before it existed, files from the same exposure arriving at the same time could create duplicate rows, so those
+-- are merged first: the row holding the header is kept, and the file-existence flags of every duplicate are
+-- folded into it.
+
+BEGIN;
+
+CREATE TEMPORARY TABLE merged_duplicates ON COMMIT DROP AS
+SELECT
+    base_filename,
+    (ARRAY_AGG(image_id ORDER BY (header IS NULL), image_id))[1] AS keep_id,
+    BOOL_OR(fits_01_exists) AS fits_01_exists,
+    BOOL_OR(fits_10_exists) AS fits_10_exists,
+    BOOL_OR(jpg_medium_exists) AS jpg_medium_exists,
+    BOOL_OR(jpg_small_exists) AS jpg_small_exists
+FROM images
+GROUP BY base_filename
+HAVING COUNT(*) > 1;
+
+UPDATE images
+SET
+    fits_01_exists = m.fits_01_exists,
+    fits_10_exists = m.fits_10_exists,
+    jpg_medium_exists = m.jpg_medium_exists,
+    jpg_small_exists = m.jpg_small_exists
+FROM merged_duplicates AS m
+WHERE images.image_id = m.keep_id;
+
+DELETE FROM images
+USING merged_duplicates AS m
+WHERE images.base_filename = m.base_filename
+  AND images.image_id <> m.keep_id;
+
+COMMIT;
+
+-- Build the index without blocking ingest, then attach it as the constraint.
+--
+-- Ingest keeps running while the index is built, so it can insert a new duplicate after the merge above. The build
+-- then fails and leaves an INVALID index behind, which IF NOT EXISTS would skip on a rerun. If that happens, run this
+-- whole file again: the merge picks up the new duplicates, and the invalid index is dropped and rebuilt below.
+-- (Or pause the insert_data functions, eg. with reserved concurrency 0, until the constraint is added.)
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_index
+        WHERE indexrelid = to_regclass('images_base_filename_key') AND NOT indisvalid
+    ) THEN
+        RAISE NOTICE 'Dropping the invalid index images_base_filename_key left by an earlier run';
+        DROP INDEX images_base_filename_key;
+    END IF;
+END;
+$$;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS images_base_filename_key ON images (base_filename);
+
+-- Stop here if the index is still invalid (a duplicate arrived during this build); rerun the file.
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_index
+        WHERE indexrelid = to_regclass('images_base_filename_key') AND NOT indisvalid
+    ) THEN
+        RAISE EXCEPTION 'images_base_filename_key is invalid (duplicates were written during the build); run again';
+    END IF;
+END;
+$$;
+
+ALTER TABLE images ADD CONSTRAINT images_base_filename_key UNIQUE USING INDEX images_base_filename_key;
@@ -0,0 +1,22 @@
+-- Step 1 of moving images.header from a json string (character varying) to an indexed jsonb column.
+--
+-- Adds header_jsonb next to the existing header column, and a trigger that fills it whenever the currently
+-- deployed code writes a header, so nothing is missed while 003_backfill_header_jsonb.py converts existing rows.
+
+ALTER TABLE images ADD COLUMN IF NOT EXISTS header_jsonb JSONB;
+
+CREATE OR REPLACE FUNCTION images_header_to_jsonb() RETURNS trigger AS $$
+BEGIN
+    NEW.header_jsonb := NEW.header::jsonb;
+    RETURN NEW;
+EXCEPTION WHEN others THEN
+    -- Leave headers that aren't valid json for the backfill script to report
+    NEW.header_jsonb := NULL;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS images_header_to_jsonb ON images;
+CREATE TRIGGER images_header_to_jsonb
+    BEFORE INSERT OR UPDATE OF header ON images
+    FOR EACH ROW EXECUTE PROCEDURE images_header_to_jsonb();
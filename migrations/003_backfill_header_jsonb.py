@@ -0,0 +1,77 @@
+""" Step 2 of moving images.header to jsonb: copy existing headers into images.header_jsonb.
+
+Rows are converted in chunks, in image_id order, each chunk in its own transaction. Only rows whose header_jsonb is
+still empty are selected, so the script can be stopped and started again at any time; pass --start-after to skip
+ahead to the image_id printed by an earlier run.
+
+Headers are parsed in python rather than with header::jsonb, so that a single bad row doesn't abort its chunk.
+NaN and Infinity (which json.dumps writes but postgres rejects) are stored as strings. Rows whose header is not
+valid json are reported and left empty.
+
+Usage:
+    $ python migrations/003_backfill_header_jsonb.py --db-url "$DB_URL" [--chunk-size 5000] [--start-after 0]
+"""
+import argparse
+import json
+import os
+import time
+
+from sqlalchemy import create_engine, text
+
+SELECT_CHUNK = text("""
+    SELECT image_id, header FROM images
+    WHERE image_id > :after AND header IS NOT NULL AND header_jsonb IS NULL
+    ORDER BY image_id
+    LIMIT :chunk_size
+""")
+UPDATE_ROW = text("UPDATE images SET header_jsonb = CAST(:header AS jsonb) WHERE image_id = :image_id")
+
+
+def to_jsonb_text(header_text):
+    """ Re-serialize a header json string so postgres will accept it as jsonb. """
+    header = json.loads(header_text, parse_constant=str)
+    return json.dumps(header)
+
+
+def backfill(db_url, chunk_size, start_after):
+    engine = create_engine(db_url)
+    last_id = start_after
+    converted = 0
+    invalid = []
+    start = time.time()
+
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(SELECT_CHUNK, {"after": last_id, "chunk_size": chunk_size}).fetchall()
+            if not rows:
+                break
+            updates = []
+            for image_id, header_text in rows:
+                try:
+                    updates.append({"image_id": image_id, "header": to_jsonb_text(header_text)})
+                except ValueError:
+                    invalid.append(image_id)
+            if updates:
+                connection.execute(UPDATE_ROW, updates)
+        converted += len(updates)
+        last_id = rows[-1][0]
+        print(f"converted {converted} rows, last image_id {last_id}, {time.time() - start:.0f}s")
+
+    if invalid:
+        print(f"{len(invalid)} rows have headers that are not valid json: {invalid}")
+    print("done")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url', default=os.getenv('DB_URL'), help='SQLAlchemy url of the database')
+    parser.add_argument('--chunk-size', type=int, default=5000)
+    parser.add_argument('--start-after', type=int, default=0, help='only convert rows with a larger image_id')
+    args = parser.parse_args()
+    if not args.db_url:
+        parser.error('--db-url (or the DB_URL environment variable) is required')
+    backfill(args.db_url, args.chunk_size, args.start_after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+-- Step 3 of moving images.header to jsonb: swap the columns and index the new one.
+--
+-- Run 003_backfill_header_jsonb.py again right before this file, so headers written since the first backfill that
+-- postgres can't cast (eg. with NaN or Infinity values) are re-serialized, then deploy the code that writes a jsonb
+-- header (and the matching photonranch-api change) right after. The old text column is kept as header_text until
+-- it's no longer needed.
+
+BEGIN;
+
+-- Like header::jsonb, but NULL instead of an error for headers that aren't valid json, so one bad row can't roll
+-- back the swap.
+CREATE OR REPLACE FUNCTION images_try_jsonb(header_text TEXT) RETURNS JSONB AS $$
+BEGIN
+    RETURN header_text::jsonb;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+-- Catch any rows written since the backfill finished
+UPDATE images SET header_jsonb = images_try_jsonb(header)
+WHERE header IS NOT NULL AND header_jsonb IS NULL;
+
+-- Report the headers that are still missing. Their text is kept in header_text.
+DO $$
+DECLARE
+    missing INTEGER;
+BEGIN
+    SELECT COUNT(*) INTO missing FROM images WHERE header IS NOT NULL AND header_jsonb IS NULL;
+    IF missing > 0 THEN
+        RAISE WARNING '% rows have headers that could not be converted to jsonb; see header_text', missing;
+    END IF;
+END;
+$$;
+
+DROP FUNCTION images_try_jsonb(TEXT);
+DROP TRIGGER IF EXISTS images_header_to_jsonb ON images;
+DROP FUNCTION IF EXISTS images_header_to_jsonb();
+
+ALTER TABLE images RENAME COLUMN header TO header_text;
+ALTER TABLE images RENAME COLUMN header_jsonb TO header;
+
+COMMIT;
+
+-- Index for header queries (containment and key existence). Built without blocking ingest.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS images_header_gin ON images USING GIN (header);
+
+-- Once nothing reads the old column:
+-- ALTER TABLE images DROP COLUMN header_text;
@@ -0,0 +1,5 @@
+-- Record which jpg renditions (by height in pixels) exist for each image. See helpers.get_s3_rendition_path for
+-- where each rendition is saved. NULL means no renditions were recorded; older images only have the EX11 thumbnail,
+-- which is still tracked by jpg_small_exists.
+
+ALTER TABLE images ADD COLUMN IF NOT EXISTS jpg_renditions INTEGER[];